@@ -1,3 +1,31 @@
 #!/usr/bin/env bash
 # start searchd without exiting shell
+
+# Size the rt index RAM chunk for the GeoNames dataset loaded (CITYSEARCH_DATASET),
+# SPHINX_RT_MEM_LIMIT overrides it:
+case "${CITYSEARCH_DATASET:-cities1000}" in
+	cities15000) RT_MEM_LIMIT=128M ;;
+	cities5000) RT_MEM_LIMIT=256M ;;
+	allCountries) RT_MEM_LIMIT=1024M ;;
+	*) RT_MEM_LIMIT=512M ;;
+esac
+RT_MEM_LIMIT=${SPHINX_RT_MEM_LIMIT:-$RT_MEM_LIMIT}
+sed -i "s/^\(\s*rt_mem_limit\s*=\s*\).*/\1$RT_MEM_LIMIT/" /etc/sphinxsearch/sphinx.conf
+
+# Index the tsvpipe source of the plain city index whenever the loader writes a newer one,
+# rotating it into the running searchd (seamless_rotate). The stamp, taken before indexing, is
+# kept only once indexer succeeds, so a failed run is retried:
+TSV=/tmp/citysearch/sphinx/city.tsv
+STAMP=/var/lib/sphinxsearch/data/city.indexed
+(
+	while sleep 10; do
+		if [ -f $TSV ] && [ $TSV -nt $STAMP ]; then
+			touch $STAMP.new
+			if indexer --rotate city; then
+				mv $STAMP.new $STAMP
+			fi
+		fi
+	done
+) &
+
 searchd --nodetach
@@ -1,38 +1,31 @@
+# Secondary indexes are in CityIndexes.sql, built after the bulk load.
+# Widths fit every GeoNames dataset, allCountries included (12M+ rows, altnames up to 10000 chars, continent populations past 2^32).
 CREATE TABLE IF NOT EXISTS City (
-	id MEDIUMINT UNSIGNED PRIMARY KEY,
-	geonameid INT UNSIGNED UNIQUE NOT NULL,
-	name CHAR(100) NOT NULL COLLATE utf8_bin,
-	asciiname CHAR(100) COLLATE utf8_bin,
-	altnames CHAR(200) COLLATE utf8_bin,
+	id INT UNSIGNED PRIMARY KEY,
+	geonameid INT UNSIGNED NOT NULL,
+	name VARCHAR(200) NOT NULL COLLATE utf8_bin,
+	asciiname VARCHAR(200) COLLATE utf8_bin,
+	altnames VARCHAR(10000) COLLATE utf8_bin,
 	latitude FLOAT NOT NULL,
 	longitude FLOAT NOT NULL,
-	feat_class CHAR(1) NOT NULL COLLATE utf8_bin,
-	feat_code CHAR(5) NOT NULL COLLATE utf8_bin,
+	feat_class CHAR(1) COLLATE utf8_bin,
+	feat_code CHAR(10) COLLATE utf8_bin,
 	country_code CHAR(2) COLLATE utf8_bin,
-	cc2 CHAR(5) COLLATE utf8_bin,
-	admin1_code CHAR(10) COLLATE utf8_bin,
-	admin2_code CHAR(50) COLLATE utf8_bin,
-	admin3_code CHAR(10) COLLATE utf8_bin,
+	cc2 VARCHAR(200) COLLATE utf8_bin,
+	admin1_code CHAR(20) COLLATE utf8_bin,
+	admin2_code VARCHAR(80) COLLATE utf8_bin,
+	admin3_code CHAR(20) COLLATE utf8_bin,
 	admin4_code CHAR(20) COLLATE utf8_bin,
-	population INT UNSIGNED NOT NULL,
+	population BIGINT UNSIGNED NOT NULL,
 	elevation FLOAT,
 	dem SMALLINT NOT NULL,
-	timezone CHAR(32) COLLATE utf8_bin,
-	modified DATE,
-	INDEX (name),
-	INDEX idx_lat (latitude),
-	INDEX idx_lon (longitude),
-#	INDEX idx_lonlat (longitude, latitude),
-	INDEX (feat_class),
-	INDEX (feat_code),
-	INDEX (cc2),
-	INDEX (country_code),
-	INDEX (admin1_code),
-	INDEX (admin2_code),
-	INDEX (admin3_code),
-	INDEX (admin4_code),
-	INDEX (population),
-	INDEX (elevation),
-	INDEX (timezone),
-	INDEX (modified)
+	timezone VARCHAR(40) COLLATE utf8_bin,
+	modified DATE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+#split#
+# What City holds, the source file and delta files of its last complete load (see DataLoader.load_state),
+# in one row written once the load and its indexes are done, and removed before City is changed:
+CREATE TABLE IF NOT EXISTS CityLoad (
+	id TINYINT UNSIGNED PRIMARY KEY,
+	state TEXT NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
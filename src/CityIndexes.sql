@@ -0,0 +1,29 @@
+# Secondary indexes of City, added in one table pass after the bulk load, and its spatial CityPoint table.
+ALTER TABLE City
+	ADD UNIQUE INDEX IF NOT EXISTS geonameid (geonameid),
+	ADD INDEX IF NOT EXISTS name (name),
+	ADD INDEX IF NOT EXISTS idx_lat (latitude),
+	ADD INDEX IF NOT EXISTS idx_lon (longitude),
+#	ADD INDEX IF NOT EXISTS idx_lonlat (longitude, latitude),
+	ADD INDEX IF NOT EXISTS feat_class (feat_class),
+	ADD INDEX IF NOT EXISTS feat_code (feat_code),
+	ADD INDEX IF NOT EXISTS cc2 (cc2),
+	ADD INDEX IF NOT EXISTS country_code (country_code),
+	ADD INDEX IF NOT EXISTS admin1_code (admin1_code),
+	ADD INDEX IF NOT EXISTS admin2_code (admin2_code),
+	ADD INDEX IF NOT EXISTS admin3_code (admin3_code),
+	ADD INDEX IF NOT EXISTS admin4_code (admin4_code),
+	ADD INDEX IF NOT EXISTS population (population),
+	ADD INDEX IF NOT EXISTS elevation (elevation),
+	ADD INDEX IF NOT EXISTS timezone (timezone),
+	ADD INDEX IF NOT EXISTS modified (modified);
+#split#
+# CityPoint, City's coordinates as POINTs (x longitude, y latitude) under a SPATIAL index for
+# proximity_search3, filled from City after the load. Aria, as InnoDB has no SPATIAL indexes before
+# MariaDB 10.2; its bulk insert into the empty table builds the index in one sort.
+CREATE TABLE IF NOT EXISTS CityPoint (
+	id INT UNSIGNED PRIMARY KEY,
+	country_code CHAR(2) COLLATE utf8_bin,
+	location POINT NOT NULL,
+	SPATIAL INDEX location (location)
+) ENGINE=Aria DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
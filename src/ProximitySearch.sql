@@ -1,6 +1,8 @@
 DROP PROCEDURE IF EXISTS proximity_search;
 #split#
-CREATE PROCEDURE proximity_search (IN city_id INT UNSIGNED, k INT UNSIGNED, ccode CHAR(2))
+CREATE PROCEDURE proximity_search (IN city_id INT UNSIGNED, k INT UNSIGNED, ccode CHAR(2), fields VARCHAR(1024))
+	COMMENT 'fields is a select list of City c columns, NULL for c.*,
+			 callers must only pass validated column names.'
 BEGIN
 	SELECT @lat := latitude, @lon := longitude FROM City WHERE id = city_id;
 	IF k < 1000 THEN
@@ -26,11 +28,16 @@ BEGIN
 		INSERT INTO GeoPatch
 		SELECT id FROM City WHERE latitude >= (@lat - @dt) AND latitude <= (@lat + @dt) AND longitude >= (@lon - @dt) AND longitude <= (@lon + @dt);
 	END IF;
-	SELECT c.*
-	FROM City c
-	JOIN GeoPatch p
-		ON (c.id = p.id)
-	WHERE (ccode IS NULL) OR (country_code = ccode)
-	ORDER BY geo_dist(@lat, @lon, latitude, longitude) ASC
-	LIMIT k;
+	SET @ccode := ccode, @k := k;
+	SET @sql := CONCAT(
+		'SELECT ', IFNULL(fields, 'c.*'), '
+		FROM City c
+		JOIN GeoPatch p
+			ON (c.id = p.id)
+		WHERE (? IS NULL) OR (c.country_code = ?)
+		ORDER BY geo_dist(@lat, @lon, c.latitude, c.longitude) ASC
+		LIMIT ?');
+	PREPARE stmt FROM @sql;
+	EXECUTE stmt USING @ccode, @ccode, @k;
+	DEALLOCATE PREPARE stmt;
 END;
@@ -0,0 +1,87 @@
+DROP PROCEDURE IF EXISTS proximity_window;
+#split#
+CREATE PROCEDURE proximity_window (IN lat DOUBLE, lon DOUBLE, dt DOUBLE)
+	COMMENT 'Sets @w1 (and @w2 when it crosses the antimeridian, else NULL) to
+			 the MBR windows holding every point within dt degrees of arc of
+			 lat, lon, widened to all longitudes when it reaches a pole.'
+BEGIN
+	DECLARE lat1 DOUBLE DEFAULT GREATEST(-90, lat - dt);
+	DECLARE lat2 DOUBLE DEFAULT LEAST(90, lat + dt);
+	DECLARE dlon DOUBLE DEFAULT 180;
+	IF lat1 > -90 AND lat2 < 90 THEN
+		SET dlon := LEAST(180, dt / COS(RADIANS(GREATEST(ABS(lat1), ABS(lat2)))));
+	END IF;
+	SET @w2 := NULL;
+	IF dlon >= 180 THEN
+		SET @w1 := ENVELOPE(LINESTRING(POINT(-180, lat1), POINT(180, lat2)));
+	# Antimeridian, west:
+	ELSEIF lon - dlon < -180 THEN
+		SET @w1 := ENVELOPE(LINESTRING(POINT(-180, lat1), POINT(lon + dlon, lat2)));
+		SET @w2 := ENVELOPE(LINESTRING(POINT(lon - dlon + 360, lat1), POINT(180, lat2)));
+	# Antimeridian, east:
+	ELSEIF lon + dlon > 180 THEN
+		SET @w1 := ENVELOPE(LINESTRING(POINT(lon - dlon, lat1), POINT(180, lat2)));
+		SET @w2 := ENVELOPE(LINESTRING(POINT(-180, lat1), POINT(lon + dlon - 360, lat2)));
+	ELSE
+		SET @w1 := ENVELOPE(LINESTRING(POINT(lon - dlon, lat1), POINT(lon + dlon, lat2)));
+	END IF;
+END;
+#split#
+DROP PROCEDURE IF EXISTS proximity_search3;
+#split#
+CREATE PROCEDURE proximity_search3 (IN city_id INT UNSIGNED, k INT UNSIGNED, ccode CHAR(2), fields VARCHAR(1024))
+	COMMENT 'proximity_search over the CityPoint SPATIAL index: MBRContains windows
+			 double until one holds k cities, then the window of the k-th nearest
+			 one''s distance holds the exact k nearest, ordered by an inline
+			 haversine. fields is a select list of City c columns, NULL for c.*,
+			 callers must only pass validated column names.'
+BEGIN
+	DECLARE kth INT UNSIGNED DEFAULT GREATEST(k, 1) - 1;
+	SELECT @lat := latitude, @lon := longitude FROM City WHERE id = city_id;
+	SET @ccode := ccode, @k := k, @dt := 0.25, @n := 0;
+	WHILE @n < k AND @dt < 180 DO
+		SET @dt := @dt * 2;
+		CALL proximity_window(@lat, @lon, @dt);
+		SELECT
+			(SELECT COUNT(1) FROM CityPoint WHERE MBRContains(@w1, location) AND (@ccode IS NULL OR country_code = @ccode)) +
+			(SELECT COUNT(1) FROM CityPoint WHERE MBRContains(@w2, location) AND (@ccode IS NULL OR country_code = @ccode))
+		INTO @n;
+	END WHILE;
+	# The k nearest in the window may not be the k nearest overall (its corners reach
+	# further than its sides), so the final window is that of the k-th one's distance:
+	IF @n >= k AND k > 0 THEN
+		SELECT DEGREES(2 * ASIN(SQRT(
+			POW(SIN(RADIANS(p.lat - @lat) / 2), 2) +
+			COS(RADIANS(@lat)) * COS(RADIANS(p.lat)) * POW(SIN(RADIANS(p.lon - @lon) / 2), 2)))) AS arc
+		INTO @arc
+		FROM (
+			SELECT ST_Y(location) AS lat, ST_X(location) AS lon FROM CityPoint
+			WHERE MBRContains(@w1, location) AND (@ccode IS NULL OR country_code = @ccode)
+			UNION ALL
+			SELECT ST_Y(location) AS lat, ST_X(location) AS lon FROM CityPoint
+			WHERE MBRContains(@w2, location) AND (@ccode IS NULL OR country_code = @ccode)) p
+		ORDER BY arc ASC
+		LIMIT kth, 1;
+		CALL proximity_window(@lat, @lon, @arc + 1e-6);
+	END IF;
+	SET @sql := CONCAT(
+		'SELECT ', IFNULL(fields, 'c.*'), '
+		FROM (
+			SELECT id, SQRT(
+				POW(SIN(RADIANS(lat - @lat) / 2), 2) +
+				COS(RADIANS(@lat)) * COS(RADIANS(lat)) * POW(SIN(RADIANS(lon - @lon) / 2), 2)) AS hav
+			FROM (
+				SELECT id, ST_Y(location) AS lat, ST_X(location) AS lon FROM CityPoint
+				WHERE MBRContains(@w1, location) AND (@ccode IS NULL OR country_code = @ccode)
+				UNION ALL
+				SELECT id, ST_Y(location) AS lat, ST_X(location) AS lon FROM CityPoint
+				WHERE MBRContains(@w2, location) AND (@ccode IS NULL OR country_code = @ccode)) w
+			ORDER BY hav ASC, id ASC
+			LIMIT ?) p
+		JOIN City c
+			ON (c.id = p.id)
+		ORDER BY p.hav ASC, p.id ASC');
+	PREPARE stmt FROM @sql;
+	EXECUTE stmt USING @k;
+	DEALLOCATE PREPARE stmt;
+END;
@@ -4,22 +4,32 @@ This module has mixed concerns about data fetching,
 database schema, database inserts, web caching, and web responses.
 """
 
-import io
 import os
+import csv
 import re
+import argparse
+import json
 import time
+import email.utils
+import queue
 import random
-import zipfile
+import asyncio
+import contextlib
+import collections
 import concurrent.futures
 
 import requests
 import numpy as np
 import pandas as pd
-from rtree import index as rtree
 
 import logger
-from mariadb import SQL
-from sphinxql import SphinxQL
+import snapshot
+from citystore import CityStore, position_dtype
+from download import DownloadError, fetch, extract, read_state, write_state
+from geoindex import GeoIndex
+from mariadb import SQL, AsyncSQLPool, retry_delay
+from resultcache import ResultCache, cached
+from sphinxql import SphinxQL, AsyncSphinxQLPool, MAX_BATCH_QUERIES
 
 
 # Statics:
@@ -27,6 +37,52 @@ col_names = ['geonameid','name','asciiname','altnames','latitude','longitude','f
 col_names += ['country_code', 'cc2', 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code']
 col_names += ['population','elevation','dem','timezone','modified']
 col_set = set(col_names)
+col_types = {'id':'int64', 'geonameid':'int64', 'latitude':'float32', 'longitude':'float32'}
+col_types.update({'population':'int64', 'elevation':'float64', 'dem':'int64'}) # Others are strings.
+
+# GeoNames dump directory the source archive is downloaded from, and the dataset (dump file) served:
+GEONAMES_URL = os.getenv('CITYSEARCH_GEONAMES_URL', 'http://download.geonames.org/export/dump/')
+DATASETS = ['cities500', 'cities1000', 'cities5000', 'cities15000', 'allCountries']
+DATASET = os.getenv('CITYSEARCH_DATASET', 'cities1000')
+
+# Points per geo index leaf, 0 for about sqrt(n) (see GeoIndex):
+GEO_LEAFSIZE = int(os.getenv('CITYSEARCH_GEO_LEAFSIZE', 0))
+
+# Rows per parsed chunk of a GeoNames file, the parse/load pipeline holds a few chunks at a time:
+CHUNK_ROWS = int(os.getenv('CITYSEARCH_CHUNK_ROWS', 100000))
+
+# MariaDB bulk load: 'infile' (LOAD DATA LOCAL INFILE from a staging file per chunk)
+# or 'insert' (multi-row INSERTs over LOAD_CONNECTIONS parallel connections by id range):
+BULK_LOAD = os.getenv('CITYSEARCH_BULK_LOAD', 'infile')
+LOAD_CONNECTIONS = int(os.getenv('CITYSEARCH_LOAD_CONNECTIONS', 4))
+
+# Sphinx bulk load: 'rt' (multi-row INSERTs of up to max_packet_size over SPHINX_LOAD_CONNECTIONS
+# connections) or 'tsvpipe' (a TSV file for the plain city index, which searchd.sh indexes and rotates in):
+SPHINX_LOAD = os.getenv('SPHINX_LOAD', 'rt')
+SPHINX_LOAD_CONNECTIONS = int(os.getenv('SPHINX_LOAD_CONNECTIONS', 4))
+# Index searched, 'cities' is the plain city index overlaid by rt (tsvpipe leaves rt to delta updates):
+SPHINX_INDEX = os.getenv('SPHINX_INDEX', 'cities' if SPHINX_LOAD == 'tsvpipe' else 'rt')
+
+# Seconds to wait for a database to accept connections on a cold start:
+READY_TIMEOUT = float(os.getenv('CITYSEARCH_READY_TIMEOUT', 300))
+# Seconds a warm start waits (once) for each database to answer its load record check:
+CHECK_TIMEOUT = int(os.getenv('CITYSEARCH_CHECK_TIMEOUT', 1))
+
+# GeoNames daily delta files, and the admin seats citiesN files keep at any population:
+DELTA_FILE = re.compile(r'^(modifications|deletes)-(\d{4}-\d{2}-\d{2})\.txt$')
+SEAT_CODES = ['PPLC', 'PPLA', 'PPLA2', 'PPLA3']
+
+# Hydrate text search hits from the in-memory store, else from MariaDB in chunks:
+HYDRATE_MEMORY = os.getenv('CITYSEARCH_HYDRATE', 'memory') == 'memory'
+HYDRATE_CHUNK = 1000
+
+# Streaming responses, rows per chunk, and the largest text search limit:
+STREAM_CHUNK = 1000
+TEXT_LIMIT_MAX = int(os.getenv('CITYSEARCH_TEXT_LIMIT_MAX', 100000))
+
+# Batch proximity search, items per request and per vectorized pass:
+BATCH_MAX = int(os.getenv('CITYSEARCH_BATCH_MAX', 100000))
+BATCH_CHUNK = 4096
 
 
 def colnames():
@@ -48,64 +104,333 @@ def chunks(l, n):
 	for i in range(0, len(l), n):
 		yield l[i:i + n]
 
+def fanout(items, consumers, depth = 2):
+	"""
+	Feed every item of an iterator to each consumer (a function of an
+	iterator) running in its own thread, through bounded queues so at most
+	depth items per consumer are in flight. Returns the consumers' results.
+	"""
+	done = object()
+	queues = [queue.Queue(depth) for _ in consumers]
+
+	def drain(q):
+		while True:
+			item = q.get()
+			if item is done:
+				return
+			yield item
+
+	def run(consumer, q):
+		items = drain(q)
+		try:
+			return consumer(items)
+		finally:
+			for _ in items: # A consumer that stops early must not block the producer.
+				pass
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers = len(consumers)) as ex:
+		futures = [ex.submit(run, consumer, q) for consumer, q in zip(consumers, queues)]
+		try:
+			for item in items:
+				for q in queues:
+					q.put(item)
+		finally:
+			for q in queues:
+				q.put(done)
+		return [f.result() for f in futures]
+
+def wait_ready(name, probe, timeout = None):
+	""" Call probe until it stops raising, backing off between attempts, for up to timeout seconds. """
+	timeout = READY_TIMEOUT if timeout is None else timeout
+	started = time.time()
+	attempt = 0
+	while True:
+		try:
+			probe()
+			break
+		except Exception:
+			if time.time() - started > timeout:
+				raise
+			time.sleep(retry_delay(attempt))
+			attempt += 1
+	logger.info('%s is ready after %.1f s.' % (name, time.time() - started))
+
+
+
+class StartupTimer:
+	""" Wall clock timings of named startup phases. """
+
+	def __init__(self):
+		self.started = time.time()
+		self.phases = collections.OrderedDict()
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		""" Time the enclosed block as a named phase. """
+		started = time.time()
+		try:
+			yield
+		finally:
+			self.phases[name] = time.time() - started
+
+	def timed(self, name, fn, *args):
+		""" Call fn as a named phase, e.g. in another thread. """
+		with self.phase(name):
+			return fn(*args)
+
+	def report(self):
+		""" Phase timings as a printable table. """
+		lines = ['%-20s %9.3f s' % (name, secs) for name, secs in self.phases.items()]
+		lines += ['%-20s %9.3f s' % ('total', time.time() - self.started)]
+		return '\n'.join(lines)
+
 
 
 class DataLoader:
 
+	def __init__(self, dataset = None):
+		self.dataset = dataset or DATASET
+		if self.dataset not in DATASETS:
+			raise ValueError('Unknown dataset %s, expected one of %s.' % (self.dataset, ', '.join(DATASETS)))
+
 	def dlpath(self):
 		""" Download path."""
 		return '/tmp/citysearch'
 
 	def srcfile(self):
 		""" Full source file path."""
-		return os.path.join(self.dlpath(), 'cities1000.txt')
+		return os.path.join(self.dlpath(), self.dataset + '.txt')
+
+	def archive(self):
+		""" Path of the source file's zip archive."""
+		return os.path.splitext(self.srcfile())[0] + '.zip'
 
 	def download(self):
-		""" Download city data from web source."""
+		"""
+		Download the source archive from GEONAMES_URL, streamed to disk and
+		extracted member by member, unless the server reports it unchanged
+		since the last download (or since the source file was written).
+		An existing source file is kept when the server cannot be reached.
+		Returns whether the source file was refreshed.
+		"""
 		logger.info('Download starting...')
-		if os.path.isfile(self.srcfile()):
-			logger.info('City csv exists, skipping donwload...')
-		else:
-			zurl = 'http://download.geonames.org/export/dump/cities1000.zip'
-			rz = requests.get(zurl)
-			zf = zipfile.ZipFile(io.BytesIO(rz.content))
-			zf.extractall(self.dlpath())
-		logger.info('Download finished.')
-
-	def to_dataframe(self):
-		""" Parse csv with Pandas. """
+		archive = self.archive()
+		url = GEONAMES_URL.rstrip('/') + '/' + os.path.basename(archive)
+		since = os.path.getmtime(self.srcfile()) if os.path.isfile(self.srcfile()) else None
+		state = read_state(archive + '.json') if since is not None else {}
+		started = time.time()
+		try:
+			state = fetch(url, archive, state, since)
+		except (requests.RequestException, DownloadError) as ex:
+			if since is None:
+				raise
+			logger.info('Download check failed, keeping the current source file: %s' % ex)
+			return False
+		if state is None:
+			logger.info('%s unchanged, skipping download.' % url)
+			return False
+		extract(archive, self.dlpath(), [os.path.basename(self.srcfile())])
+		os.remove(archive)
+		write_state(archive + '.json', state)
+		verified = ', %s digest verified' % state['digest'][0] if state.get('digest') else ''
+		logger.info('Download finished: %d bytes in %.1f s%s.' % (state['size'], time.time() - started, verified))
+		return True
+
+	def geonames_chunks(self, path, chunksize = None):
+		"""
+		Parse a GeoNames table (the dump or a modifications file) with Pandas,
+		chunksize rows at a time: numeric columns typed, strings None for nulls.
+		"""
 		cols = colnames()
-		df = pd.read_csv(self.srcfile(), sep = '\t', header = None, names = cols, index_col = False, low_memory = False)
-		df = df.astype(object).where(pd.notnull(df), None)
-		df.latitude = df.latitude.astype('float32')
-		df.longitude = df.longitude.astype('float32')
-		#df.population = df.population.astype('uint64')
-		#df.elevation = df.elevation.astype('float32')
-		df.index = df.index + 1 # Use 1 based indexing.
-		df.reset_index(drop = False, inplace = True)
-		df.rename(columns = {'index':'id'}, inplace = True)
-		assert df.shape[1] == len(cols) + 1
-		return df
-
-	def to_sphinx(self, df):
-		""" Defer the city altnames to Sphinx. """
-		logger.info('Inserting city data into Sphinx...')
-		dg = df[['id','altnames']].copy()
-		dg = dg[~dg.altnames.isnull()]
-		dg.altnames = dg.altnames.apply(sphinx_escape)
-		dg['pk'] = dg.id
-		dm = dg.as_matrix()
-		sql = SphinxQL()
-		numrecs = int(sql.fetchone('SELECT COUNT(*) FROM rt')[0])
-		if numrecs == 0:
-			sqltxt = 'INSERT INTO rt VALUES (%s, %s, %s)'
-			for x in dm:
-				params = tuple(x.tolist())
-				sql.execute(sqltxt, params)
-			sql.commitclose()
+		dtypes = {col: col_types.get(col, object) for col in cols}
+		reader = pd.read_csv(
+			path, sep = '\t', header = None, names = cols, index_col = False, dtype = dtypes,
+			keep_default_na = False, na_values = [''], quoting = csv.QUOTE_NONE, chunksize = chunksize or CHUNK_ROWS)
+		for df in reader:
+			for col in cols:
+				if col not in col_types:
+					df[col] = df[col].where(df[col].notnull(), None)
+			yield df
+
+	def read_geonames(self, path):
+		""" Parse a (small) GeoNames table whole, e.g. a modifications file. """
+		parts = list(self.geonames_chunks(path))
+		if not parts:
+			return pd.DataFrame([], columns = colnames())
+		return pd.concat(parts, ignore_index = True)
+
+	def to_chunks(self):
+		""" Parse the source file in chunks of CHUNK_ROWS, with a 1 based id column in front. """
+		start = 1
+		for df in self.geonames_chunks(self.srcfile()):
+			df.insert(0, 'id', np.arange(start, start + len(df), dtype = 'int64'))
+			start += len(df)
+			yield df
+
+	@staticmethod
+	def records(df):
+		""" Row tuples of plain python values, None for nulls, as the database drivers expect. """
+		cols = []
+		for col in df.columns:
+			vals = df[col].tolist()
+			nulls = df[col].isnull().values
+			if nulls.any():
+				vals = [None if null else val for val, null in zip(vals, nulls)]
+			cols.append(vals)
+		return list(zip(*cols))
+
+	def has_snapshot(self):
+		""" Whether a snapshot current for the source file exists. """
+		return os.path.isfile(self.srcfile()) and snapshot.current(self.dlpath(), self.snapshot_fingerprint())
+
+	def snapshot_fingerprint(self):
+		""" Identify the source file a snapshot was built from. """
+		st = os.stat(self.srcfile())
+		return {'srcfile': os.path.basename(self.srcfile()), 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+	def write_snapshot(self, store, indexes, meta = None):
+		"""
+		Write the city store and geo indexes as a memory-mappable snapshot under dlpath,
+		meta recording the applied delta files and the snapshot generation.
+		"""
+		logger.info('Writing city snapshot...')
+		arrays = {'dead': store.dead}
+		arrays.update(('order.' + col, order) for col, order in store.orders().items())
+		arrays.update(('keys.' + col, keys) for col, keys in store.search_keys().items())
+		arrays.update(('json.' + attr, arr) for attr, arr in store.json.arrays().items())
+		path = snapshot.write(self.dlpath(), self.snapshot_fingerprint(), store.columns, indexes, arrays, meta)
+		logger.info('City snapshot written to %s.' % path)
+
+	def read_snapshot(self):
+		"""
+		Memory-map the snapshot if it is current for the source file,
+		returning (CityStore, geo indexes, meta) or None.
+		"""
+		if not os.path.isfile(self.srcfile()):
+			return None
+		snap = snapshot.read(self.dlpath(), self.snapshot_fingerprint())
+		if snap is None:
+			return None
+		columns, indexes, arrays, meta = snap
+		orders = {name[len('order.'):]: arr for name, arr in arrays.items() if name.startswith('order.')}
+		keys = {name[len('keys.'):]: arr for name, arr in arrays.items() if name.startswith('keys.')}
+		encoded = {name[len('json.'):]: arr for name, arr in arrays.items() if name.startswith('json.')}
+		return CityStore(columns, orders, encoded, keys, arrays.get('dead')), indexes, meta
+
+	def sphinx_state(self):
+		""" The load_state Sphinx holds, from its loadstate index, None if no load (in this SPHINX_LOAD mode) completed. """
+		try:
+			rs = SphinxQL(autoretry = False).fetchone('SELECT state FROM loadstate WHERE id = 1')
+		except Exception:
+			return None
+		state = json.loads(rs[0]) if rs else None
+		if state is None or state.pop('load', None) != SPHINX_LOAD:
+			return None
+		return state
+
+	def write_sphinx_state(self, state):
+		""" Record the load_state Sphinx holds (and the SPHINX_LOAD mode), or with None that it is being changed. """
+		sql = SphinxQL(autocommit = True)
+		if state is None:
+			sql.execute('DELETE FROM loadstate WHERE id = 1')
 		else:
-			logger.info('Sphinx data exists, skipping.')
-		logger.info('Finished Sphinx inserts.')
+			sql.execute("REPLACE INTO loadstate (id, marker, state) VALUES (1, '', %s)", (json.dumps(dict(state, load = SPHINX_LOAD), sort_keys = True),))
+		sql.close()
+
+	def write_states(self, state):
+		""" write_mariadb_state and write_sphinx_state. """
+		self.write_mariadb_state(state)
+		self.write_sphinx_state(state)
+
+	def databases_hold(self, state):
+		"""
+		Whether MariaDB and Sphinx both hold the load_state state. Their load
+		records stand in for row counts, which a partial load or a changed
+		source file can match too. A single connection attempt of at most
+		CHECK_TIMEOUT seconds each, raising if a database cannot be reached.
+		"""
+		SQL(db = 'mysql', printsql = False, autoretry = False, connect_timeout = CHECK_TIMEOUT).close()
+		SphinxQL(autoretry = False, connect_timeout = CHECK_TIMEOUT).close()
+		return self.mariadb_state() == state and self.sphinx_state() == state
+
+	def reset_sphinx(self):
+		""" Empty the rt index, whatever it holds. """
+		self.write_sphinx_state(None)
+		sql = SphinxQL(autocommit = True, autoretry = False)
+		sql.execute('TRUNCATE RTINDEX rt')
+		sql.close()
+
+	@staticmethod
+	def sphinx_rows(df):
+		""" (id, altnames, id) rt documents of the rows of a chunk with altnames. """
+		dg = df[df.altnames.notnull()]
+		ids = dg.id.tolist()
+		return list(zip(ids, dg.altnames.apply(sphinx_escape).tolist(), ids))
+
+	@staticmethod
+	def sphinx_batch(statement):
+		""" Run one multi-row statement over a connection of its own, returning its row count. """
+		sqltxt, args = statement
+		sql = SphinxQL(autocommit = True, autoretry = False)
+		sql.execute(sqltxt, args)
+		sql.close()
+		return len(args) // 3
+
+	def to_sphinx(self, frames):
+		"""
+		Defer the city altnames to the Sphinx rt index, from an iterator of parsed
+		chunks, as packet sized multi-row INSERTs over SPHINX_LOAD_CONNECTIONS.
+		"""
+		logger.info('Inserting city data into Sphinx...')
+		started = time.time()
+		numrecs = 0
+		pending = collections.deque()
+		with concurrent.futures.ThreadPoolExecutor(max_workers = SPHINX_LOAD_CONNECTIONS) as ex:
+			for df in frames:
+				for statement in SphinxQL.generate_insert_batches('rt', self.sphinx_rows(df)):
+					if len(pending) >= SPHINX_LOAD_CONNECTIONS:
+						numrecs += pending.popleft().result()
+					pending.append(ex.submit(self.sphinx_batch, statement))
+			numrecs += sum(f.result() for f in pending)
+		secs = time.time() - started
+		logger.info('Finished Sphinx inserts: %d documents in %.1f s (%.0f docs/s).' % (numrecs, secs, numrecs / max(secs, 1e-9)))
+		return numrecs
+
+	def sphinx_tsvpath(self):
+		""" The tsvpipe source file of the plain city index, see sphinx.conf. """
+		return os.path.join(self.dlpath(), 'sphinx', 'city.tsv')
+
+	def to_sphinx_tsv(self, frames):
+		"""
+		Write the city altnames as the plain city index's tsvpipe source. It is
+		renamed into place when complete, and searchd.sh then indexes it and
+		rotates the index in seamlessly.
+		"""
+		logger.info('Writing Sphinx tsvpipe source...')
+		path = self.sphinx_tsvpath()
+		os.makedirs(os.path.dirname(path), exist_ok = True)
+		numrecs = 0
+		with open(path + '.tmp', 'w', encoding = 'utf-8') as fout:
+			for df in frames:
+				for x in self.sphinx_rows(df):
+					fout.write('%d\t%s\t%d\n' % (x[0], re.sub(r'[\t\r\n]', ' ', x[1]), x[2]))
+					numrecs += 1
+		os.replace(path + '.tmp', path)
+		logger.info('Finished Sphinx tsvpipe source, %d documents.' % numrecs)
+		return numrecs
+
+	def mariadb_ready(self):
+		""" Wait for MariaDB to accept connections. """
+		wait_ready('MariaDB', lambda: SQL(db = 'mysql', printsql = False, autoretry = False).fetchone('SELECT 1;'))
+
+	def sphinx_ready(self):
+		""" Wait for Sphinx searchd to accept connections. """
+		wait_ready('Sphinx', lambda: SphinxQL(autoretry = False).close())
+
+	def prepare_mariadb(self):
+		""" Wait for MariaDB, then apply the DDL. """
+		self.mariadb_ready()
+		self.ddl_mariadb()
 
 	def ddl_mariadb(self):
 		""" Throw DDL at MariaDB. """
@@ -113,67 +438,332 @@ class DataLoader:
 		printsql = False
 		sql_zero = lambda: SQL(db = 'mysql', printsql = printsql, autocommit = True, autoretry = False)
 		sql_zero().execute_ddl('CREATE DATABASE IF NOT EXISTS citysearch;')
-		time.sleep(2)
 		sql_ddl = lambda: SQL(printsql = printsql, autocommit = True, autoretry = False)
-		try:
-			numrecs = int(sql_ddl().fetchone('SELECT COUNT(1) FROM citysearch.City;')[0])
-		except:
-			numrecs = 0
-		if numrecs == 0:
-			sqlsrc = ['Start.sql','City.sql','Haversine.sql','GeoDist.sql','ProximitySearch.sql']
-			for src in sqlsrc:
-				with open('./'+src,'r') as fin:
-					sqltxt = fin.read()
-				for sqltxt_part in sqltxt.split('#split#'):
-					if sqltxt_part.strip() != '':
-						sql_ddl().execute_ddl(sqltxt_part)
-			time.sleep(2)
+		# Tables are created if missing (indexes after the load, see index_mariadb), routines drop and recreate themselves:
+		for src in ['Start.sql','City.sql','Haversine.sql','GeoDist.sql','ProximitySearch.sql','ProximitySearch3.sql']:
+			self.execute_sqlfile(src)
 		logger.info('MariaDB DDL applied.')
 
-	def to_mariadb(self, df):
-		""" Load city data into MariaDB. """
-		logger.info('Inserting city data into MariaDB...')
-		sql = lambda: SQL(printsql = False, autocommit = False, autoretry = True)
+	@staticmethod
+	def execute_sqlfile(src, strict = False):
+		""" Execute the #split# separated DDL statements of a SQL file, raising on errors if strict. """
+		with open('./'+src,'r') as fin:
+			sqltxt = fin.read()
+		for sqltxt_part in sqltxt.split('#split#'):
+			if sqltxt_part.strip() != '':
+				sqlconn = SQL(printsql = False, autocommit = True, autoretry = False)
+				if strict:
+					sqlconn.execute(sqltxt_part)
+				else:
+					sqlconn.execute_ddl(sqltxt_part)
+
+	def load_state(self, deltas = ()):
+		"""
+		What the databases hold once loaded from the source file and then
+		the delta files applied (in order), recorded by each database when
+		its load completes: a different (or no) record means reloading it.
+		"""
+		return {'source': self.snapshot_fingerprint(), 'deltas': list(deltas)}
+
+	def mariadb_state(self):
+		""" The load_state City holds, None if no load completed. """
+		try:
+			rs = SQL(printsql = False, autoretry = False).fetchone('SELECT state FROM citysearch.CityLoad WHERE id = 1;')
+		except Exception:
+			return None
+		return json.loads(rs[0]) if rs else None
+
+	def write_mariadb_state(self, state):
+		""" Record the load_state City holds, or with None that it is being changed. """
+		sqlconn = SQL(printsql = False, autocommit = True, autoretry = True)
+		if state is None:
+			sqlconn.execute('DELETE FROM CityLoad;')
+		else:
+			sqlconn.execute('REPLACE INTO CityLoad (id, state) VALUES (1, %s);', (json.dumps(state, sort_keys = True),))
+		sqlconn.close()
+
+	def reset_mariadb(self):
+		""" Drop City and CityPoint, whatever they hold, and recreate City empty, in the current schema. """
+		self.write_mariadb_state(None)
+		sqlconn = SQL(printsql = False, autocommit = True, autoretry = False)
+		sqlconn.execute('DROP TABLE IF EXISTS City, CityPoint;')
+		sqlconn.close()
+		self.execute_sqlfile('City.sql', strict = True)
+
+	@staticmethod
+	def bulk_sql():
+		""" A connection for bulk loads, skipping per-row checks and the binlog. """
+		sqlconn = SQL(printsql = False, autocommit = False, autoretry = True, local_infile = True)
+		sqlconn.execute('SET unique_checks = 0, foreign_key_checks = 0, sql_log_bin = 0;')
+		return sqlconn
+
+	@staticmethod
+	def infile_lines(df):
+		""" A chunk as LOAD DATA text: tab separated, backslash escaped, \\N for nulls. """
+		def field(x):
+			if x is None:
+				return '\\N'
+			if isinstance(x, str):
+				return x.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+			return str(x)
+		return ''.join('\t'.join(map(field, row)) + '\n' for row in DataLoader.records(df))
+
+	def load_infile(self, frames):
+		""" LOAD DATA each chunk from a staging file over one connection, committing once. """
+		path = os.path.join(self.dlpath(), 'City.load.tsv')
+		sqltxt = SQL.generate_load('City', ['id'] + colnames())
+		sqlconn = self.bulk_sql()
+		numrecs = 0
 		try:
-			numrecs = int(sql().fetchone('SELECT COUNT(1) FROM citysearch.City;')[0])
-		except:
-			numrecs = 0
-		if numrecs == 0:
-			sqltxt = SQL.generate_insert('City', df.columns.tolist())
-			vals = df.to_records(index = False)
-			vals = [tuple(x) for x in vals] # < mariadb driver expectations
-			batch_size = 10000
-			sqlconn = sql()
-			for chunk in chunks(vals, batch_size):
-				sqlconn.executemany(sqltxt, chunk)
+			for df in frames:
+				with open(path, 'w', encoding = 'utf-8') as fout:
+					fout.write(self.infile_lines(df))
+				sqlconn.execute(sqltxt, (path,))
+				numrecs += len(df)
 			sqlconn.commitclose()
+		finally:
+			if os.path.isfile(path):
+				os.remove(path)
+		return numrecs
+
+	def insert_rows(self, rows):
+		""" Multi-row INSERT of row tuples over a connection of its own. """
+		sqltxt = SQL.generate_insert('City', ['id'] + colnames())
+		sqlconn = self.bulk_sql()
+		for chunk in chunks(rows, 10000): # executemany sends multi-row INSERTs.
+			sqlconn.executemany(sqltxt, chunk)
+		sqlconn.commitclose()
+		return len(rows)
+
+	def load_insert(self, frames):
+		""" Split each chunk into LOAD_CONNECTIONS id ranges and INSERT them in parallel. """
+		numrecs = 0
+		with concurrent.futures.ThreadPoolExecutor(max_workers = LOAD_CONNECTIONS) as ex:
+			for df in frames:
+				rows = self.records(df)
+				size = -(-len(rows) // LOAD_CONNECTIONS)
+				numrecs += sum(ex.map(self.insert_rows, list(chunks(rows, size))))
+		return numrecs
+
+	@staticmethod
+	def citypoint_sql(verb = 'INSERT', where = ''):
+		""" verb CityPoint rows from the City rows matching where, their coordinates as POINT(longitude, latitude). """
+		return verb + ' INTO CityPoint (id, country_code, location) SELECT id, country_code, POINT(longitude, latitude) FROM City' + where + ';'
+
+	def index_mariadb(self):
+		""" Build the City secondary indexes and CityPoint (CityIndexes.sql), those missing, raising on errors, e.g. a duplicate geonameid. """
+		self.execute_sqlfile('CityIndexes.sql', strict = True)
+		sqlconn = SQL(printsql = False, autocommit = True, autoretry = False)
+		if int(sqlconn.fetchone('SELECT COUNT(1) FROM CityPoint;')[0]) == 0:
+			sqlconn.execute(self.citypoint_sql())
+		sqlconn.close()
+
+	def to_mariadb(self, frames):
+		"""
+		Bulk load city data into MariaDB from an iterator of parsed chunks,
+		by BULK_LOAD mode, then build the secondary indexes. Returns load stats.
+		"""
+		logger.info('Loading city data into MariaDB (%s)...' % BULK_LOAD)
+		started = time.time()
+		if BULK_LOAD == 'insert':
+			numrecs = self.load_insert(frames)
 		else:
+			numrecs = self.load_infile(frames)
+		loaded = time.time()
+		self.index_mariadb()
+		stats = {
+			'mode': BULK_LOAD, 'rows': numrecs, 'load_seconds': loaded - started,
+			'index_seconds': time.time() - loaded, 'rows_per_second': numrecs / max(loaded - started, 1e-9)}
+		logger.info('Finished MariaDB load: %(rows)d rows in %(load_seconds).1f s (%(rows_per_second).0f rows/s, %(mode)s), indexes in %(index_seconds).1f s.' % stats)
+		return stats
+
+	def load_mariadb(self, frames, ready, state):
+		"""
+		to_mariadb once the future ready of MariaDB's DDL is done, unless City
+		holds the load_state state. Anything else, an interrupted load, another
+		source file or dataset, is dropped and reloaded, and state recorded.
+		"""
+		ready.result()
+		if self.mariadb_state() == state:
 			logger.info('MariaDB data exists, skipping.')
-		logger.info('Finished MariaDB inserts.')
+			return None
+		self.reset_mariadb()
+		stats = self.to_mariadb(frames)
+		self.write_mariadb_state(state)
+		return stats
+
+	def load_sphinx(self, frames, ready, state):
+		"""
+		to_sphinx (or to_sphinx_tsv) once the future ready of searchd is done,
+		unless Sphinx holds the load_state state in this SPHINX_LOAD mode. Else
+		rt is emptied (tsvpipe leaves it to delta updates), loaded and the
+		state recorded, so a partial load is redone on the next start.
+		"""
+		ready.result()
+		if self.sphinx_state() == state:
+			logger.info('Sphinx data exists, skipping.')
+			return None
+		self.reset_sphinx()
+		if SPHINX_LOAD == 'tsvpipe':
+			numrecs = self.to_sphinx_tsv(frames)
+		else:
+			numrecs = self.to_sphinx(frames)
+		self.write_sphinx_state(state)
+		return numrecs
 
-	def persist(self):
+	def persist(self, mariadb, sphinx):
+		"""
+		Stream the source file through one parse pass into the city store
+		encoder and the MariaDB and Sphinx loaders, a chunk at a time, so the
+		parse holds a few chunks whatever the file size. mariadb and sphinx
+		are futures of the databases' readiness, each loader waits for its
+		own (holding up the parse at most a couple of chunks in). Returns the
+		CityStore.
+		"""
 		logger.info('City data persistence started.')
-		self.ddl_mariadb()
-		df_mdb = self.to_dataframe()
-		df_spx = df_mdb[['id','altnames']].copy()
-		df_mdb.altnames = df_mdb.altnames.str[:200]
-		with concurrent.futures.ThreadPoolExecutor(max_workers = 2) as ex:
-			ex.submit(self.to_mariadb, df_mdb)
-			ex.submit(self.to_sphinx, df_spx)
-		logger.info('City data persistence finished.')
-		return df_mdb
-
-
-def bootstrap():
-	""" Bootstrap the citysearch app. """
+		state = self.load_state()
+		consumers = [
+			lambda frames: CityStore.from_chunks(frames, col_types),
+			lambda frames: self.load_mariadb(frames, mariadb, state),
+			lambda frames: self.load_sphinx(frames, sphinx, state)]
+		store = fanout(self.to_chunks(), consumers)[0]
+		logger.info('City data persistence finished, %d cities.' % len(store))
+		return store
+
+	def deltapath(self):
+		""" Directory of the daily GeoNames modifications-*.txt and deletes-*.txt files. """
+		return os.getenv('CITYSEARCH_DELTA_DIR', os.path.join(self.dlpath(), 'deltas'))
+
+	def dump_date(self):
+		"""
+		The day (YYYY-MM-DD, UTC) of the downloaded dump's Last-Modified, whose
+		changes up to then it holds, or None if no download recorded one.
+		"""
+		modified = email.utils.parsedate_tz(read_state(self.archive() + '.json').get('last_modified') or '')
+		if modified is None:
+			return None
+		return time.strftime('%Y-%m-%d', time.gmtime(email.utils.mktime_tz(modified)))
+
+	def delta_files(self, applied = (), path = None, after = None):
+		"""
+		Delta files in path not applied yet, as (name, kind) in date order,
+		a day's modifications before its deletes. Files dated on or before
+		after (a dump_date) are older than the dump, and left out.
+		"""
+		path = path or self.deltapath()
+		if not os.path.isdir(path):
+			return []
+		pending = []
+		for name in os.listdir(path):
+			m = DELTA_FILE.match(name)
+			if m and name not in applied and (after is None or m.group(2) > after):
+				pending.append((m.group(2), m.group(1) == 'deletes', name, m.group(1)))
+		return [(name, kind) for date, second, name, kind in sorted(pending)]
+
+	def read_deletes(self, path):
+		""" geonameids of a deletes file (geonameid, name and comment columns). """
+		with open(path, encoding = 'utf-8') as fin:
+			return [int(line.split('\t', 1)[0]) for line in fin if line.strip()]
+
+	def read_deltas(self, pending, path):
+		"""
+		The net effect of the pending (name, kind) delta files in path, in order:
+		(rows, deletes), the latest row of every changed city still in the
+		dataset, and the geonameids to delete, those out of it included.
+		"""
+		upserts = collections.OrderedDict() # geonameid -> row, the latest wins.
+		deletes = set()
+		for name, kind in pending:
+			if kind == 'deletes':
+				for gid in self.read_deletes(os.path.join(path, name)):
+					upserts.pop(gid, None)
+					deletes.add(gid)
+			else:
+				df = self.read_geonames(os.path.join(path, name))
+				df = df.assign(qualifies = self.qualifies(df))
+				for row in df.to_dict('records'):
+					upserts[int(row['geonameid'])] = row
+					deletes.discard(int(row['geonameid']))
+		rows = []
+		for gid, row in upserts.items():
+			if row.pop('qualifies'):
+				rows.append(row)
+			else:
+				deletes.add(gid) # Out of the dataset now, e.g. below its population floor.
+		return rows, deletes
+
+	def min_population(self):
+		""" Population floor of the citiesN source file, None for dumps of every feature. """
+		m = re.match(r'cities(\d+)', os.path.basename(self.srcfile()))
+		return int(m.group(1)) if m else None
+
+	def qualifies(self, df):
+		""" Mask of the rows of a GeoNames frame that belong in the source file's dataset. """
+		minpop = self.min_population()
+		if minpop is None:
+			return np.ones(len(df), dtype = 'bool')
+		populated = pd.to_numeric(df.population).fillna(0).values >= minpop
+		seats = df.feat_code.isin(SEAT_CODES).values # Seats of admin divisions go in at any size.
+		return (df.feat_class == 'P').values & (populated | seats)
+
+	def upsert_mariadb(self, df):
+		""" Insert or update City rows, on their id or geonameid, and their CityPoint rows. """
+		if len(df) == 0:
+			return
+		cols = df.columns.tolist()
+		sqltxt = SQL.generate_insert('City', cols, [col for col in cols if col != 'id'])
+		vals = self.records(df)
+		sqlconn = SQL(printsql = False, autocommit = False, autoretry = True)
+		for chunk in chunks(vals, 10000):
+			sqlconn.executemany(sqltxt, chunk)
+		sqlconn.commitclose()
+		sqlconn = SQL(printsql = False, autocommit = True, autoretry = True)
+		for chunk in chunks(df.id.tolist(), 10000):
+			sqlconn.execute(self.citypoint_sql('REPLACE', ' WHERE id IN (' + ','.join(['%s'] * len(chunk)) + ')'), tuple(chunk))
+		sqlconn.close()
+
+	def delete_mariadb(self, city_ids):
+		""" Delete City rows, and their CityPoint rows, by id. """
+		if not city_ids:
+			return
+		sqlconn = SQL(printsql = False, autocommit = False, autoretry = True)
+		for chunk in chunks(list(city_ids), 10000):
+			for table in ['City', 'CityPoint']:
+				sqlconn.execute('DELETE FROM ' + table + ' WHERE id IN (' + ','.join(['%s'] * len(chunk)) + ');', tuple(chunk))
+		sqlconn.commitclose()
+
+	def upsert_sphinx(self, df, deleted = ()):
+		"""
+		Replace the rt documents of rows with altnames, and delete those of
+		rows without them and of the deleted city ids.
+		"""
+		sql = SphinxQL()
+		for sqltxt, args in SphinxQL.generate_insert_batches('rt', self.sphinx_rows(df), 'REPLACE'):
+			sql.execute(sqltxt, args)
+		gone = df[df.altnames.isnull()].id.tolist() + list(deleted)
+		for chunk in chunks(gone, 1000):
+			sql.execute('DELETE FROM rt WHERE id IN (' + ','.join(['%s'] * len(chunk)) + ')', tuple(chunk))
+		sql.commitclose()
+
+
+def bootstrap(timer = None):
+	"""
+	Bootstrap the citysearch app: the download, MariaDB's readiness probe
+	and DDL, and Sphinx's readiness probe run concurrently, and the
+	streaming load starts as soon as the download is done.
+	"""
 	logger.info('Bootstrapping CitySearch...')
+	timer = timer or StartupTimer()
 	dl = DataLoader()
-	dl.download()
-	logger.info('Waiting a second for databases...')
-	time.sleep(8)
-	webcache = dl.persist()
+	with concurrent.futures.ThreadPoolExecutor(max_workers = 3) as ex:
+		download = ex.submit(timer.timed, 'download', dl.download)
+		mariadb = ex.submit(timer.timed, 'mariadb_ready', dl.prepare_mariadb)
+		sphinx = ex.submit(timer.timed, 'sphinx_ready', dl.sphinx_ready)
+		download.result()
+		with timer.phase('persist'):
+			store = dl.persist(mariadb, sphinx)
 	logger.info('Bootstrapping is complete.')
-	return webcache
+	return store
 
 
 
@@ -181,83 +771,350 @@ def bootstrap():
 
 class CityAPI:
 	
-	def __init__(self):
-		""" Load data into databases and cache."""
-		time.sleep(4) # Wait a sec for databases...
-		df = bootstrap()
+	def __init__(self, build = True):
+		"""
+		Load data into databases and cache.
+		The cache always runs from the memory-mapped snapshot: warm starts
+		map the existing one, cold starts bootstrap, write it, then map it.
+		With build False a missing snapshot leaves the API not ready, see reload.
+		"""
+		self.version = 0 # Dataset version, bumped on every (re)load.
+		self.source = None # Fingerprint of the source file the snapshot was built from.
+		self.generation = 0 # Snapshot generation, bumped by every delta update.
+		self.deltas = [] # Delta files applied to the snapshot.
+		self.store = None # Until the dataset is loaded.
+		self.cache = ResultCache() # Query results for the current version.
+		self.sqlpool = None # Per worker, see open_pools.
+		self.spxpool = None
+		self.reload(build)
+
+
+	@property
+	def ready(self):
+		""" Whether the dataset is loaded. """
+		return self.store is not None
+
+
+	@classmethod
+	def build_snapshot(cls, timer = None):
+		"""
+		Cold start: bootstrap the databases and write the city snapshot, with
+		the delta files in the delta directory newer than the dump applied
+		again, as the dump (and the databases, if they were reloaded) holds
+		none of them.
+		"""
+		timer = timer or StartupTimer()
+		dl = DataLoader()
+		store = bootstrap(timer) # Encoded and indexed as the dump streams into the databases.
 		logger.info('Generating cache indexes...')
-		self.df = df
-		self.df_geonameid = df.set_index('geonameid')[['id']]
-		self.df_name = df.set_index('name')[['id','country_code']]
-		geoslice = df[['id','longitude','latitude']]
-		rgeo = rtree.Rtree()
-		for i in range(1, len(geoslice)):
-			rgeo.insert(i, tuple(geoslice.iloc[i][1:].tolist()))
-		self.rgeo = rgeo # geographic index
-		self.df_coords = geoslice.set_index('id')
-		#self.df = None # Drop unused bulk.
-		logger.info('Cache index generation complete.')
+		with timer.phase('geo_index'):
+			indexes = cls.geo_indexes(store)
+		meta = {'generation': 0, 'deltas': []}
+		pending = dl.delta_files(after = dl.dump_date())
+		if pending:
+			with timer.phase('deltas'):
+				store, indexes, summary = cls.update(dl, store, indexes['geo_cc'], pending, dl.deltapath())
+			meta['deltas'] = [name for name, kind in pending]
+			logger.info('Delta files applied again: %s' % summary)
+		with timer.phase('snapshot_write'):
+			dl.write_snapshot(store, indexes, meta)
+		dl.write_states(dl.load_state(meta['deltas']))
+		return timer
+
+
+	def reload(self, build = True):
+		"""
+		(Re)load the dataset and invalidate cached results, building it first
+		when there is no snapshot, or with build False returning False then.
+		"""
+		timer = StartupTimer()
+		dl = DataLoader()
+		with timer.phase('snapshot_read'):
+			snap = dl.read_snapshot()
+		if snap is None:
+			if not build:
+				return False
+			self.build_snapshot(timer)
+			with timer.phase('snapshot_read'):
+				snap = dl.read_snapshot()
+			if snap is None: # The source file changed while it was built, e.g. by the download command.
+				raise RuntimeError('No current snapshot of %s after building one.' % dl.srcfile())
+		store, indexes, meta = snap
+		self.source = dl.snapshot_fingerprint()
+		self.store = store # columnar city rows and lookup indexes
+		self.geo = indexes['geo']['all'] # great-circle index
+		self.geo_cc = indexes['geo_cc'] # per-country great-circle indexes
+		self.generation = meta.get('generation', 0)
+		self.deltas = meta.get('deltas', [])
+		self.version += 1
+		self.cache.invalidate(self.version)
+		self.startup = timer
+		logger.info('Cache index generation complete, dataset version %d.' % self.version)
+		logger.info('Startup timing report:\n' + timer.report())
+		return True
+
+
+	@classmethod
+	def geo_indexes(cls, store, geo_cc = None, countries = None):
+		"""
+		The global and per-country geo indexes of the live rows, for the snapshot.
+		Given the current geo_cc, only the countries listed are rebuilt.
+		"""
+		live = store.live()
+		live = live.astype(position_dtype(len(store)))
+		geo = GeoIndex(store['latitude'][live], store['longitude'][live], ids = live, leafsize = GEO_LEAFSIZE)
+		if geo_cc is None:
+			return {'geo': {'all': geo}, 'geo_cc': cls.country_indexes(store)}
+		geo_cc = {ccode: idx for ccode, idx in geo_cc.items() if ccode not in countries}
+		geo_cc.update(cls.country_indexes(store, countries))
+		return {'geo': {'all': geo}, 'geo_cc': geo_cc}
+
+
+	@staticmethod
+	def country_indexes(store, countries = None):
+		""" Partition the geo index by country (or only the listed ones), keeping global row positions as ids. """
+		lat = store['latitude']
+		lon = store['longitude']
+		groups = collections.defaultdict(list)
+		for pos, ccode in enumerate(store['country_code'].tolist()):
+			if ccode is not None and not store.dead[pos] and (countries is None or ccode in countries):
+				groups[ccode].append(pos)
+		geo_cc = {}
+		for ccode, rows in groups.items():
+			rows = np.array(rows, dtype = position_dtype(len(store)))
+			geo_cc[ccode] = GeoIndex(lat[rows], lon[rows], ids = rows, leafsize = GEO_LEAFSIZE)
+		return geo_cc
+
+
+	@staticmethod
+	def delta_changes(store, rows, deletes):
+		"""
+		Where the rows and deletes of read_deltas go in the store: (df,
+		positions, dead), df the rows with their id (positions + 1), new
+		cities taking the next ids, in position order, and dead the sorted
+		positions of the deleted cities.
+		"""
+		gids = store.index['geonameid']
+		positions = gids.first_many([row['geonameid'] for row in rows])
+		size = len(store)
+		for i, pos in enumerate(positions):
+			if pos is None: # New cities get the next ids.
+				positions[i], size = size, size + 1
+		dead = sorted(pos for pos in gids.first_many(sorted(deletes)) if pos is not None)
+		df = pd.DataFrame(rows, columns = colnames())
+		df = df.astype(object).where(pd.notnull(df), None)
+		df.latitude = df.latitude.astype('float32')
+		df.longitude = df.longitude.astype('float32')
+		df.insert(0, 'id', [pos + 1 for pos in positions])
+		df = df.iloc[np.argsort(positions, kind = 'mergesort')]
+		return df, sorted(positions), dead
+
+
+	@classmethod
+	def patch_store(cls, store, geo_cc, df, positions, dead):
+		"""
+		Patch the store and its indexes at the delta_changes rows only, and
+		rebuild the geo indexes of the countries touched. Returns (store, indexes).
+		"""
+		values = {}
+		for col in df.columns:
+			if col in col_types:
+				values[col] = pd.to_numeric(df[col]).values.astype(col_types[col])
+			else:
+				values[col] = df[col].tolist()
+		countries = set(df.country_code.dropna().tolist())
+		countries |= set(store['country_code'][pos] for pos in positions + dead if pos < len(store))
+		patched = store.patch(positions, values, dead)
+		return patched, cls.geo_indexes(patched, geo_cc, countries - set([None]))
+
+
+	@classmethod
+	def update(cls, dl, store, geo_cc, pending, path):
+		"""
+		Apply the pending delta files in path to MariaDB, Sphinx and a copy of
+		the store, whose load states are cleared first (a failure part way
+		leaves them to be reloaded) and left for the caller to write once the
+		snapshot is. Returns (store, indexes, summary).
+		"""
+		rows, deletes = dl.read_deltas(pending, path)
+		df, positions, dead = cls.delta_changes(store, rows, deletes)
+		dead_ids = [pos + 1 for pos in dead]
+		dl.write_states(None)
+		dl.upsert_mariadb(df)
+		dl.delete_mariadb(dead_ids)
+		dl.upsert_sphinx(df, dead_ids)
+		patched, indexes = cls.patch_store(store, geo_cc, df, positions, dead)
+		inserted = len(patched) - len(store)
+		summary = {
+			'applied': [name for name, kind in pending],
+			'updated': len(positions) - inserted, 'inserted': inserted, 'deleted': len(dead)}
+		return patched, indexes, summary
+
+
+	def apply_deltas(self, path = None):
+		"""
+		Apply the pending GeoNames delta files in path (the delta directory by
+		default) without re-reading the dump: upsert and delete the changed
+		cities in MariaDB and Sphinx, patch the store and its indexes at the
+		changed rows, rebuild the geo indexes of the touched countries, write
+		the next snapshot generation and reload it. Workers pick it up from
+		the snapshot, see snapshot_changed. Cold starts apply the files in the
+		delta directory again, see build_snapshot. Returns a summary.
+		"""
+		started = time.time()
+		dl = DataLoader()
+		path = path or dl.deltapath()
+		pending = dl.delta_files(self.deltas, path, dl.dump_date())
+		if not pending:
+			return {'applied': [], 'generation': self.generation}
+		logger.info('Applying %d delta files...' % len(pending))
+		store, indexes, summary = self.update(dl, self.store, self.geo_cc, pending, path)
+		meta = {'generation': self.generation + 1, 'deltas': self.deltas + summary['applied']}
+		dl.write_snapshot(store, indexes, meta)
+		dl.write_states(dl.load_state(meta['deltas']))
+		self.reload()
+		summary.update({'generation': self.generation, 'seconds': time.time() - started})
+		logger.info('Delta update complete: %s' % summary)
+		return summary
+
+
+	def snapshot_changed(self):
+		"""
+		Whether another snapshot was written, e.g. by apply_deltas (a newer
+		generation) or the download command (another source file) in another process.
+		"""
+		manifest = snapshot.read_manifest(DataLoader().dlpath())
+		if manifest is None:
+			return False
+		return manifest.get('fingerprint') != self.source or manifest.get('meta', {}).get('generation', 0) != self.generation
+
+
+	def geo_index(self, country_code = None):
+		""" Route a query to the global or the per-country geo index. """
+		if country_code is None:
+			return self.geo
+		return self.geo_cc.get(country_code)
 
 
 	def city_coords(self, city_id):
-		""" Get city coordinates from city_id."""
-		return self.df_coords.loc[city_id].tolist()
+		""" Get city [longitude, latitude] from city_id."""
+		pos = self.store.position(city_id)
+		return [float(self.store['longitude'][pos]), float(self.store['latitude'][pos])]
+
+
+	def keyval_index(self, akey, country_code = None):
+		"""
+		The in-memory index answering a lookup, returns (index, composite),
+		composite when it is the (country_code, akey) index, else a country
+		qualified lookup filters the akey matches, see CityStore.first_in_country.
+		(None, False) when unindexed.
+		"""
+		if akey not in self.store.index:
+			return None, False
+		if country_code and akey in self.store.composite:
+			return self.store.composite[akey], True
+		return self.store.index[akey], False
+
+
+	def keyval_memory(self, akey, avalue, country_code = None):
+		"""
+		In-memory city lookup, returns (indexed, city_id).
+		Non-unique values resolve to the most populous match, then the lowest id.
+		"""
+		if country_code and len(country_code) != 2:
+			country_code = None
+		idx, composite = self.keyval_index(akey, country_code)
+		if idx is None:
+			return False, None
+		try:
+			avalue = idx.coerce((country_code, avalue) if composite else avalue)
+		except (TypeError, ValueError):
+			return True, None
+		if country_code and not composite:
+			pos = self.store.first_in_country(idx.positions(avalue), country_code)
+		else:
+			pos = idx.first(avalue)
+		if pos is None:
+			return True, None
+		return True, int(self.store['id'][pos])
+
+
+	def keyval_memory_many(self, lookups):
+		"""
+		keyval_memory for a list of (akey, avalue, country_code),
+		with one bulk index probe per index, composite ones included.
+		"""
+		out = [None] * len(lookups)
+		groups = collections.defaultdict(list)
+		for i, (akey, avalue, country_code) in enumerate(lookups):
+			if country_code and len(country_code) != 2:
+				country_code = None
+			idx, composite = self.keyval_index(akey, country_code)
+			if idx is None or (country_code and not composite):
+				out[i] = self.keyval_memory(akey, avalue, country_code)
+				continue
+			try:
+				avalue = idx.coerce((country_code, avalue) if composite else avalue)
+			except (TypeError, ValueError):
+				out[i] = (True, None)
+				continue
+			groups[id(idx)].append((i, idx, avalue))
+		ids = self.store['id']
+		for group in groups.values():
+			positions = group[0][1].first_many([avalue for i, idx, avalue in group])
+			for (i, idx, avalue), pos in zip(group, positions):
+				out[i] = (True, None if pos is None else int(ids[pos]))
+		return out
+
+
+	def keyval_search_many(self, lookups):
+		"""
+		keyval_search for a list of (akey, avalue, country_code) lookups,
+		returning city ids (or None) in order.
+		"""
+		valid = [lookup if lookup[0] in colset() else (None, None, None) for lookup in lookups]
+		return [city_id for indexed, city_id in self.keyval_memory_many(valid)]
+
+
+	async def keyval_search_many_async(self, lookups):
+		""" keyval_search_many for async callers, it never waits on a database. """
+		return self.keyval_search_many(lookups)
+
+
+	@staticmethod
+	def select_list(fields):
+		"""
+		SQL select list of City c for a field projection, None for all columns.
+		Only known columns pass, and at least id is selected.
+		"""
+		if fields is None:
+			return None
+		cols = [col for col in ['id'] + colnames() if col in fields]
+		return ','.join('c.' + col for col in cols or ['id'])
+
+
+	@staticmethod
+	def project(rows, fields):
+		""" Project row dicts onto fields, a no-op without a projection. """
+		if fields is None:
+			return rows
+		return [{key: val for key, val in row.items() if key in fields} for row in rows]
 
 
 	def keyval_search(self, akey, avalue, country_code = None):
-		""" Base city lookup. """
+		""" Base city lookup, every column in colset is indexed in memory. """
 		if akey not in colset():
-			return None # No SQL injection here.
-		if akey == 'geonameid':
-			try:
-				ids = self.df_geonameid.loc[avalue].id
-			except:
-				return None
-			try:
-				return int(ids)
-			except:
-				pass
-			if len(ids) < 1:
-				return None
-			return int(ids.iloc[0])
-		if akey == 'name' and country_code and len(country_code) == 2:
-			try:
-				ids = self.df_name[self.df_name.country_code == country_code].loc[avalue].id
-			except:
-				return None
-			try:
-				return int(ids)
-			except:
-				pass
-			if len(ids) < 1:
-				return None
-			return int(ids.iloc[0])
-		elif akey == 'name':
-			try:
-				ids = self.df_name.loc[avalue].id
-			except:
-				return None
-			try:
-				return int(ids)
-			except:
-				pass
-			if len(ids) < 1:
-				return None
-			return int(ids.iloc[0])
-		try:
-			sql = SQL.singleton(random.randint(0,16))
-			if country_code:
-				sqltxt = 'SELECT id FROM City WHERE '+akey+' = %s and country_code = %s;'
-				city_id = int(sql.fetchone(sqltxt, (avalue, country_code))[0])
-			else:
-				sqltxt = 'SELECT id FROM City WHERE '+akey+' = %s;'
-				city_id = int(sql.fetchone(sqltxt, avalue)[0])
-		except:
-			city_id = None
-		return city_id
+			return None
+		return self.keyval_memory(akey, avalue, country_code)[1]
 
 
-	def proximity_search(self, akey, avalue, k, country_code = None):
+	async def keyval_search_async(self, akey, avalue, country_code = None):
+		""" keyval_search for async callers, it never waits on a database. """
+		return self.keyval_search(akey, avalue, country_code)
+
+
+	@cached('proximity_search', k = int, fields = tuple)
+	def proximity_search(self, akey, avalue, k, country_code = None, fields = None):
 		""" MariaDB based proximity search. """
 		if akey not in colset():
 			return {}
@@ -269,13 +1126,63 @@ class CityAPI:
 			return {}
 		sqltxt = 'proximity_search'
 		sql = SQL.singleton(random.randint(0,16))
-		params = (city_id, k, country_code)
+		params = (city_id, k, country_code, self.select_list(fields))
 		rs = sql.fetchproc(sqltxt, params, jsonify = True)
-		return rs[:-1][0]
+		return self.project(rs[:-1][0], fields)
+
+
+	@cached('proximity_search', k = int, fields = tuple)
+	async def proximity_search_async(self, akey, avalue, k, country_code = None, fields = None):
+		""" MariaDB based proximity search over the async pool. """
+		if akey not in colset():
+			return {}
+		if country_code and len(country_code) != 2:
+			return {}
+		k = int(k)
+		city_id = await self.keyval_search_async(akey, avalue, country_code)
+		if city_id is None:
+			return {}
+		params = (city_id, k, country_code, self.select_list(fields))
+		rs = await self.sqlpool.fetchproc('proximity_search', params, jsonify = True)
+		return self.project(rs[:-1][0], fields)
+
+
+	@cached('proximity_search3', k = int, fields = tuple)
+	def proximity_search3(self, akey, avalue, k, country_code = None, fields = None):
+		""" MariaDB proximity search over the CityPoint SPATIAL index. """
+		if akey not in colset():
+			return {}
+		if country_code and len(country_code) != 2:
+			return {}
+		k = int(k)
+		city_id = self.keyval_search(akey, avalue, country_code)
+		if city_id is None:
+			return {}
+		sql = SQL.singleton(random.randint(0,16))
+		params = (city_id, k, country_code, self.select_list(fields))
+		rs = sql.fetchproc('proximity_search3', params, jsonify = True)
+		return self.project(rs[:-1][0], fields)
+
+
+	@cached('proximity_search3', k = int, fields = tuple)
+	async def proximity_search3_async(self, akey, avalue, k, country_code = None, fields = None):
+		""" MariaDB proximity search over the CityPoint SPATIAL index, over the async pool. """
+		if akey not in colset():
+			return {}
+		if country_code and len(country_code) != 2:
+			return {}
+		k = int(k)
+		city_id = await self.keyval_search_async(akey, avalue, country_code)
+		if city_id is None:
+			return {}
+		params = (city_id, k, country_code, self.select_list(fields))
+		rs = await self.sqlpool.fetchproc('proximity_search3', params, jsonify = True)
+		return self.project(rs[:-1][0], fields)
 
 
-	def proximity_search2(self, akey, avalue, k, country_code = None):
-		""" RTree+MariaDB based proximity search. """
+	@cached('proximity_search2', k = int, fields = tuple)
+	def proximity_search2(self, akey, avalue, k, country_code = None, fields = None):
+		""" In-memory great-circle kNN proximity search, a JSON body of pre-encoded rows. """
 		if akey not in colset():
 			return {}
 		if country_code and len(country_code) != 2:
@@ -284,19 +1191,328 @@ class CityAPI:
 		city_id = self.keyval_search(akey, avalue, country_code)
 		if city_id is None:
 			return {}
-		coords = self.city_coords(city_id)
-		rs = self.df.loc[self.rgeo.nearest(coords, k)].to_json(orient = 'records')
+		geo = self.geo_index(country_code)
+		if geo is None:
+			return {}
+		lon, lat = self.city_coords(city_id)
+		rows, dists = geo.nearest(lat, lon, k)
+		rs = self.store.to_json(rows, {'distance_km': dists}, fields)
 		return rs
 
 
-	def text_search(self, atext):
+	@staticmethod
+	def batch_item(item):
+		"""
+		Parse a batch proximity item, {akey: avalue} or {'lat': .., 'lon': ..}
+		plus optional k and ccode, into (lookup, coords, k, ccode) or None.
+		"""
+		if not isinstance(item, dict):
+			return None
+		try:
+			k = int(item.get('k', 10))
+		except (TypeError, ValueError):
+			return None
+		ccode = item.get('ccode')
+		if ccode is not None and (not isinstance(ccode, str) or len(ccode) != 2):
+			return None
+		if 'lat' in item and 'lon' in item:
+			try:
+				lat, lon = float(item['lat']), float(item['lon'])
+			except (TypeError, ValueError):
+				return None
+			if not (-90 <= lat <= 90 and -180 <= lon <= 180): # Also false for NaN.
+				return None
+			return None, (lat, lon), k, ccode
+		keys = [x for x in item if x not in ('k', 'ccode')]
+		if len(keys) != 1:
+			return None
+		return (keys[0], item[keys[0]], ccode), None, k, ccode
+
+
+	@staticmethod
+	def lookup_item(item):
+		""" Parse a lookup item, {akey: avalue} plus optional ccode, into (akey, avalue, ccode) or None. """
+		if not isinstance(item, dict):
+			return None
+		ccode = item.get('ccode')
+		if ccode is not None and (not isinstance(ccode, str) or len(ccode) != 2):
+			return None
+		keys = [x for x in item if x != 'ccode']
+		if len(keys) != 1 or keys[0] not in colset():
+			return None
+		return keys[0], item[keys[0]], ccode
+
+
+	def lookup_batch(self, items, fields = None):
+		"""
+		Resolve many lookup items to their cities in one bulk probe per index,
+		a JSON array body of the city rows in input order, null when an item
+		is invalid or not found.
+		"""
+		parsed = [self.lookup_item(item) for item in items]
+		city_ids = self.keyval_search_many([x or (None, None, None) for x in parsed])
+		found = [i for i, city_id in enumerate(city_ids) if city_id is not None]
+		rows = self.store.json.row_bytes([self.store.position(city_ids[i]) for i in found], None, fields)
+		bodies = [b'null'] * len(items)
+		for i, row in zip(found, rows):
+			bodies[i] = row
+		return b'[' + b','.join(bodies) + b']'
+
+
+	async def proximity_search_batch(self, items, fields = None):
+		"""
+		proximity_search2 for many origins, yielding one JSON body per item
+		in input order ({} for items that are invalid or not found). Each
+		chunk resolves its keys in bulk and runs one nearest_many per index.
+		"""
+		for chunk in chunks(items, BATCH_CHUNK):
+			parsed = [self.batch_item(item) for item in chunk]
+			keyed = [i for i, x in enumerate(parsed) if x is not None and x[0] is not None]
+			city_ids = await self.keyval_search_many_async([parsed[i][0] for i in keyed])
+			coords = [None if x is None else x[1] for x in parsed]
+			for i, city_id in zip(keyed, city_ids):
+				if city_id is not None:
+					lon, lat = self.city_coords(city_id)
+					coords[i] = (lat, lon)
+			groups = collections.defaultdict(list)
+			for i, x in enumerate(parsed):
+				if coords[i] is not None:
+					groups[x[3]].append(i)
+			bodies = [b'{}'] * len(chunk)
+			for ccode, group in groups.items():
+				geo = self.geo_index(ccode)
+				if geo is None:
+					continue
+				lat = [coords[i][0] for i in group]
+				lon = [coords[i][1] for i in group]
+				ks = [parsed[i][2] for i in group]
+				for i, (rows, dists) in zip(group, geo.nearest_many(lat, lon, ks)):
+					bodies[i] = self.store.to_json(rows, {'distance_km': dists}, fields)
+			for body in bodies:
+				yield body
+
+
+	@staticmethod
+	def encode_rows(rows):
+		""" Per row JSON bytes of row dicts from MariaDB. """
+		return [json.dumps(row).encode('utf-8') for row in rows]
+
+
+	async def proximity_search_stream(self, akey, avalue, k, country_code = None, fields = None, proc = 'proximity_search'):
+		""" proximity_search (or proc, e.g. proximity_search3) as an async iterator of encoded row chunks, streamed from the cursor. """
+		if akey not in colset():
+			return
+		if country_code and len(country_code) != 2:
+			return
+		k = int(k)
+		city_id = await self.keyval_search_async(akey, avalue, country_code)
+		if city_id is None:
+			return
+		params = (city_id, k, country_code, self.select_list(fields))
+		async for rows in self.sqlpool.iterproc(proc, params, STREAM_CHUNK, jsonify = True):
+			yield self.encode_rows(self.project(rows, fields))
+
+
+	async def proximity_search2_stream(self, akey, avalue, k, country_code = None, fields = None):
+		"""
+		proximity_search2 as an async iterator of encoded row chunks:
+		the kNN ids come from the index at once, the rows are encoded
+		a chunk at a time as they are written.
+		"""
+		if akey not in colset():
+			return
+		if country_code and len(country_code) != 2:
+			return
+		k = int(k)
+		city_id = await self.keyval_search_async(akey, avalue, country_code)
+		if city_id is None:
+			return
+		geo = self.geo_index(country_code)
+		if geo is None:
+			return
+		lon, lat = self.city_coords(city_id)
+		rows, dists = geo.nearest(lat, lon, k)
+		for i in range(0, len(rows), STREAM_CHUNK):
+			yield self.store.json.row_bytes(rows[i:i + STREAM_CHUNK], {'distance_km': dists[i:i + STREAM_CHUNK]}, fields)
+			await asyncio.sleep(0) # Let other requests run between chunks.
+
+
+	async def text_search_stream(self, atext, limit = 20, fields = None):
+		"""
+		text_search as an async iterator of encoded row chunks, for up to
+		limit hits: Sphinx ids are read from an unbuffered cursor and each
+		chunk is hydrated as it arrives.
+		"""
+		limit = max(1, min(int(limit), TEXT_LIMIT_MAX))
+		sqltxt = 'SELECT id FROM ' + SPHINX_INDEX + ' WHERE MATCH(%s) LIMIT %s OPTION max_matches = %s'
+		async for rs in self.spxpool.iterall(sqltxt, (sphinx_escape(atext), limit, max(limit, 1000)), STREAM_CHUNK):
+			city_ids = [int(x[0]) for x in rs]
+			if HYDRATE_MEMORY:
+				positions = [self.store.position(x) for x in city_ids]
+				yield self.store.json.row_bytes([x for x in positions if 0 <= x < len(self.store) and not self.store.dead[x]], fields = fields)
+			else:
+				rows = []
+				for sqltxt_ids, params in self.hydrate_sql(city_ids, fields):
+					rows += await self.sqlpool.fetchall(sqltxt_ids, params, jsonify = True)
+				yield self.encode_rows(self.hydrate_order(city_ids, rows, fields))
+
+
+	def hydrate_memory(self, city_ids, fields = None):
+		""" JSON body of the pre-encoded rows for city ids, in the given order. """
+		positions = [self.store.position(x) for x in city_ids]
+		return self.store.to_json([x for x in positions if 0 <= x < len(self.store) and not self.store.dead[x]], fields = fields)
+
+
+	@classmethod
+	def hydrate_sql(cls, city_ids, fields = None):
+		""" Bounded IN-list statements fetching city ids (and fields) from MariaDB. """
+		cols = 'c.*' if fields is None else cls.select_list(set(fields) | {'id'}) # id puts rows back in order.
+		for chunk in chunks(city_ids, HYDRATE_CHUNK):
+			yield 'SELECT '+cols+' FROM City c WHERE c.id IN (' + ','.join(['%s'] * len(chunk)) + ');', tuple(chunk)
+
+
+	@staticmethod
+	def hydrate_order(city_ids, rows, fields = None):
+		""" Put MariaDB rows back in Sphinx relevance order, optionally projected. """
+		by_id = {int(row['id']): row for row in rows}
+		rows = [by_id[x] for x in city_ids if x in by_id]
+		if fields is not None:
+			rows = [{key: val for key, val in row.items() if key in fields} for row in rows]
+		return rows
+
+
+	def hydrate(self, city_ids, fields = None):
+		""" City rows for Sphinx hits, from memory or in chunks from MariaDB. """
+		if HYDRATE_MEMORY:
+			return self.hydrate_memory(city_ids, fields)
+		sql = SQL.singleton(random.randint(0,16))
+		rows = []
+		for sqltxt, params in self.hydrate_sql(city_ids, fields):
+			rows += sql.fetchall(sqltxt, params, jsonify = True)
+		return self.hydrate_order(city_ids, rows, fields)
+
+
+	async def hydrate_async(self, city_ids, fields = None):
+		""" City rows for Sphinx hits, from memory or in chunks over the async pool. """
+		if HYDRATE_MEMORY:
+			return self.hydrate_memory(city_ids, fields)
+		rows = []
+		for sqltxt, params in self.hydrate_sql(city_ids, fields):
+			rows += await self.sqlpool.fetchall(sqltxt, params, jsonify = True)
+		return self.hydrate_order(city_ids, rows, fields)
+
+
+	@cached('text_search', fields = tuple)
+	def text_search(self, atext, fields = None):
 		""" SphinxQL based text search. """
 		spx = SphinxQL()
 		atext = sphinx_escape(atext)
-		city_ids = spx.fetchall("SELECT id FROM rt WHERE MATCH('"+atext+"')")
-		city_ids = [str(int(x[0])) for x in city_ids] # Ensure these are safe.
-		city_ids = ','.join(city_ids)
-		sql = SQL.singleton(random.randint(0,16))
-		rs = sql.fetchall('SELECT * FROM City WHERE id IN ('+city_ids+');', jsonify = True)
-		return rs
+		city_ids = spx.fetchall("SELECT id FROM " + SPHINX_INDEX + " WHERE MATCH('"+atext+"')")
+		city_ids = [int(x[0]) for x in city_ids] # Ensure these are safe.
+		return self.hydrate(city_ids, fields)
+
+
+	@cached('text_search', fields = tuple)
+	async def text_search_async(self, atext, fields = None):
+		""" SphinxQL based text search over the async Sphinx and MariaDB pools. """
+		atext = sphinx_escape(atext)
+		city_ids = await self.spxpool.fetchall('SELECT id FROM ' + SPHINX_INDEX + ' WHERE MATCH(%s)', (atext,))
+		city_ids = [int(x[0]) for x in city_ids]
+		return await self.hydrate_async(city_ids, fields)
+
+
+	@staticmethod
+	def text_batch_sql(texts):
+		""" Sphinx multi-query statements for text queries, MAX_BATCH_QUERIES per batch. """
+		statements = [('SELECT id FROM ' + SPHINX_INDEX + ' WHERE MATCH(%s)', (sphinx_escape(x),)) for x in texts]
+		return list(chunks(statements, MAX_BATCH_QUERIES))
+
+
+	def text_search_hydrate(self, hits, rows = None, fields = None):
+		"""
+		Per query results for lists of hit ids, from memory or from
+		rows fetched once for the union of the hits.
+		"""
+		if HYDRATE_MEMORY:
+			return [self.hydrate_memory(city_ids, fields) for city_ids in hits]
+		return [self.hydrate_order(city_ids, rows, fields) for city_ids in hits]
+
+
+	def text_search_batch(self, texts, fields = None):
+		""" text_search for many queries, one Sphinx round trip per MAX_BATCH_QUERIES. """
+		live = [i for i, x in enumerate(texts) if isinstance(x, str) and x.strip()]
+		spx = SphinxQL()
+		results = []
+		for statements in self.text_batch_sql([texts[i] for i in live]):
+			results += spx.fetchbatch(statements)
+		hits = [[] for x in texts]
+		for i, rs in zip(live, results):
+			hits[i] = [int(x[0]) for x in rs]
+		rows = None
+		if not HYDRATE_MEMORY:
+			sql = SQL.singleton(random.randint(0,16))
+			rows = []
+			for sqltxt, params in self.hydrate_sql(sorted(set(x for ids in hits for x in ids)), fields):
+				rows += sql.fetchall(sqltxt, params, jsonify = True)
+		return self.text_search_hydrate(hits, rows, fields)
+
+
+	async def text_search_batch_async(self, texts, fields = None):
+		"""
+		text_search for many queries over the async pools: MAX_BATCH_QUERIES
+		queries per Sphinx round trip, as many batches in flight as the Sphinx
+		pool has connections (more would only time out waiting for one),
+		and the union of the hits hydrated in one pass.
+		"""
+		live = [i for i, x in enumerate(texts) if isinstance(x, str) and x.strip()]
+		batches = self.text_batch_sql([texts[i] for i in live])
+		slots = asyncio.Semaphore(self.spxpool.maxsize)
+		async def fetchbatch(batch):
+			async with slots:
+				return await self.spxpool.fetchbatch(batch)
+		results = await asyncio.gather(*[fetchbatch(x) for x in batches])
+		hits = [[] for x in texts]
+		for i, rs in zip(live, [rs for batch in results for rs in batch]):
+			hits[i] = [int(x[0]) for x in rs]
+		rows = None
+		if not HYDRATE_MEMORY:
+			rows = []
+			for sqltxt, params in self.hydrate_sql(sorted(set(x for ids in hits for x in ids)), fields):
+				rows += await self.sqlpool.fetchall(sqltxt, params, jsonify = True)
+		return self.text_search_hydrate(hits, rows, fields)
+
+
+	async def open_pools(self):
+		""" Open this worker's async connection pools, from within its event loop. """
+		self.sqlpool = AsyncSQLPool()
+		self.spxpool = AsyncSphinxQLPool()
+		for pool in (self.sqlpool, self.spxpool):
+			try:
+				await pool.start()
+			except Exception as ex: # Not up yet on a cold start, the pool connects on demand.
+				logger.info('%s connecting on demand: %s' % (type(pool).__name__, ex))
+
+
+	async def close_pools(self):
+		await self.sqlpool.close()
+		await self.spxpool.close()
+
+
+
+def main():
+	""" Data maintenance commands, e.g. python3 citysearch.py deltas [directory]. """
+	parser = argparse.ArgumentParser(description = 'CitySearch data maintenance.')
+	parser.add_argument(
+		'command', choices = ['deltas', 'download'],
+		help = 'deltas: apply pending GeoNames delta files, download: refresh the source file if it changed, and reload from it')
+	parser.add_argument('path', nargs = '?', help = 'delta file directory, defaults to CITYSEARCH_DELTA_DIR')
+	args = parser.parse_args()
+	if args.command == 'deltas':
+		CityAPI().apply_deltas(args.path)
+	elif args.command == 'download':
+		if DataLoader().download():
+			CityAPI.build_snapshot() # City ids are row ordinals of the file: reload the databases with it, then workers.
+
 
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,625 @@
+"""
+A module for the compact in-memory city store.
+Columns are numpy arrays or string arenas and lookup indexes are sorted
+position arrays, so the store holds no per-cell Python objects and its
+pages stay shared between forked workers.
+"""
+
+import json
+import collections
+
+import numpy as np
+import pandas as pd
+
+from snapshot import StringColumn, splice
+
+
+encode_string = json.encoder.encode_basestring_ascii # What json.dumps uses for str.
+
+
+def position_dtype(n):
+	""" Narrowest dtype of row positions into n rows, int32 halves index memory below 2^31 rows. """
+	return 'int32' if n < 2**31 else 'int64'
+
+
+
+class KeyIndex:
+	"""
+	Sorted-array index over one column.
+	order lists row positions sorted by value, equal values by a tie-break
+	rank (highest first) then by position, and lookups binary search it
+	without materializing the column. String columns are searched on keys,
+	their first PREFIX utf-8 bytes as fixed-width bytes, which sort the
+	same way, so only values sharing a prefix are decoded.
+	"""
+	PREFIX = 8
+
+	def __init__(self, column, order, keys = None):
+		self.column = column
+		self.order = order
+		self.strings = isinstance(column, StringColumn)
+		self.keys = self.search_keys(order) if keys is None else keys
+
+	@staticmethod
+	def ranks(rank):
+		""" Ascending sort key of a tie-break rank column, highest rank first and unknown last. """
+		if rank is None:
+			return None
+		return -np.nan_to_num(np.asarray(rank, dtype = 'float64'), nan = -np.inf)
+
+	@classmethod
+	def build(cls, column, rank = None):
+		""" Sort a column into a new index, nulls are left out. rank orders equal values, highest first. """
+		rank = cls.ranks(rank)
+		if isinstance(column, StringColumn):
+			order = cls.sort_strings([column], rank)
+		elif rank is None:
+			order = np.argsort(column, kind = 'mergesort').astype(position_dtype(len(column)))
+		else:
+			order = np.lexsort((np.arange(len(column)), rank, column)).astype(position_dtype(len(column)))
+		return cls(column, order)
+
+	@staticmethod
+	def sort_strings(columns, rank = None):
+		"""
+		Row positions sorted by the values of string columns in turn, then by
+		the ascending rank (see ranks), then by position, rows with a null left
+		out. Values compare as utf-8 bytes, the order of str, 8 bytes at a time:
+		all rows sort on their first 8, then only the runs of rows tied on them
+		on their next 8, and so on, so nothing is decoded (or sorted) in Python.
+		"""
+		n = len(columns[0])
+		order = np.flatnonzero(~np.any([col.nulls for col in columns], axis = 0))
+		if rank is not None:
+			order = order[np.argsort(rank[order], kind = 'mergesort')] # Ties stay in this order, the sorts being stable.
+		runs = np.zeros(len(order), dtype = 'int64') # Where in order the run of values equal so far starts.
+		tied = np.arange(len(order)) # Where in order the rows of runs still to sort are.
+		for i, column in enumerate(columns):
+			equal = [tied[:0]] # Runs of equal values, sorted on the next column.
+			skip = 0
+			while len(tied):
+				pos = order[tied]
+				keys = KeyIndex.prefixes(column, pos, skip = skip).view('>u8') # Compare like the bytes.
+				j = np.lexsort((keys, runs[tied]))
+				pos, keys, run = pos[j], keys[j], runs[tied][j]
+				order[tied] = pos # tied holds whole runs, each stays in place.
+				start = np.ones(len(tied), dtype = 'bool')
+				start[1:] = (run[1:] != run[:-1]) | (keys[1:] != keys[:-1])
+				run = np.cumsum(start) - 1
+				runs[tied] = tied[start][run]
+				shared = np.bincount(run)[run] > 1
+				more = (keys & 0xff) != 0 # Values going on past these 8 bytes.
+				equal.append(tied[shared & ~more])
+				tied = tied[shared & more]
+				skip += 8
+			if i + 1 < len(columns):
+				tied = np.sort(np.concatenate(equal))
+		return order.astype(position_dtype(n))
+
+	@classmethod
+	def prefixes(cls, column, positions, chunk = 1 << 20, skip = 0):
+		""" Search keys of a string column at positions, zero padded, cut from byte skip of the values on. """
+		keys = np.zeros(len(positions), dtype = 'S%d' % cls.PREFIX)
+		if len(column.arena) == 0:
+			return keys
+		slot = np.arange(cls.PREFIX)
+		last = len(column.arena) - cls.PREFIX # Start of the last whole PREFIX bytes.
+		if last >= 0: # Every PREFIX bytes of the arena as a row, gathered a row per key.
+			window = np.lib.stride_tricks.as_strided(column.arena, shape = (last + 1, cls.PREFIX), strides = (1, 1), writeable = False)
+		for i in range(0, len(positions), chunk):
+			pos = np.asarray(positions[i:i + chunk])
+			starts = column.offsets[pos] + skip
+			inside = slot < (column.offsets[pos + 1] - 1 - starts)[:, None]
+			if last >= 0:
+				prefix = window[np.clip(starts, 0, last)]
+				tail = np.flatnonzero(starts > last) # Within the arena's last PREFIX bytes.
+			else:
+				prefix = np.zeros((len(pos), cls.PREFIX), dtype = 'uint8')
+				tail = np.arange(len(pos))
+			at = np.minimum(starts[tail, None] + slot, len(column.arena) - 1)
+			prefix[tail] = column.arena[at]
+			prefix[~inside] = 0
+			keys[i:i + chunk] = prefix.view(keys.dtype).ravel()
+		return keys
+
+	def value(self, pos):
+		""" Column value at a row position. """
+		return self.column[pos]
+
+	def encode(self, value):
+		""" utf-8 bytes of a str value, what the search keys are cut from. """
+		return value.encode('utf-8')
+
+	def search_keys(self, positions):
+		""" Keys of the rows at positions, as stored in keys. """
+		if self.strings:
+			return self.prefixes(self.column, positions)
+		return self.column[positions]
+
+	def present(self, pos):
+		""" Whether the row at pos belongs in the index, nulls do not. """
+		return not (self.strings and self.column.nulls[pos])
+
+	def prefix(self, value):
+		""" Search key of one str value. """
+		return np.bytes_(self.encode(value)[:self.PREFIX])
+
+	def coerce(self, value):
+		""" A lookup value in the column's type, raises ValueError (or TypeError) when it has none. """
+		if self.strings:
+			return str(value)
+		if self.keys.dtype.kind in 'iu':
+			return int(value)
+		return self.keys.dtype.type(float(value)) # Compared as the column's float32, whatever the promotion rules.
+
+	def _bisect(self, value, right = False):
+		""" Leftmost (or rightmost) insertion point of value in the sorted order. """
+		side = 'right' if right else 'left'
+		if not self.strings:
+			return int(np.searchsorted(self.keys, value, side = side))
+		encoded = self.encode(value)
+		key = np.bytes_(encoded[:self.PREFIX])
+		if len(encoded) < self.PREFIX: # The key is the whole value.
+			return int(np.searchsorted(self.keys, key, side = side))
+		lo = int(np.searchsorted(self.keys, key, side = 'left'))
+		hi = int(np.searchsorted(self.keys, key, side = 'right'))
+		order, at = self.order, self.value
+		while lo < hi:
+			mid = (lo + hi) // 2
+			x = at(order[mid])
+			if x < value or (right and x == value):
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def _insertion(self, lo, hi, ranks, pos, sorted_ranks):
+		"""
+		Where the row at pos sorts into the order, [lo, hi) being the run of
+		its value and sorted_ranks being ranks[order].
+		"""
+		if ranks is not None:
+			i = int(np.searchsorted(sorted_ranks[lo:hi], ranks[pos], side = 'left'))
+			j = int(np.searchsorted(sorted_ranks[lo:hi], ranks[pos], side = 'right'))
+			lo, hi = lo + i, lo + j
+		return lo + int(np.searchsorted(self.order[lo:hi], pos))
+
+	def patch(self, source, changed, rank = None, dead = None):
+		"""
+		A copy of this index over source, the patched column (or columns),
+		with the rows at changed positions taken out and, unless dead, sorted
+		back in. Numeric orders are simply re-sorted, string ones only search
+		and compare the changed rows.
+		"""
+		changed = np.asarray(changed, dtype = 'int64')
+		dtype = position_dtype(len(source[0] if isinstance(source, tuple) else source))
+		keep = self.order[~np.isin(self.order, changed)]
+		ranks = self.ranks(rank)
+		adds = [p for p in changed.tolist() if dead is None or not dead[p]]
+		if not self.strings:
+			order = np.concatenate((keep, np.array(adds, dtype = dtype)))
+			tie = np.zeros(len(order)) if ranks is None else ranks[order]
+			return type(self)(source, order[np.lexsort((order, tie, source[order]))])
+		idx = type(self)(source, keep, self.keys[~np.isin(self.order, changed)])
+		adds = [p for p in adds if idx.present(p)]
+		adds.sort(key = lambda p: (idx.value(p), 0 if ranks is None else ranks[p])) # Stable, so ties by position.
+		sorted_ranks = None if ranks is None else ranks[keep]
+		points = []
+		last = None
+		for p in adds:
+			value = idx.value(p)
+			if value != last: # adds are sorted, so runs of a value share one search.
+				lo, hi, last = idx._bisect(value), idx._bisect(value, right = True), value
+			points.append(idx._insertion(lo, hi, ranks, p, sorted_ranks))
+		order = np.insert(keep, points, adds).astype(dtype)
+		keys = np.insert(idx.keys, points, idx.search_keys(np.array(adds, dtype = 'int64')))
+		return type(self)(source, order, keys)
+
+	def positions(self, value):
+		""" Row positions holding value, in tie-break order. """
+		lo = self._bisect(value)
+		hi = self._bisect(value, right = True)
+		return self.order[lo:hi]
+
+	def first(self, value):
+		""" Top ranked row position holding value, or None. """
+		lo = self._bisect(value)
+		if lo < len(self.order):
+			pos = self.order[lo]
+			if self.value(pos) == value:
+				return int(pos)
+		return None
+
+	def first_many(self, values):
+		""" first for a list of values, one searchsorted call for numeric columns. """
+		if self.strings:
+			return [self.first(x) for x in values]
+		if len(self.keys) == 0:
+			return [None] * len(values)
+		cast = np.zeros(len(values), dtype = self.keys.dtype)
+		fits = np.zeros(len(values), dtype = 'bool')
+		for i, value in enumerate(values):
+			try:
+				cast[i] = value
+			except (TypeError, ValueError, OverflowError):
+				continue # Not representable in the column, so held by no row, as in first.
+			fits[i] = cast[i] == value
+		lo = np.minimum(np.searchsorted(self.keys, cast), len(self.keys) - 1)
+		found = fits & (self.keys[lo] == cast)
+		return [int(pos) if ok else None for pos, ok in zip(self.order[lo].tolist(), found.tolist())]
+
+
+
+class CompositeIndex(KeyIndex):
+	"""
+	Sorted-array index over a tuple of string columns, e.g. (country_code, name).
+	Values are tuples, ordered and ranked like KeyIndex values, and searched
+	on the prefix of their parts joined by SEP, which sorts below any text.
+	"""
+	PREFIX = 16 # Room for a country code and most names.
+	SEP = b'\x1f'
+
+	def __init__(self, columns, order, keys = None):
+		self.columns = tuple(columns)
+		self.order = order
+		self.strings = True
+		self.keys = self.search_keys(order) if keys is None else keys
+
+	@classmethod
+	def build(cls, columns, rank = None):
+		""" Sort tuples of columns into a new index, rows with a null part are left out. """
+		return cls(columns, cls.sort_strings(columns, cls.ranks(rank)))
+
+	def search_keys(self, positions, chunk = 1 << 18):
+		""" The prefixes of the parts joined by SEP, laid out from each column's own prefixes. """
+		positions = np.asarray(positions, dtype = 'int64')
+		keys = np.zeros(len(positions), dtype = 'S%d' % self.PREFIX)
+		slot = np.arange(self.PREFIX)
+		for i in range(0, len(positions), chunk):
+			pos = positions[i:i + chunk]
+			key = np.zeros((len(pos), self.PREFIX), dtype = 'uint8')
+			at = np.zeros(len(pos), dtype = 'int64') # Where the next part starts in each key.
+			for j, col in enumerate(self.columns):
+				if j:
+					key[slot == at[:, None]] = self.SEP[0]
+					at += 1
+				part = self.prefixes(col, pos).view('uint8').reshape(-1, self.PREFIX)
+				size = col.offsets[pos + 1] - 1 - col.offsets[pos]
+				src = slot - at[:, None]
+				inside = (src >= 0) & (src < size[:, None])
+				key = np.where(inside, np.take_along_axis(part, np.clip(src, 0, self.PREFIX - 1), axis = 1), key)
+				at += size
+			keys[i:i + chunk] = key.view(keys.dtype).ravel()
+		return keys
+
+	def present(self, pos):
+		return not any(col.nulls[pos] for col in self.columns)
+
+	def value(self, pos):
+		return tuple(col[pos] for col in self.columns)
+
+	def encode(self, value):
+		return self.SEP.join(x.encode('utf-8') for x in value)
+
+	def coerce(self, value):
+		""" A lookup tuple of str, raises ValueError when it has the wrong arity. """
+		value = tuple(str(x) for x in value)
+		if len(value) != len(self.columns):
+			raise ValueError('expected %d values' % len(self.columns))
+		return value
+
+
+
+class RowJSON:
+	"""
+	Every row pre-encoded once as an ascii JSON object in one arena.
+	fields holds the offset of each "name":value member within its row, plus
+	the row length, so projections are slices of the same bytes.
+	"""
+	ARRAYS = ('offsets', 'arena', 'fields')
+
+	def __init__(self, names, offsets, arena, fields):
+		self.names = list(names)
+		self.offsets = np.asarray(offsets)
+		self.arena = np.asarray(arena)
+		self.fields = np.asarray(fields)
+		self.buf = memoryview(self.arena)
+		self.column = {name: j for j, name in enumerate(self.names)}
+
+	@classmethod
+	def encode(cls, store, chunk = 1 << 17):
+		"""
+		Encode the rows of a store, values exactly as json.dumps writes them,
+		chunk rows at a time so only one chunk's rows are Python strings.
+		"""
+		arenas = [np.empty(0, dtype = 'uint8')]
+		fields = [np.ones((0, len(store.columns) + 1), dtype = 'int32')]
+		for i in range(0, len(store), chunk):
+			rows, part = cls._rows(store.columns, np.arange(i, min(i + chunk, len(store))))
+			arenas.append(np.frombuffer(''.join(rows).encode('ascii'), dtype = 'uint8'))
+			fields.append(part)
+		fields = np.concatenate(fields)
+		offsets = np.zeros(len(fields) + 1, dtype = 'int64')
+		np.cumsum(fields[:, -1], out = offsets[1:])
+		return cls(store.columns.keys(), offsets, np.concatenate(arenas), fields)
+
+	@staticmethod
+	def _rows(columns, positions):
+		""" Encoded rows of store columns at positions and their member offsets. """
+		members = []
+		span = len(positions) > 0 and np.array_equal(positions, np.arange(positions[0], positions[0] + len(positions)))
+		for name, col in columns.items():
+			key = json.dumps(name) + ':'
+			if isinstance(col, StringColumn):
+				vals = col.tolist(positions[0], positions[-1] + 1) if span else [col[i] for i in positions]
+				members.append([key + ('null' if x is None else encode_string(x)) for x in vals])
+			else:
+				members.append([key + ('null' if x is None else repr(x)) for x in CityStore._values(col, positions)])
+		lengths = np.array([[len(x) for x in col] for col in members], dtype = 'int32').reshape(len(members), -1).T
+		fields = np.ones((len(positions), len(members) + 1), dtype = 'int32')
+		np.cumsum(lengths + 1, axis = 1, out = fields[:, 1:]) # Each member is followed by ',' or '}'.
+		fields[:, 1:] += 1
+		return ['{' + ','.join(row) + '}' for row in zip(*members)], fields
+
+	def patch(self, columns, positions):
+		""" A copy with the rows at sorted positions re-encoded from the (patched) store columns. """
+		positions = np.asarray(positions, dtype = 'int64')
+		rows, changed = self._rows(columns, positions)
+		offsets, arena = splice(self.offsets, self.arena, positions.tolist(), [x.encode('ascii') for x in rows])
+		fields = np.ones((len(offsets) - 1, self.fields.shape[1]), dtype = 'int32')
+		fields[:len(self.fields)] = self.fields
+		fields[positions] = changed
+		return RowJSON(self.names, offsets, arena, fields)
+
+	def arrays(self):
+		""" Arrays by name, for the snapshot. """
+		return {attr: getattr(self, attr) for attr in self.ARRAYS}
+
+	@staticmethod
+	def _encode(vals):
+		""" JSON text of each value, repr being json.dumps for ints and finite floats. """
+		vals = np.asarray(vals)
+		if vals.dtype.kind in 'iu' or (vals.dtype.kind == 'f' and np.isfinite(vals).all()):
+			return list(map(repr, vals.tolist()))
+		return list(map(json.dumps, vals.tolist()))
+
+	def _extra(self, extra, positions):
+		""" Encoded ,"name":value tails of extra columns, one bytes per row. """
+		tails = [''] * len(positions)
+		for name, vals in (extra or {}).items():
+			key = ',' + json.dumps(name) + ':'
+			tails = [tail + key + val for tail, val in zip(tails, self._encode(vals))]
+		return [tail.encode('ascii') for tail in tails]
+
+	def row_bytes(self, positions, extra = None, fields = None):
+		"""
+		Encoded JSON object of each row at positions, as bytes-like slices.
+		extra maps names to per-row values appended to each object, and fields
+		optionally projects the members (in store order, then extra order).
+		"""
+		positions = np.asarray(positions, dtype = 'int64')
+		starts = self.offsets[positions].tolist()
+		buf = self.buf
+		if fields is None:
+			if not extra:
+				ends = self.offsets[positions + 1].tolist()
+				return [buf[s:e] for s, e in zip(starts, ends)]
+			ends = (self.offsets[positions + 1] - 1).tolist()
+			tails = self._extra(extra, positions)
+			return [b''.join((buf[s:e], t, b'}')) for s, e, t in zip(starts, ends, tails)]
+		cols = [j for j, name in enumerate(self.names) if name in fields]
+		extra = {name: vals for name, vals in (extra or {}).items() if name in fields}
+		bounds = self.fields[positions]
+		tails = self._extra(extra, positions)
+		out = []
+		for s, row, tail in zip(starts, bounds.tolist(), tails):
+			body = b','.join([buf[s+row[j]:s+row[j+1]-1] for j in cols])
+			if not cols:
+				tail = tail[1:]
+			out.append(b''.join((b'{', body, tail, b'}')))
+		return out
+
+	def records(self, positions, extra = None, fields = None):
+		""" JSON array body of the rows at positions, see row_bytes. """
+		return b'[' + b','.join(self.row_bytes(positions, extra, fields)) + b']'
+
+
+
+class CityStore:
+	"""
+	Columnar city rows with row position = id - 1.
+	INDEXED columns get a KeyIndex, with equal values ranked by RANK,
+	COMPOSITE columns also a CompositeIndex over (COUNTRY, column) for
+	country qualified lookups, and every row is pre-encoded as JSON.
+	Deleted rows keep their position (and id) as tombstones in dead,
+	left out of every index.
+	"""
+	INDEXED = ('geonameid', 'name', 'asciiname', 'altnames', 'latitude', 'longitude', 'feat_class', 'feat_code',
+		'country_code', 'cc2', 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code',
+		'population', 'elevation', 'dem', 'timezone', 'modified')
+	RANK = 'population' # Non-unique keys resolve to the most populous city, then the lowest id.
+	COUNTRY = 'country_code'
+	COMPOSITE = ('name', 'asciiname')
+
+	def __init__(self, columns, orders = None, encoded = None, keys = None, dead = None):
+		"""
+		Wrap columns, building any index (or string index keys) or row
+		encoding not supplied, encoded being RowJSON arrays or a RowJSON.
+		"""
+		self.columns = columns
+		orders = orders or {}
+		keys = keys or {}
+		self.dead = np.zeros(len(self), dtype = 'bool') if dead is None else np.asarray(dead)
+		tombstones = np.flatnonzero(self.dead)
+		rank = columns.get(self.RANK)
+		self.index = {}
+		for col in self.INDEXED:
+			if col not in columns:
+				continue
+			if col in orders:
+				self.index[col] = KeyIndex(columns[col], orders[col], keys.get(col))
+			else:
+				self.index[col] = KeyIndex.build(columns[col], rank).patch(columns[col], tombstones, rank, self.dead)
+		self.composite = {}
+		for col in self.COMPOSITE:
+			if col not in columns or self.COUNTRY not in columns:
+				continue
+			name = self.composite_name(col)
+			pair = (columns[self.COUNTRY], columns[col])
+			if name in orders:
+				self.composite[col] = CompositeIndex(pair, orders[name], keys.get(name))
+			else:
+				self.composite[col] = CompositeIndex.build(pair, rank).patch(pair, tombstones, rank, self.dead)
+		if encoded is None:
+			self.json = RowJSON.encode(self)
+		elif isinstance(encoded, RowJSON):
+			self.json = encoded
+		else:
+			self.json = RowJSON(columns.keys(), **encoded)
+
+	@classmethod
+	def from_dataframe(cls, df, types):
+		""" Encode a parsed city frame, types maps numeric columns to dtypes. """
+		return cls.from_chunks([df], types)
+
+	@classmethod
+	def from_chunks(cls, frames, types):
+		"""
+		Encode an iterator of parsed city frames as they arrive, keeping only
+		their compact columns, then join them and index the whole.
+		"""
+		parts = collections.OrderedDict()
+		for df in frames:
+			for col in df.columns:
+				if col in types:
+					part = pd.to_numeric(df[col]).values.astype(types[col])
+				else:
+					part = StringColumn.from_values(df[col].values)
+				parts.setdefault(col, []).append(part)
+		columns = collections.OrderedDict()
+		for col, col_parts in parts.items():
+			if col in types:
+				columns[col] = np.concatenate(col_parts)
+			else:
+				columns[col] = StringColumn.concat(col_parts)
+			del col_parts[:]
+		return cls(columns)
+
+	def patch(self, positions, values, deletes = ()):
+		"""
+		A patched copy of the store. values maps every column to its new
+		values for the rows at sorted positions (positions past the end
+		append rows), and the rows at deletes become tombstones. Columns,
+		row JSON and indexes are spliced at the changed rows only.
+		"""
+		positions = sorted(positions)
+		size = max([len(self)] + [p + 1 for p in positions])
+		columns = collections.OrderedDict()
+		for name, col in self.columns.items():
+			if isinstance(col, StringColumn):
+				columns[name] = col.patch(positions, values[name])
+			else:
+				arr = np.zeros(size, dtype = col.dtype)
+				arr[:len(col)] = col
+				arr[positions] = values[name]
+				columns[name] = arr
+		dead = np.zeros(size, dtype = 'bool')
+		dead[:len(self)] = self.dead
+		dead[positions] = False
+		dead[list(deletes)] = True
+		changed = sorted(set(positions) | set(deletes))
+		rank = columns.get(self.RANK)
+		orders, keys = {}, {}
+		for name, idx in self.indexes().items():
+			if name in self.index:
+				source = columns[name]
+			else:
+				source = (columns[self.COUNTRY], columns[name[len(self.composite_name('')):]])
+			idx = idx.patch(source, changed, rank, dead)
+			orders[name] = idx.order
+			if idx.strings:
+				keys[name] = idx.keys
+		return CityStore(columns, orders, self.json.patch(columns, positions), keys, dead)
+
+	def first_in_country(self, positions, country_code, chunk = 1 << 12):
+		"""
+		The first of row positions (e.g. a KeyIndex's, in tie-break order)
+		in country_code, or None. Their country search keys are compared a
+		chunk at a time, so nothing is decoded unless they match.
+		"""
+		ccodes = self.columns[self.COUNTRY]
+		key = np.bytes_(country_code.encode('utf-8')[:KeyIndex.PREFIX])
+		for i in range(0, len(positions), chunk):
+			pos = np.asarray(positions[i:i + chunk])
+			for j in np.flatnonzero(KeyIndex.prefixes(ccodes, pos) == key).tolist():
+				if ccodes[pos[j]] == country_code: # Only differs past the PREFIX bytes.
+					return int(pos[j])
+		return None
+
+	def live(self):
+		""" Row positions that are not tombstones. """
+		return np.flatnonzero(~self.dead)
+
+	@classmethod
+	def composite_name(cls, col):
+		""" Name of the composite index for col, e.g. country_code+name. """
+		return cls.COUNTRY + '+' + col
+
+	def indexes(self):
+		""" Every index by name, composite ones by composite_name. """
+		indexes = dict(self.index)
+		indexes.update((self.composite_name(col), idx) for col, idx in self.composite.items())
+		return indexes
+
+	def orders(self):
+		""" Index orders by name, for the snapshot. """
+		return {name: idx.order for name, idx in self.indexes().items()}
+
+	def search_keys(self):
+		""" String index search keys by name, for the snapshot. """
+		return {name: idx.keys for name, idx in self.indexes().items() if idx.strings}
+
+	def __len__(self):
+		return len(self.columns['id'])
+
+	def __getitem__(self, col):
+		return self.columns[col]
+
+	def position(self, city_id):
+		""" Row position of a city id. """
+		return int(city_id) - 1
+
+	@staticmethod
+	def _values(col, positions):
+		""" Plain Python values of a column at positions, NaN as None. """
+		if isinstance(col, StringColumn):
+			return [col[i] for i in positions]
+		vals = col[positions]
+		if vals.dtype.kind == 'f':
+			nulls = np.isnan(vals)
+			if vals.dtype == 'float32':
+				vals = vals.astype('U').astype('float64') # Shortest float32 repr, not its float64 expansion.
+			vals = vals.tolist()
+			for i in np.flatnonzero(nulls):
+				vals[i] = None
+			return vals
+		return vals.tolist()
+
+	def rows(self, positions, extra = None):
+		""" Row dicts at positions, with optional extra columns of equal length. """
+		positions = np.asarray(positions, dtype = 'int64')
+		data = collections.OrderedDict((name, self._values(col, positions)) for name, col in self.columns.items())
+		for name, vals in (extra or {}).items():
+			data[name] = np.asarray(vals).tolist()
+		names = list(data.keys())
+		return [dict(zip(names, vals)) for vals in zip(*data.values())]
+
+	def to_json(self, positions, extra = None, fields = None):
+		""" JSON records at positions as bytes, from the pre-encoded rows. """
+		return self.json.records(positions, extra, fields)
+
+	def to_dataframe(self):
+		""" Materialize a pandas frame, for interactive use. """
+		return pd.DataFrame(collections.OrderedDict(
+			(name, col.tolist() if isinstance(col, StringColumn) else np.asarray(col))
+			for name, col in self.columns.items()))
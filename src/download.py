@@ -0,0 +1,172 @@
+"""
+A module to download and extract source archives over HTTP.
+Transfers stream to a .part file that later runs resume with a Range
+request, the validators (ETag, Last-Modified) of a finished download
+make the next check a conditional request, and zip members are
+extracted a block at a time, so memory stays flat for any archive size.
+"""
+
+import os
+import json
+import base64
+import shutil
+import hashlib
+import zipfile
+import email.utils
+
+import requests
+
+
+BLOCK = 1 << 20 # Bytes per read and write.
+TIMEOUT = (10, 60) # Connect and read timeouts in seconds.
+
+
+
+class DownloadError(Exception):
+	""" A transfer that came back short, corrupt, or with an unexpected status. """
+
+
+
+def read_state(path):
+	""" The JSON state saved next to a download, or {}. """
+	try:
+		with open(path) as fin:
+			return json.load(fin)
+	except (OSError, ValueError):
+		return {}
+
+
+def write_state(path, state):
+	with open(path + '.tmp', 'w') as fout:
+		json.dump(state, fout)
+	os.replace(path + '.tmp', path)
+
+
+def file_digest(path, name):
+	""" Base64 digest of a file by hashlib algorithm name, read a block at a time. """
+	digest = hashlib.new(name)
+	with open(path, 'rb') as fin:
+		for block in iter(lambda: fin.read(BLOCK), b''):
+			digest.update(block)
+	return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def published_digest(response):
+	"""
+	The digest the server publishes for the whole file, as [hashlib name,
+	base64 digest], or None: a SHA-256 or MD5 Digest header (RFC 3230, of
+	the file whatever the range), else the Content-MD5 of a full response.
+	"""
+	algorithms = {'sha-256': 'sha256', 'md5': 'md5'}
+	for item in response.headers.get('Digest', '').split(','):
+		name, _, value = item.strip().partition('=')
+		if name.lower() in algorithms and value:
+			return [algorithms[name.lower()], value]
+	if response.status_code == 200 and response.headers.get('Content-MD5'):
+		return ['md5', response.headers['Content-MD5'].strip()]
+	return None
+
+
+def validators(response):
+	""" The response's ETag and Last-Modified, for conditional and ranged requests. """
+	return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def conditional_headers(state, since = None):
+	""" If-None-Match / If-Modified-Since from a previous download's state, else from the time since. """
+	headers = {}
+	if state.get('etag'):
+		headers['If-None-Match'] = state['etag']
+	if state.get('last_modified'):
+		headers['If-Modified-Since'] = state['last_modified']
+	elif since is not None:
+		headers['If-Modified-Since'] = email.utils.formatdate(since, usegmt = True)
+	return headers
+
+
+def discard(part):
+	""" Remove a partial download and its state. """
+	for stale in (part, part + '.json'):
+		if os.path.isfile(stale):
+			os.remove(stale)
+
+
+def range_total(response):
+	""" The full size from a Content-Range header (bytes a-b/total or bytes */total), None if unknown. """
+	total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+	return int(total) if total.isdigit() else None
+
+
+def fetch(url, path, state = None, since = None):
+	"""
+	Stream url to path, returning its new state (validators, size and the
+	digest checked, if any), or None when the server reports it unchanged
+	since state (or the time since). A partial path.part left by an
+	interrupted run is resumed when the server still has the same version
+	of the file, finished when it turns out to be whole (416, nothing left
+	past it) and started over when it is larger. When the server publishes
+	a digest (see published_digest) a file not matching it is discarded
+	with a DownloadError, else the zip CRC-32s checked by extract are the
+	only verification.
+	"""
+	state = state or {}
+	part = path + '.part'
+	partstate = read_state(part + '.json')
+	headers = conditional_headers(state, since)
+	offset = os.path.getsize(part) if os.path.isfile(part) else 0
+	if offset and (partstate.get('etag') or partstate.get('last_modified')):
+		headers['Range'] = 'bytes=%d-' % offset
+		headers['If-Range'] = partstate.get('etag') or partstate['last_modified']
+	with requests.get(url, headers = headers, stream = True, timeout = TIMEOUT) as rs:
+		if rs.status_code == 304:
+			discard(part) # A partial of the version we already have.
+			return None
+		if rs.status_code == 416 and offset: # Killed after the last block, or a partial past the end.
+			total = range_total(rs)
+			if total != offset:
+				discard(part)
+				return fetch(url, path, state, since)
+			mode = None
+		elif rs.status_code == 206:
+			total = range_total(rs)
+			mode = 'ab'
+			partstate['digest'] = published_digest(rs) or partstate.get('digest')
+		elif rs.status_code == 200:
+			total = int(rs.headers['Content-Length']) if 'Content-Length' in rs.headers else None
+			mode, offset = 'wb', 0
+			partstate = dict(validators(rs), digest = published_digest(rs))
+			write_state(part + '.json', partstate)
+		else:
+			raise DownloadError('GET %s: HTTP %d' % (url, rs.status_code))
+		if mode is not None:
+			with open(part, mode) as fout:
+				for block in rs.iter_content(BLOCK):
+					fout.write(block)
+	size = os.path.getsize(part)
+	if total is not None and size != total:
+		raise DownloadError('GET %s: %d of %d bytes, run again to resume' % (url, size, total))
+	if partstate.get('digest'):
+		name, expected = partstate['digest']
+		if file_digest(part, name) != expected:
+			discard(part)
+			raise DownloadError('GET %s: %s digest mismatch, run again to download it again' % (url, name))
+	os.replace(part, path)
+	os.remove(part + '.json')
+	partstate.update({'url': url, 'size': size})
+	return partstate
+
+
+def extract(archive, dest, members = None):
+	"""
+	Extract the members (default all) of a zip archive into dest, streaming each
+	through a temporary file renamed into place. Every member's CRC-32 is
+	checked as it is read, a mismatch raises zipfile.BadZipFile.
+	"""
+	with zipfile.ZipFile(archive) as zf:
+		for info in zf.infolist():
+			if info.is_dir() or (members is not None and info.filename not in members):
+				continue
+			target = os.path.join(dest, os.path.basename(info.filename))
+			with zf.open(info) as fin, open(target + '.tmp', 'wb') as fout:
+				shutil.copyfileobj(fin, fout, BLOCK)
+			os.replace(target + '.tmp', target)
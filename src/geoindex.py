@@ -0,0 +1,229 @@
+"""
+A module for in-process great-circle nearest neighbour search.
+Coordinates are mapped onto 3D unit vectors, where euclidean (chord)
+distance is monotonic in great-circle distance, so a plain kd-tree
+answers exact kNN with no pole or antimeridian special cases.
+"""
+
+import math
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088 # Same mean radius as GeoDist.sql.
+BOUND_SLACK = 1e-12 # Leaf box distances are rounded apart from point ones, keep leaves tied with the k-th point.
+
+
+def unit_vectors(lat, lon):
+	""" Map latitude and longitude degrees onto 3D unit vectors. """
+	lat = np.radians(np.asarray(lat, dtype = 'float64'))
+	lon = np.radians(np.asarray(lon, dtype = 'float64'))
+	coslat = np.cos(lat)
+	return np.column_stack((coslat * np.cos(lon), coslat * np.sin(lon), np.sin(lat)))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+	""" Vectorized haversine distance in kilometers between degree coordinates. """
+	lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+	a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+	return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def unit_vector(lat, lon):
+	""" Scalar unit_vectors, skipping numpy overhead for a single query point. """
+	lat, lon = math.radians(lat), math.radians(lon)
+	coslat = math.cos(lat)
+	return np.array((coslat * math.cos(lon), coslat * math.sin(lon), math.sin(lat)))
+
+
+def sqnorms(vecs):
+	""" Row-wise squared euclidean norms. """
+	return np.einsum('ij,ij->i', vecs, vecs)
+
+
+def chord2(points, qs):
+	"""
+	Squared chord distances between unit vectors, as 2 - 2 cos, broadcast
+	over the leading axes. Spelled out elementwise so a point's distance
+	rounds the same in query and query_many, whatever the batch shape.
+	"""
+	return 2 - 2 * (points[..., 0] * qs[..., 0] + points[..., 1] * qs[..., 1] + points[..., 2] * qs[..., 2])
+
+
+
+class GeoIndex:
+	"""
+	Numpy backed kd-tree over unit vectors.
+	Points are reordered so every leaf owns a contiguous slice, and a
+	query is answered from vectorized leaf bounding box distances
+	instead of walking nodes one at a time in Python.
+	"""
+	ARRAYS = ('points', 'lat', 'lon', 'ids', 'lo', 'hi', 'bmin', 'bmax')
+	LEAF_ARRAYS = ('lo', 'hi', 'bmin', 'bmax')
+
+	def __init__(self, lat, lon, ids = None, leafsize = None):
+		"""
+		Build the index, ids default to the input row positions.
+		The default leaf size of about sqrt(n) balances the leaf box scan
+		against the point scan inside the leaves that survive it.
+		"""
+		lat = np.asarray(lat, dtype = 'float64')
+		lon = np.asarray(lon, dtype = 'float64')
+		ids = np.arange(len(lat)) if ids is None else np.asarray(ids)
+		self.leafsize = leafsize or max(16, int(math.sqrt(len(lat))))
+		points = unit_vectors(lat, lon)
+		perm = self.build(points)
+		self.points = points[perm]
+		self.lat = lat[perm]
+		self.lon = lon[perm]
+		self.ids = ids[perm]
+
+	def __len__(self):
+		return len(self.ids)
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		""" Rebuild an index from the ARRAYS of a built one, e.g. memory-mapped from disk. """
+		geo = cls.__new__(cls)
+		for attr in cls.ARRAYS:
+			setattr(geo, attr, arrays[attr])
+		sizes = geo.hi - geo.lo
+		geo.leafsize = int(sizes.max()) if len(sizes) else 0
+		geo.minleaf = max(1, int(sizes.min())) if len(sizes) else 1
+		return geo
+
+	def build(self, points):
+		""" Split points on the median of their widest axis down to leaf size, returning the leaf order. """
+		n = len(points)
+		perm = np.arange(n)
+		nodes = [(0, n)]
+		while (n >> len(nodes).bit_length()) >= self.leafsize:
+			children = []
+			for a, b in nodes:
+				mid = (a + b) // 2
+				if b - a > 1:
+					seg = points[perm[a:b]]
+					dim = np.argmax(seg.max(axis = 0) - seg.min(axis = 0))
+					part = np.argpartition(seg[:, dim], mid - a)
+					perm[a:b] = perm[a:b][part]
+				children += [(a, mid), (mid, b)]
+			nodes = children
+		self.lo = np.array([a for a, b in nodes], dtype = 'int64')
+		self.hi = np.array([b for a, b in nodes], dtype = 'int64')
+		self.bmin = np.full((len(nodes), 3), np.inf)
+		self.bmax = np.full((len(nodes), 3), -np.inf)
+		for leaf, (a, b) in enumerate(nodes):
+			if b > a:
+				seg = points[perm[a:b]]
+				self.bmin[leaf] = seg.min(axis = 0)
+				self.bmax[leaf] = seg.max(axis = 0)
+		self.minleaf = max(1, int((self.hi - self.lo).min()))
+		return perm
+
+	def _gather(self, leaves):
+		""" Internal positions of the points owned by leaves. """
+		if len(leaves) == 1:
+			return np.arange(self.lo[leaves[0]], self.hi[leaves[0]])
+		return np.concatenate([np.arange(self.lo[x], self.hi[x]) for x in leaves])
+
+	def query(self, q, k):
+		""" Internal positions of the k points nearest to unit vector q, ties broken by id. """
+		gap = np.maximum(self.bmin - q, q - self.bmax)
+		leaf_d2 = sqnorms(np.maximum(gap, 0, out = gap))
+		nseed = min(len(leaf_d2), k // self.minleaf + 1)
+		if nseed == 1:
+			seed = [np.argmin(leaf_d2)]
+		elif nseed < len(leaf_d2):
+			seed = np.argpartition(leaf_d2, nseed - 1)[:nseed]
+		else:
+			seed = np.arange(nseed)
+		pos = self._gather(seed)
+		bound = np.partition(chord2(self.points[pos], q), k - 1)[k - 1]
+		pos = self._gather(np.flatnonzero(leaf_d2 <= bound + BOUND_SLACK))
+		d2 = chord2(self.points[pos], q)
+		if len(pos) > k:
+			near = d2 <= np.partition(d2, k - 1)[k - 1] # The k nearest and any tied with the k-th.
+			pos, d2 = pos[near], d2[near]
+			pos = pos[np.lexsort((self.ids[pos], d2))[:k]]
+		return pos
+
+	def nearest(self, lat, lon, k):
+		"""
+		Exact great-circle k nearest neighbours of a degree coordinate.
+		Returns (ids, distance_km) ordered by distance, ties broken by id.
+		"""
+		k = min(int(k), len(self))
+		if k < 1:
+			return self.ids[:0], np.empty(0)
+		pos = self.query(unit_vector(lat, lon), k)
+		dist = haversine_km(lat, lon, self.lat[pos], self.lon[pos])
+		order = np.lexsort((self.ids[pos], dist))
+		return self.ids[pos][order], dist[order]
+
+	def _candidates(self, leaves):
+		"""
+		Internal positions owned by an array of leaves, padded to the widest leaf.
+		Returns (positions, valid), shaped leaves.shape + (width,).
+		"""
+		sizes = self.hi - self.lo
+		slot = np.arange(int(sizes.max()))
+		valid = slot < sizes[leaves][..., None]
+		return np.where(valid, self.lo[leaves][..., None] + slot, 0), valid
+
+	def _chord2(self, pos, qs):
+		""" Squared chord distances between points at pos (rows) and unit vectors qs, see chord2. """
+		return chord2(np.take(self.points, pos, axis = 0), qs[:, None])
+
+	def query_many(self, qs, ks):
+		"""
+		The ks[i] points nearest to each unit vector qs[i], ties broken by id,
+		by the same seed-bound-filter steps as query with each step one array
+		operation over the batch. Returns flat (query, position) arrays grouped
+		by query.
+		"""
+		nleaves = len(self.lo)
+		rows = np.arange(len(qs))
+		gap = np.maximum(self.bmin - qs[:, None], qs[:, None] - self.bmax)
+		np.maximum(gap, 0, out = gap)
+		leaf_d2 = np.einsum('ijk,ijk->ij', gap, gap)
+		nseed = min(nleaves, int(ks.max()) // self.minleaf + 1)
+		if nseed < nleaves:
+			seed = np.argpartition(leaf_d2, nseed - 1, axis = 1)[:, :nseed]
+		else:
+			seed = np.tile(np.arange(nleaves), (len(qs), 1))
+		pos, valid = self._candidates(seed)
+		d2 = self._chord2(pos.reshape(len(qs), -1), qs)
+		d2[~valid.reshape(len(qs), -1)] = np.inf
+		bound = np.partition(d2, np.unique(ks - 1), axis = 1)[rows, ks - 1]
+		qi, leaves = np.nonzero(leaf_d2 <= bound[:, None] + BOUND_SLACK) # Surviving (query, leaf) pairs.
+		pos, valid = self._candidates(leaves)
+		d2 = self._chord2(pos, qs[qi])
+		keep = valid & (d2 <= bound[qi][:, None])
+		qi = np.broadcast_to(qi[:, None], pos.shape)[keep]
+		pos = pos[keep]
+		order = np.lexsort((self.ids[pos], d2[keep], qi))
+		qi = qi[order]
+		rank = np.arange(len(qi)) - np.searchsorted(qi, rows)[qi]
+		nearest = rank < ks[qi]
+		return qi[nearest], pos[order][nearest]
+
+	def nearest_many(self, lat, lon, k, batch = 256):
+		"""
+		nearest for many degree coordinates, with one k for all or one per query.
+		Returns a list of (ids, distance_km) in query order.
+		"""
+		lat = np.asarray(lat, dtype = 'float64')
+		lon = np.asarray(lon, dtype = 'float64')
+		ks = np.minimum(np.broadcast_to(np.asarray(k, dtype = 'int64'), lat.shape), len(self))
+		results = [(self.ids[:0], np.empty(0))] * len(lat)
+		live = np.flatnonzero(ks >= 1)
+		live = live[np.argsort(ks[live], kind = 'mergesort')] # Similar k per batch, seeds scale with the largest.
+		for chunk in (live[i:i + batch] for i in range(0, len(live), batch)):
+			qi, pos = self.query_many(unit_vectors(lat[chunk], lon[chunk]), ks[chunk])
+			dist = haversine_km(lat[chunk][qi], lon[chunk][qi], self.lat[pos], self.lon[pos])
+			ids = self.ids[pos]
+			order = np.lexsort((ids, dist, qi))
+			bounds = np.cumsum(np.bincount(qi, minlength = len(chunk)))[:-1] # Short of k for a non-finite origin.
+			for i, ids_i, dist_i in zip(chunk.tolist(), np.split(ids[order], bounds), np.split(dist[order], bounds)):
+				results[i] = (ids_i, dist_i)
+		return results
@@ -6,12 +6,15 @@ import re
 import sys
 import time
 import random
+import asyncio
 import collections
 from warnings import filterwarnings
 
 import MySQLdb
 import cachetools.func
 
+import resultset
+
 try:
 	import logger
 except ImportError:
@@ -32,8 +35,19 @@ try:
 except ImportError:
 	pass
 
+try:
+	import aiomysql
+except ImportError:
+	pass
+
 filterwarnings('ignore', category = MySQLdb.Warning)
 
+
+def retry_delay(attempt, base = 0.1, cap = 10.0):
+	""" Seconds to wait before retry number attempt (from 0): jittered exponential backoff up to cap. """
+	return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
 class SQL:
 	""" Class to manage SQL connections. """
 	DEFAULT_DB = 'citysearch'
@@ -42,7 +56,8 @@ class SQL:
 			self, db = DEFAULT_DB, host = None, port = None, user = None,
 			passwd = None, autocommit = False, printsql = False,
 			use_unicode = True, charset = 'utf8', managed = True,
-			alchemy = False, connect = True, autoretry = True, retryperiod = 240):
+			alchemy = False, connect = True, autoretry = True, retryperiod = 240,
+			local_infile = False, connect_timeout = None):
 		self.db = db
 		self.host = host or os.getenv('SQL_HOST', 'mariadb')
 		self.user = user or os.getenv('SQL_USER', 'root')
@@ -55,6 +70,8 @@ class SQL:
 		self.use_unicode = use_unicode
 		self.charset = charset
 		self.managed = managed
+		self.local_infile = local_infile # Allow LOAD DATA LOCAL INFILE, see generate_load.
+		self.connect_timeout = connect_timeout # Seconds, else the driver's default.
 		self.alchemy = alchemy
 		self.alchemy_engine = None
 		if not connect:
@@ -63,7 +80,7 @@ class SQL:
 			self.conn = MySQLdb.connect(
 				host=self.host, port=self.port, user=self.user,
 				passwd=self.passwd, db=self.db, use_unicode = self.use_unicode,
-				charset = self.charset)
+				charset = self.charset, local_infile = int(self.local_infile), **self.timeouts())
 			self.conn.autocommit(self.autocommit)
 			self.conn.set_character_set(self.charset)
 			sqlsetup = "SET NAMES utf8; "
@@ -117,10 +134,15 @@ class SQL:
 			pass
 		self.conn = MySQLdb.connect(
 			host=self.host, port=self.port, user=self.user, passwd=self.passwd,
-			db=self.db, use_unicode=self.use_unicode, charset=self.charset)
+			db=self.db, use_unicode=self.use_unicode, charset=self.charset,
+			local_infile=int(self.local_infile), **self.timeouts())
 		self.conn.autocommit(self.autocommit)
 		self.execute("SET collation_connection = 'utf8_bin';")
 
+	def timeouts(self):
+		""" MySQLdb.connect timeout arguments. """
+		return {'connect_timeout': self.connect_timeout} if self.connect_timeout else {}
+
 	def ping(self):
 		self.conn.ping()
 
@@ -149,6 +171,7 @@ class SQL:
 		self.__printsql__(sqltxt, args)
 		started = time.time()
 		complete = False
+		attempt = 0
 		ex0 = Exception('SQL.execute exception')
 		while (not complete) and time.time() - started < self.retryperiod:
 			try:
@@ -157,9 +180,12 @@ class SQL:
 				lastrowid = curs.lastrowid
 				complete = True
 			except Exception as ex:
+				if not self.autoretry:
+					raise
 				ex0 = ex
 				print(ex)
-				time.sleep(10)
+				time.sleep(retry_delay(attempt))
+				attempt += 1
 			finally:
 				curs.close()
 		if not complete:
@@ -177,6 +203,7 @@ class SQL:
 		self.__printsql__(sqltxt, args)
 		started = time.time()
 		complete = False
+		attempt = 0
 		ex0 = Exception('SQL.executemany exception')
 		while (not complete) and time.time() - started < self.retryperiod:
 			try:
@@ -185,9 +212,12 @@ class SQL:
 				lastrowid = curs.lastrowid
 				complete = True
 			except Exception as ex:
+				if not self.autoretry:
+					raise
 				ex0 = ex
 				print(ex)
-				time.sleep(10)
+				time.sleep(retry_delay(attempt))
+				attempt += 1
 			finally:
 				curs.close()
 		if not complete:
@@ -197,21 +227,6 @@ class SQL:
 				raise TimeoutError('Max query time exceeded. SQL execution was not completed.')
 		return lastrowid
 
-	def _jsonify(self, table_rs):
-		"""A function to take tabular result set data with header and jsonify it."""
-		jout = []
-		header = table_rs[0]
-		for row_num in range(1, len(table_rs)):
-			jout.append({})
-			for col_num in range(len(header)):
-				val = table_rs[row_num][col_num]
-				try:
-					float(val)
-				except:
-					val = str(val)
-				jout[row_num-1][header[col_num]] = val
-		return jout
-
 	def callproc(self, sqltxt, args = ()):
 		"""
 		A method to execute a sql procedure 
@@ -234,12 +249,7 @@ class SQL:
 				if rsp is None:
 					break
 				rs = curs.fetchall()
-				if (header or jsonify) and curs.description is not None:
-					headr = [col_desc[0] for col_desc in curs.description]
-					rs = (tuple(headr),) + rs
-					if jsonify:
-						rs = self._jsonify(rs)
-				rsl += [rs]
+				rsl += [resultset.shape(rs, curs.description, header, jsonify)]
 		curs.close()
 		return rsl
 
@@ -330,12 +340,23 @@ class SQL:
 		"""
 		A function to return a MySQLdb result set in a Pandas DataFrame.
 		"""
-		self.__printsql__(sqltxt)
-		rs = self.fetchall(sqltxt, args, header = True)
-		rs = SQL.tuples2lists(rs)
-		if len(rs) == 0:
-			return pandas.DataFrame(columns = rs[0])
-		return pandas.DataFrame(rs[1:], columns = rs[0])
+		self.__printsql__(sqltxt, args)
+		curs = self.conn.cursor()
+		curs.execute(sqltxt, args)
+		rs = curs.fetchall()
+		curs.close()
+		return resultset.dataframe(rs, curs.description)
+
+	def fetchcolumns(self, sqltxt, args = None):
+		"""
+		A function to execute sql and return an ordered dict of column name to values.
+		"""
+		self.__printsql__(sqltxt, args)
+		curs = self.conn.cursor()
+		curs.execute(sqltxt, args)
+		rs = curs.fetchall()
+		curs.close()
+		return resultset.columns(rs, curs.description)
 
 	def fetchall(self, sqltxt, args = None, header = False, jsonify = False):
 		"""
@@ -346,12 +367,7 @@ class SQL:
 		curs.execute(sqltxt, args)
 		rs = curs.fetchall()
 		curs.close()
-		if header or jsonify:
-			headr = [col_desc[0] for col_desc in curs.description]
-			rs = (tuple(headr),) + rs
-			if jsonify:
-				rs = self._jsonify(rs)
-		return rs
+		return resultset.shape(rs, curs.description, header, jsonify)
 
 	def fetchone(self, sqltxt, args = None, header = False, jsonify = False):
 		"""
@@ -362,12 +378,10 @@ class SQL:
 		curs.execute(sqltxt, args)
 		rs = curs.fetchone()
 		curs.close()
-		if header or jsonify:
-			headr = [col_desc[0] for col_desc in curs.description]
-			rs = (tuple(headr),) + rs
-			if jsonify:
-				rs = self._jsonify(rs)
-		return rs
+		if rs is None or not (header or jsonify):
+			return rs
+		rs = resultset.shape((rs,), curs.description, header, jsonify)
+		return rs[0] if jsonify else rs
 
 	_singletons = {}
 	@staticmethod
@@ -411,6 +425,17 @@ class SQL:
 		return sqltxt+';\n'
 
 
+	@staticmethod
+	def generate_load(table_name, columns):
+		"""
+		Generate a LOAD DATA LOCAL INFILE statement taking the file path as its parameter,
+		for tab separated, backslash escaped utf-8 lines with \\N for nulls.
+		"""
+		sqltxt = 'LOAD DATA LOCAL INFILE %s INTO TABLE ' + table_name + ' CHARACTER SET utf8'
+		sqltxt += '\n (' + ','.join(columns) + ');\n'
+		return sqltxt
+
+
 	@staticmethod
 	def generate_select(table_name, columns):
 		""" Generate sql select statement. """
@@ -428,3 +453,263 @@ class SQL:
 		self.commit()
 		return lastrowid
 
+
+
+
+class PooledConnection:
+	""" An aiomysql connection with its pool health state. """
+
+	def __init__(self, conn):
+		self.conn = conn
+		self.created = time.time()
+		self.last_used = self.created
+		self.uses = 0
+		self.failures = 0
+		self.healthy = True
+
+	def state(self):
+		return {
+			'age': time.time() - self.created, 'idle': time.time() - self.last_used,
+			'uses': self.uses, 'failures': self.failures, 'healthy': self.healthy}
+
+
+class _Acquired:
+	""" Async context manager returning a pooled connection to its pool. """
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.pc = None
+
+	async def __aenter__(self):
+		self.pc = await self.pool.acquire()
+		return self.pc
+
+	async def __aexit__(self, exc_type, exc, tb):
+		if exc is not None and isinstance(exc, (aiomysql.OperationalError, aiomysql.InterfaceError)):
+			self.pc.healthy = False # Lost or broken connection, not a bad query.
+			self.pc.failures += 1
+		await self.pool.release(self.pc)
+
+
+class AsyncSQLPool:
+	"""
+	Asyncio native connection pool with the SQL fetch surface.
+	Connections are opened on demand up to maxsize, kept down to minsize,
+	pinged before reuse once idle for ping_interval seconds, and replaced
+	when they fail. Waiting for a free connection times out after timeout.
+	"""
+	DEFAULT_DB = SQL.DEFAULT_DB
+
+	def __init__(
+			self, db = DEFAULT_DB, host = None, port = None, user = None, passwd = None,
+			minsize = None, maxsize = None, timeout = None, ping_interval = 30,
+			charset = 'utf8', init_command = "SET collation_connection = 'utf8_bin';",
+			client_flag = 0, printsql = False):
+		self.connect_kwargs = {
+			'host': host or os.getenv('SQL_HOST', 'mariadb'),
+			'port': port or int(os.getenv('SQL_PORT', 3306)),
+			'user': user or os.getenv('SQL_USER', 'root'),
+			'password': passwd or os.getenv('SQL_PASS', 'citysearch123456'),
+			'db': db, 'charset': charset, 'autocommit': True,
+			'init_command': init_command, 'client_flag': client_flag}
+		self.minsize = minsize if minsize is not None else int(os.getenv('SQL_POOL_MIN', 2))
+		self.maxsize = maxsize or int(os.getenv('SQL_POOL_MAX', 16))
+		self.timeout = timeout or float(os.getenv('SQL_POOL_TIMEOUT', 10))
+		self.ping_interval = ping_interval
+		self.printsql = printsql
+		self._idle = collections.deque()
+		self._size = 0 # Open connections, idle or in use, plus those being opened.
+		self._cond = None
+		self.closed = False
+
+	async def start(self):
+		""" Open the minimum number of connections, call from the event loop. """
+		self._cond = asyncio.Condition()
+		pcs = [await self.acquire() for i in range(self.minsize)]
+		for pc in pcs:
+			await self.release(pc)
+		return self
+
+	async def _connect(self):
+		conn = await aiomysql.connect(**self.connect_kwargs)
+		return PooledConnection(conn)
+
+	async def _check(self, pc):
+		""" Health check before reuse. """
+		if not pc.healthy or pc.conn.closed:
+			return False
+		if time.time() - pc.last_used > self.ping_interval:
+			try:
+				await pc.conn.ping(reconnect = False)
+			except Exception:
+				pc.failures += 1
+				return False
+		return True
+
+	async def _discard(self, pc):
+		""" Close a connection and free its slot. """
+		if pc is not None:
+			pc.conn.close()
+		async with self._cond:
+			self._size -= 1
+			self._cond.notify()
+
+	async def _acquire(self):
+		while True:
+			async with self._cond:
+				while not self._idle and self._size >= self.maxsize:
+					await self._cond.wait()
+				pc = self._idle.pop() if self._idle else None
+				if pc is None:
+					self._size += 1
+			try: # Free the slot on errors and on acquire timeout cancellation.
+				if pc is None:
+					return await self._connect()
+				healthy = await self._check(pc)
+			except BaseException:
+				await asyncio.shield(self._discard(pc))
+				raise
+			if healthy:
+				return pc
+			await self._discard(pc)
+
+	async def acquire(self):
+		""" Get a healthy connection, raising asyncio.TimeoutError after timeout. """
+		if self.closed:
+			raise RuntimeError('AsyncSQLPool is closed.')
+		return await asyncio.wait_for(self._acquire(), self.timeout)
+
+	async def release(self, pc):
+		""" Return a connection to the idle set, or drop it if it is unhealthy. """
+		pc.last_used = time.time()
+		pc.uses += 1
+		if self.closed or not pc.healthy or pc.conn.closed:
+			await self._discard(pc)
+			return
+		async with self._cond:
+			self._idle.append(pc)
+			self._cond.notify()
+
+	def connection(self):
+		""" async with pool.connection() as pc: pc.conn is an aiomysql connection. """
+		return _Acquired(self)
+
+	async def close(self):
+		self.closed = True
+		while self._idle:
+			await self._discard(self._idle.pop())
+
+	def stats(self):
+		""" Pool occupancy and per idle connection health. """
+		return {
+			'size': self._size, 'idle': len(self._idle), 'minsize': self.minsize,
+			'maxsize': self.maxsize, 'connections': [pc.state() for pc in self._idle]}
+
+	def __printsql__(self, sqltxt, args = None):
+		if self.printsql:
+			msg = 'Executing SQL:\n%s' % sqltxt
+			if not args is None:
+				msg += '\n args = ' + str(args)
+			logger.info(msg)
+
+	async def execute(self, sqltxt, args = None):
+		"""
+		A method to execute a sql statement with no return result set.
+		"""
+		self.__printsql__(sqltxt, args)
+		async with self.connection() as pc:
+			async with pc.conn.cursor() as curs:
+				await curs.execute(sqltxt, args)
+				return curs.lastrowid
+
+	async def fetchall(self, sqltxt, args = None, header = False, jsonify = False):
+		"""
+		A function to execute sql and return a result set.
+		"""
+		self.__printsql__(sqltxt, args)
+		async with self.connection() as pc:
+			async with pc.conn.cursor() as curs:
+				await curs.execute(sqltxt, args)
+				rs = await curs.fetchall()
+				return resultset.shape(tuple(rs), curs.description, header, jsonify)
+
+	async def fetchone(self, sqltxt, args = None, header = False, jsonify = False):
+		"""
+		Gets one row from a sql statement.
+		"""
+		self.__printsql__(sqltxt, args)
+		async with self.connection() as pc:
+			async with pc.conn.cursor() as curs:
+				await curs.execute(sqltxt, args)
+				rs = await curs.fetchone()
+				if rs is None or not (header or jsonify):
+					return rs
+				rs = resultset.shape((rs,), curs.description, header, jsonify)
+				return rs[0] if jsonify else rs
+
+	async def iterall(self, sqltxt, args = None, size = 1000, jsonify = False):
+		"""
+		Stream a result set in chunks of up to size rows through an
+		unbuffered cursor, so the rows never sit in memory all at once.
+		"""
+		self.__printsql__(sqltxt, args)
+		async with self.connection() as pc:
+			async with pc.conn.cursor(aiomysql.SSCursor) as curs:
+				await curs.execute(sqltxt, args)
+				while True:
+					rs = await curs.fetchmany(size)
+					if not rs:
+						break
+					yield resultset.records(rs, curs.description) if jsonify else tuple(rs)
+
+	async def iterproc(self, sqltxt, args = (), size = 1000, jsonify = False):
+		"""
+		Stream a procedure's second result set, the one fetchproc returns
+		first, in chunks like iterall. Remaining result sets are drained.
+		"""
+		self.__printsql__(sqltxt, args)
+		async with self.connection() as pc:
+			async with pc.conn.cursor(aiomysql.SSCursor) as curs:
+				await curs.callproc(sqltxt, args)
+				await curs.fetchall() # Unbuffered sets are read to the end before moving on.
+				if await curs.nextset():
+					while True:
+						rs = await curs.fetchmany(size)
+						if not rs:
+							break
+						yield resultset.records(rs, curs.description) if jsonify else tuple(rs)
+				while await curs.nextset():
+					await curs.fetchall()
+
+	async def fetchbatch(self, statements):
+		"""
+		Run (sqltxt, args) statements in one multi-statement round trip and
+		return their result sets in order. The connections need the
+		CLIENT_MULTI_STATEMENTS client_flag.
+		"""
+		sqltxt = ';\n'.join(x[0] for x in statements)
+		args = tuple(arg for x in statements for arg in (x[1] or ()))
+		self.__printsql__(sqltxt, args)
+		rsl = []
+		async with self.connection() as pc:
+			async with pc.conn.cursor() as curs:
+				await curs.execute(sqltxt, args or None)
+				rsl += [tuple(await curs.fetchall() or ())]
+				while await curs.nextset():
+					rsl += [tuple(await curs.fetchall() or ())]
+		return rsl
+
+	async def fetchproc(self, sqltxt, args = (), header = False, jsonify = False):
+		"""
+		A method to execute a sql procedure and return results,
+		skipping the first result set like SQL.fetchproc.
+		"""
+		self.__printsql__(sqltxt, args)
+		rsl = []
+		async with self.connection() as pc:
+			async with pc.conn.cursor() as curs:
+				await curs.callproc(sqltxt, args)
+				while await curs.nextset():
+					rs = await curs.fetchall()
+					rsl += [resultset.shape(tuple(rs or ()), curs.description, header, jsonify)]
+		return rsl
@@ -0,0 +1,54 @@
+"""
+A module to report process memory from /proc.
+PSS splits shared pages evenly between the processes mapping them,
+so summing it over the workers gives their true combined footprint.
+"""
+
+import os
+import glob
+
+
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap')
+
+
+def memory(pid = 'self'):
+	""" Memory totals in kB for a process, from smaps_rollup or summed smaps. """
+	totals = dict.fromkeys(SMAPS_FIELDS, 0)
+	for name in ('smaps_rollup', 'smaps'):
+		path = '/proc/%s/%s' % (pid, name)
+		if not os.path.exists(path):
+			continue
+		with open(path) as fin:
+			for line in fin:
+				field, _, rest = line.partition(':')
+				if field in totals:
+					totals[field] += int(rest.split()[0])
+		break
+	totals['pid'] = os.getpid() if pid == 'self' else int(pid)
+	return totals
+
+
+def sibling_pids(exclude = ()):
+	""" Pids of the children of our parent process but exclude, i.e. the fellow workers. """
+	pids = set()
+	for path in glob.glob('/proc/%d/task/*/children' % os.getppid()):
+		try:
+			with open(path) as fin:
+				pids.update(int(x) for x in fin.read().split())
+		except OSError:
+			pass
+	return sorted(pids.difference(exclude)) or [os.getpid()]
+
+
+def workers_report(pids = None, exclude = ()):
+	""" Memory of every worker (default: our siblings but exclude) plus the sums across them. """
+	workers = []
+	for pid in pids or sibling_pids(exclude):
+		try:
+			workers.append(memory(pid))
+		except OSError:
+			pass # Worker exited between listing and reading.
+	return {
+		'workers': workers,
+		'total_rss_kb': sum(x['Rss'] for x in workers),
+		'total_pss_kb': sum(x['Pss'] for x in workers)}
@@ -0,0 +1,128 @@
+"""
+A module to cache query results between dataset reloads.
+Entries are keyed by endpoint, normalized arguments and dataset version,
+bounded by an LRU size limit plus a TTL, and counted for hits, misses,
+evictions and expirations.
+"""
+
+import os
+import inspect
+import asyncio
+import functools
+
+import cachetools
+
+
+
+class _CountingTTLCache(cachetools.TTLCache):
+	""" TTLCache counting its size-bound (LRU) evictions and TTL expirations. """
+
+	def __init__(self, maxsize, ttl):
+		super().__init__(maxsize, ttl)
+		self.evictions = 0
+		self.expirations = 0
+
+	def popitem(self):
+		item = super().popitem()
+		self.evictions += 1
+		return item
+
+	def _size(self):
+		return cachetools.Cache.currsize.fget(self) # TTLCache.currsize itself expires first.
+
+	def expire(self, *args, **kwargs):
+		size = self._size()
+		expired = super().expire(*args, **kwargs)
+		self.expirations += size - self._size()
+		return expired
+
+
+
+class ResultCache:
+	""" Size-bounded LRU + TTL cache of results for one dataset version. """
+
+	def __init__(self, maxsize = None, ttl = None, version = 0):
+		self.maxsize = maxsize or int(os.getenv('CITYSEARCH_CACHE_SIZE', 10000))
+		self.ttl = ttl or float(os.getenv('CITYSEARCH_CACHE_TTL', 3600))
+		self.cache = _CountingTTLCache(self.maxsize, self.ttl)
+		self.version = version
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	def key(self, endpoint, *args):
+		return (endpoint, self.version) + args
+
+	def get(self, key):
+		""" Returns (hit, value). """
+		try:
+			value = self.cache[key]
+		except KeyError:
+			self.misses += 1
+			return False, None
+		self.hits += 1
+		return True, value
+
+	def put(self, key, value):
+		if key[1] == self.version: # Drop results computed against a replaced dataset.
+			self.cache[key] = value
+
+	def invalidate(self, version):
+		""" Switch to a new dataset version, dropping every cached result. """
+		self.version = version
+		self.cache.clear()
+		self.invalidations += 1
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+			'version': self.version, 'size': len(self.cache), 'maxsize': self.maxsize, 'ttl': self.ttl,
+			'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+			'evictions': self.cache.evictions, 'expirations': self.cache.expirations,
+			'invalidations': self.invalidations}
+
+
+
+def cached(endpoint, **normalizers):
+	"""
+	Decorate a method of an object with a ResultCache at self.cache.
+	Arguments are bound to the signature with defaults applied, so calls
+	spelled differently share one entry, and normalizers map argument names
+	to functions giving their key form, e.g. k = int. Works on coroutines too.
+	"""
+	def decorator(fn):
+		signature = inspect.signature(fn)
+
+		def cache_key(self, args, kwargs):
+			bound = signature.bind(self, *args, **kwargs)
+			bound.apply_defaults()
+			parts = []
+			for name, value in list(bound.arguments.items())[1:]:
+				if name in normalizers:
+					try:
+						value = normalizers[name](value)
+					except (TypeError, ValueError):
+						pass # Left as given, the method reports the bad argument.
+				parts.append(value)
+			return self.cache.key(endpoint, *parts)
+
+		if asyncio.iscoroutinefunction(fn):
+			@functools.wraps(fn)
+			async def wrapper(self, *args, **kwargs):
+				key = cache_key(self, args, kwargs)
+				hit, rs = self.cache.get(key)
+				if not hit:
+					rs = await fn(self, *args, **kwargs)
+					self.cache.put(key, rs)
+				return rs
+		else:
+			@functools.wraps(fn)
+			def wrapper(self, *args, **kwargs):
+				key = cache_key(self, args, kwargs)
+				hit, rs = self.cache.get(key)
+				if not hit:
+					rs = fn(self, *args, **kwargs)
+					self.cache.put(key, rs)
+				return rs
+		return wrapper
+	return decorator
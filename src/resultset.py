@@ -0,0 +1,112 @@
+"""
+A module to decode MySQL protocol result sets, shared by SQL, SphinxQL
+and the async pools. One converter is picked per column from the
+cursor.description type code, so cells are never probed one by one.
+"""
+
+import collections
+import datetime
+import decimal
+
+try:
+	import pandas as pd
+except ImportError:
+	pass
+
+
+# MySQL protocol column type codes (the same for MySQLdb and pymysql/aiomysql):
+DECIMAL, TINY, SHORT, LONG, FLOAT, DOUBLE, NULL, TIMESTAMP = 0, 1, 2, 3, 4, 5, 6, 7
+LONGLONG, INT24, DATE, TIME, DATETIME, YEAR, NEWDATE, VARCHAR, BIT = 8, 9, 10, 11, 12, 13, 14, 15, 16
+JSON, NEWDECIMAL, ENUM, SET = 245, 246, 247, 248
+TINY_BLOB, MEDIUM_BLOB, LONG_BLOB, BLOB, VAR_STRING, STRING, GEOMETRY = 249, 250, 251, 252, 253, 254, 255
+
+NATIVE = {TINY, SHORT, LONG, LONGLONG, INT24, YEAR, FLOAT, DOUBLE, NULL} # Already int, float or None.
+NUMERIC = {DECIMAL, NEWDECIMAL}
+TEMPORAL = {TIMESTAMP, DATE, TIME, DATETIME, NEWDATE}
+
+
+
+def text(val):
+	""" str of a text or blob value, utf-8 decoding bytes. """
+	if isinstance(val, (bytes, bytearray)):
+		return val.decode('utf-8', 'replace')
+	return str(val)
+
+
+def number(val):
+	""" float of a DECIMAL value. """
+	return float(val) if isinstance(val, decimal.Decimal) else float(text(val))
+
+
+def bits(val):
+	""" int of a BIT value. """
+	return int.from_bytes(val, 'big') if isinstance(val, (bytes, bytearray)) else int(val)
+
+
+def temporal(val):
+	""" str of a date, time or datetime value, as the server writes it. """
+	if isinstance(val, datetime.timedelta): # TIME comes back as a timedelta.
+		secs = int(val.total_seconds())
+		sign = '-' if secs < 0 else ''
+		secs = abs(secs)
+		return '%s%02d:%02d:%02d' % (sign, secs // 3600, secs // 60 % 60, secs % 60)
+	return text(val)
+
+
+def converter(type_code):
+	""" JSON friendly converter for a column type, None when values are already. """
+	if type_code in NATIVE:
+		return None
+	if type_code in NUMERIC:
+		return number
+	if type_code == BIT:
+		return bits
+	if type_code in TEMPORAL:
+		return temporal
+	return text
+
+
+
+def names(description):
+	return [col_desc[0] for col_desc in description]
+
+
+def decode(rows, description):
+	""" Converted columns of a result set, as a list of lists. """
+	cols = [list(col) for col in zip(*rows)] if rows else [[] for col_desc in description]
+	for i, col_desc in enumerate(description):
+		conv = converter(col_desc[1])
+		if conv is text: # Usually already str, decoded by the driver.
+			cols[i] = [x if x is None or type(x) is str else text(x) for x in cols[i]]
+		elif conv is not None:
+			cols[i] = [None if x is None else conv(x) for x in cols[i]]
+	return cols
+
+
+def records(rows, description):
+	""" Result set rows as dicts of JSON friendly values. """
+	keys = names(description)
+	if all(converter(col_desc[1]) is None for col_desc in description):
+		return [dict(zip(keys, row)) for row in rows]
+	return [dict(zip(keys, row)) for row in zip(*decode(rows, description))]
+
+
+def columns(rows, description):
+	""" Result set as an ordered dict of column name to value list. """
+	return collections.OrderedDict(zip(names(description), decode(rows, description)))
+
+
+def dataframe(rows, description):
+	""" Result set as a pandas DataFrame, built column-wise. """
+	df = pd.DataFrame(dict(enumerate(decode(rows, description))), columns = range(len(description)))
+	df.columns = names(description)
+	return df
+
+
+def shape(rows, description, header = False, jsonify = False):
+	""" Rows as fetched, with a header row prepended, or as JSON friendly dicts. """
+	if description is None or not (header or jsonify):
+		return rows
+	if jsonify:
+		return records(rows, description)
+	return (tuple(names(description)),) + tuple(rows)
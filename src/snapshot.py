@@ -0,0 +1,235 @@
+"""
+A module for the memory-mapped columnar city snapshot.
+Numeric columns are fixed-width .npy files, string columns are a NUL
+terminated utf-8 arena plus int64 offsets, and the geo indexes are stored
+as their raw arrays, so a warm start maps files instead of parsing csv.
+"""
+
+import os
+import json
+import shutil
+import collections
+
+import numpy as np
+
+from geoindex import GeoIndex
+
+
+SNAPSHOT_VERSION = 5
+
+
+
+def splice(offsets, arena, positions, values):
+	"""
+	Replace (or append past the end) the items at sorted positions of an
+	offset-encoded arena with the bytes values, copying the untouched runs
+	between them as whole slices. Returns the new (offsets, arena).
+	"""
+	n = len(offsets) - 1
+	size = max([n] + [p + 1 for p in positions])
+	lengths = np.zeros(size, dtype = 'int64')
+	lengths[:n] = np.diff(offsets)
+	pieces = []
+	prev = 0
+	for p, val in zip(positions, values):
+		end = min(p, n)
+		if prev < end:
+			pieces.append(arena[offsets[prev]:offsets[end]])
+		prev = max(prev, min(p + 1, n))
+		pieces.append(np.frombuffer(val, dtype = 'uint8'))
+		lengths[p] = len(val)
+	if prev < n:
+		pieces.append(arena[offsets[prev]:offsets[n]])
+	offsets = np.zeros(size + 1, dtype = 'int64')
+	np.cumsum(lengths, out = offsets[1:])
+	arena = np.concatenate(pieces) if pieces else np.empty(0, dtype = 'uint8')
+	return offsets, arena.astype('uint8', copy = False)
+
+
+
+class StringColumn:
+	""" Offset-encoded utf-8 strings with a null mask. """
+
+	def __init__(self, offsets, arena, nulls):
+		self.offsets = np.asarray(offsets) # Plain ndarray views, memmap item access is slow.
+		self.arena = np.asarray(arena)
+		self.nulls = np.asarray(nulls)
+		self.buf = memoryview(self.arena)
+
+	def __len__(self):
+		return len(self.nulls)
+
+	def __getitem__(self, i):
+		if self.nulls[i]:
+			return None
+		return str(self.buf[self.offsets[i]:self.offsets[i+1]-1], 'utf-8')
+
+	def tolist(self, start = 0, stop = None):
+		""" Decode the values from start to stop (default every value) in one pass over their arena. """
+		stop = len(self) if stop is None else stop
+		vals = str(self.buf[self.offsets[start]:self.offsets[stop]], 'utf-8').split('\0')[:-1]
+		for i in np.flatnonzero(self.nulls[start:stop]):
+			vals[i] = None
+		return vals
+
+	@classmethod
+	def from_values(cls, values):
+		""" Encode a sequence of str or None. """
+		encoded = [b'' if x is None else str(x).encode('utf-8') for x in values]
+		nulls = np.fromiter((x is None for x in values), dtype = 'bool', count = len(encoded))
+		offsets = np.zeros(len(encoded) + 1, dtype = 'int64')
+		np.cumsum([len(x) + 1 for x in encoded], out = offsets[1:])
+		arena = np.frombuffer(b''.join(x + b'\0' for x in encoded), dtype = 'uint8')
+		return cls(offsets, arena, nulls)
+
+	@classmethod
+	def concat(cls, parts):
+		""" Join StringColumns end to end. """
+		if not parts:
+			return cls.from_values([])
+		sizes = np.cumsum([0] + [len(part.arena) for part in parts[:-1]])
+		offsets = np.concatenate([parts[0].offsets[:1]] + [part.offsets[1:] + size for part, size in zip(parts, sizes)])
+		arena = np.concatenate([part.arena for part in parts])
+		nulls = np.concatenate([part.nulls for part in parts])
+		return cls(offsets, arena, nulls)
+
+	def patch(self, positions, values):
+		""" A copy with the values at sorted positions replaced, positions past the end append. """
+		encoded = [b'\0' if x is None else str(x).encode('utf-8') + b'\0' for x in values]
+		offsets, arena = splice(self.offsets, self.arena, positions, encoded)
+		nulls = np.zeros(len(offsets) - 1, dtype = 'bool')
+		nulls[:len(self)] = self.nulls
+		nulls[positions] = [x is None for x in values]
+		return StringColumn(offsets, arena, nulls)
+
+	def save(self, path, name):
+		np.save(os.path.join(path, name + '.offsets.npy'), self.offsets)
+		np.save(os.path.join(path, name + '.nulls.npy'), self.nulls)
+		self.arena.tofile(os.path.join(path, name + '.arena'))
+
+	@classmethod
+	def load(cls, path, name):
+		offsets = np.load(os.path.join(path, name + '.offsets.npy'), mmap_mode = 'r')
+		nulls = np.load(os.path.join(path, name + '.nulls.npy'), mmap_mode = 'r')
+		arena_path = os.path.join(path, name + '.arena')
+		if os.path.getsize(arena_path) == 0:
+			arena = np.empty(0, dtype = 'uint8')
+		else:
+			arena = np.memmap(arena_path, dtype = 'uint8', mode = 'r')
+		return cls(offsets, arena, nulls)
+
+
+
+def save_indexes(path, name, indexes):
+	"""
+	Save a dict of geo indexes as one set of concatenated arrays.
+	Leaf bounds stay relative to their own index, so loading is slicing.
+	"""
+	keys = list(indexes.keys())
+	for attr in GeoIndex.ARRAYS:
+		parts = [getattr(indexes[key], attr) for key in keys]
+		np.save(os.path.join(path, '%s.%s.npy' % (name, attr)), np.concatenate(parts))
+	npoints = np.cumsum([0] + [len(indexes[key].ids) for key in keys])
+	nleaves = np.cumsum([0] + [len(indexes[key].lo) for key in keys])
+	np.save(os.path.join(path, name + '.npoints.npy'), npoints)
+	np.save(os.path.join(path, name + '.nleaves.npy'), nleaves)
+	return keys
+
+
+def load_indexes(path, name, keys):
+	""" Memory-map geo indexes written by save_indexes. """
+	arrays = {}
+	for attr in GeoIndex.ARRAYS:
+		arrays[attr] = np.asarray(np.load(os.path.join(path, '%s.%s.npy' % (name, attr)), mmap_mode = 'r'))
+	npoints = np.load(os.path.join(path, name + '.npoints.npy'))
+	nleaves = np.load(os.path.join(path, name + '.nleaves.npy'))
+	indexes = {}
+	for i, key in enumerate(keys):
+		parts = {}
+		for attr, arr in arrays.items():
+			bounds = nleaves if attr in GeoIndex.LEAF_ARRAYS else npoints
+			parts[attr] = arr[bounds[i]:bounds[i+1]]
+		indexes[key] = GeoIndex.from_arrays(parts)
+	return indexes
+
+
+
+def snapshot_dir(root):
+	""" Directory of the current snapshot version. """
+	return os.path.join(root, 'snapshot_v%d' % SNAPSHOT_VERSION)
+
+
+def write(root, fingerprint, columns, indexes, arrays = None, meta = None):
+	"""
+	Write a snapshot under root, replacing any previous one atomically.
+	columns: ordered dict of name -> numpy array or StringColumn.
+	indexes: dict of name -> dict of geo indexes.
+	arrays: dict of name -> numpy array, e.g. lookup index orders.
+	meta: JSON friendly dict kept in the manifest, e.g. applied updates.
+	"""
+	final = snapshot_dir(root)
+	tmp = '%s.tmp%d' % (final, os.getpid())
+	shutil.rmtree(tmp, ignore_errors = True)
+	os.makedirs(tmp)
+	manifest = {'version': SNAPSHOT_VERSION, 'fingerprint': fingerprint, 'columns': [], 'indexes': {}, 'arrays': []}
+	manifest['meta'] = meta or {}
+	for name, col in columns.items():
+		if isinstance(col, StringColumn):
+			col.save(tmp, name)
+			manifest['columns'].append({'name': name, 'kind': 'string'})
+		else:
+			np.save(os.path.join(tmp, name + '.npy'), np.asarray(col))
+			manifest['columns'].append({'name': name, 'kind': 'numeric'})
+		manifest['rows'] = len(col)
+	for name, group in indexes.items():
+		manifest['indexes'][name] = save_indexes(tmp, name, group)
+	for name, arr in (arrays or {}).items():
+		np.save(os.path.join(tmp, 'array.%s.npy' % name), arr)
+		manifest['arrays'].append(name)
+	with open(os.path.join(tmp, 'manifest.json'), 'w') as fout:
+		json.dump(manifest, fout)
+	shutil.rmtree(final, ignore_errors = True)
+	os.rename(tmp, final)
+	return final
+
+
+def remove(root):
+	""" Remove the current snapshot, if any. """
+	shutil.rmtree(snapshot_dir(root), ignore_errors = True)
+
+
+def read_manifest(root):
+	""" The current snapshot's manifest, or None. """
+	try:
+		with open(os.path.join(snapshot_dir(root), 'manifest.json')) as fin:
+			return json.load(fin)
+	except (OSError, ValueError):
+		return None
+
+
+def current(root, fingerprint):
+	""" Whether the snapshot under root is of this version and built from the fingerprinted source. """
+	manifest = read_manifest(root)
+	return manifest is not None and manifest.get('version') == SNAPSHOT_VERSION and manifest.get('fingerprint') == fingerprint
+
+
+def read(root, fingerprint):
+	"""
+	Memory-map a snapshot, returning (columns, indexes, arrays, meta), or None
+	when it is missing, from another version, or built from other source data.
+	"""
+	path = snapshot_dir(root)
+	manifest = read_manifest(root)
+	if manifest is None or manifest.get('version') != SNAPSHOT_VERSION or manifest.get('fingerprint') != fingerprint:
+		return None
+	columns = collections.OrderedDict()
+	for col in manifest['columns']:
+		if col['kind'] == 'string':
+			columns[col['name']] = StringColumn.load(path, col['name'])
+		else:
+			columns[col['name']] = np.asarray(np.load(os.path.join(path, col['name'] + '.npy'), mmap_mode = 'r'))
+	indexes = {name: load_indexes(path, name, keys) for name, keys in manifest['indexes'].items()}
+	arrays = {}
+	for name in manifest['arrays']:
+		arrays[name] = np.asarray(np.load(os.path.join(path, 'array.%s.npy' % name), mmap_mode = 'r'))
+	return columns, indexes, arrays, manifest.get('meta', {})
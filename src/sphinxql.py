@@ -7,6 +7,9 @@ from warnings import filterwarnings
 
 import MySQLdb
 
+import resultset
+from mariadb import AsyncSQLPool, retry_delay
+
 try:
 	import logger
 except ImportError:
@@ -14,6 +17,11 @@ except ImportError:
 
 filterwarnings('ignore', category = MySQLdb.Warning)
 
+MULTI_STATEMENTS = 1 << 16 # CLIENT_MULTI_STATEMENTS protocol flag.
+MAX_BATCH_QUERIES = int(os.getenv('SPHINX_MAX_BATCH', 32)) # searchd max_batch_queries.
+MAX_PACKET_SIZE = int(os.getenv('SPHINX_MAX_PACKET', 8 << 20)) # searchd max_packet_size.
+ESCAPED = ('\\', "'", '"', '\n', '\r', '\0', '\x1a') # Characters the driver escapes in string literals.
+
 class SphinxQL:
 	""" Class to manage SphinxQL connections. """
 	DEFAULT_DB = 'rt'
@@ -22,7 +30,7 @@ class SphinxQL:
 			self, db = DEFAULT_DB, host = None, port = None,
 			autocommit = False, printsql = False,
 			use_unicode = True, charset = 'utf8', managed = True,
-			autoretry = True, retryperiod = 240):
+			autoretry = True, retryperiod = 240, connect_timeout = None):
 		self.db = db
 		self.host = host or os.getenv('SQL_HOST', 'sphinx')
 		self.port = port or int(os.getenv('SQL_PORT', 9306))
@@ -33,9 +41,14 @@ class SphinxQL:
 		self.use_unicode = use_unicode
 		self.charset = charset
 		self.managed = managed
+		self.connect_timeout = connect_timeout # Seconds, else the driver's default.
+		self.connect()
+
+	def connect(self):
+		""" Open the searchd connection and run the session setup. """
 		self.conn = MySQLdb.connect(
 			host=self.host, port=self.port,
-			use_unicode = self.use_unicode, charset = self.charset)
+			use_unicode = self.use_unicode, charset = self.charset, **self.timeouts())
 		self.conn.autocommit(self.autocommit)
 		self.conn.set_character_set(self.charset)
 		sqlsetup = "SET NAMES utf8; "
@@ -44,6 +57,9 @@ class SphinxQL:
 		sqlsetup += "SET collation_connection = 'utf8_bin'; "
 		self.execute(sqlsetup)
 
+	def timeouts(self):
+		""" MySQLdb.connect timeout arguments. """
+		return {'connect_timeout': self.connect_timeout} if self.connect_timeout else {}
 
 	def __del__(self):
 		try:
@@ -82,11 +98,7 @@ class SphinxQL:
 			self.conn.close()
 		except:
 			pass
-		self.conn = MySQLdb.connect(
-			host=self.host, port=self.port, user=self.user, passwd=self.passwd,
-			db=self.db, use_unicode=self.use_unicode, charset=self.charset)
-		self.conn.autocommit(self.autocommit)
-		self.execute("SET collation_connection = 'utf8_bin';")
+		self.connect()
 
 	def ping(self):
 		self.conn.ping()
@@ -116,6 +128,7 @@ class SphinxQL:
 		self.__printsql__(sqltxt, args)
 		started = time.time()
 		complete = False
+		attempt = 0
 		ex0 = Exception('SphinxQL.execute exception')
 		while (not complete) and time.time() - started < self.retryperiod:
 			try:
@@ -125,9 +138,12 @@ class SphinxQL:
 				curs.close()
 				complete = True
 			except Exception as ex:
+				if not self.autoretry:
+					raise
 				ex0 = ex
 				print(ex)
-				time.sleep(10)
+				time.sleep(retry_delay(attempt))
+				attempt += 1
 		if not complete:
 			if ex0:
 				raise ex0
@@ -143,6 +159,7 @@ class SphinxQL:
 		self.__printsql__(sqltxt, args)
 		started = time.time()
 		complete = False
+		attempt = 0
 		ex0 = Exception('SphinxQL.executemany exception')
 		while (not complete) and time.time() - started < self.retryperiod:
 			try:
@@ -152,9 +169,12 @@ class SphinxQL:
 				curs.close()
 				complete = True
 			except Exception as ex:
+				if not self.autoretry:
+					raise
 				ex0 = ex
 				print(ex)
-				time.sleep(10)
+				time.sleep(retry_delay(attempt))
+				attempt += 1
 		if not complete:
 			if ex0:
 				raise ex0
@@ -256,27 +276,23 @@ class SphinxQL:
 		"""
 		A function to return a MySQLdb result set in a Pandas DataFrame.
 		"""
-		self.__printsql__(sqltxt)
-		rs = self.fetchall(sqltxt, args, header = True)
-		rs = SphinxQL.tuples2lists(rs)
-		if len(rs) == 0:
-			return pandas.DataFrame(columns = rs[0])
-		return pandas.DataFrame(rs[1:], columns = rs[0])
-
-	def _jsonify(self, table_rs):
-		"""A function to take tabular result set data with header and jsonify it."""
-		jout = []
-		header = table_rs[0]
-		for row_num in range(1, len(table_rs)):
-			jout.append({})
-			for col_num in range(len(header)):
-				val = table_rs[row_num][col_num]
-				try:
-					float(val)
-				except:
-					val = str(val)
-				jout[row_num-1][header[col_num]] = val
-		return jout
+		self.__printsql__(sqltxt, args)
+		curs = self.conn.cursor()
+		curs.execute(sqltxt, args)
+		rs = curs.fetchall()
+		curs.close()
+		return resultset.dataframe(rs, curs.description)
+
+	def fetchcolumns(self, sqltxt, args = None):
+		"""
+		A function to execute sql and return an ordered dict of column name to values.
+		"""
+		self.__printsql__(sqltxt, args)
+		curs = self.conn.cursor()
+		curs.execute(sqltxt, args)
+		rs = curs.fetchall()
+		curs.close()
+		return resultset.columns(rs, curs.description)
 
 	def fetchall(self, sqltxt, args = None, header = False, jsonify = False):
 		"""
@@ -287,12 +303,7 @@ class SphinxQL:
 		curs.execute(sqltxt, args)
 		rs = curs.fetchall()
 		curs.close()
-		if header or jsonify:
-			headr = [col_desc[0] for col_desc in curs.description]
-			rs = (tuple(headr),) + rs
-			if jsonify:
-				rs = self._jsonify(rs)
-		return rs
+		return resultset.shape(rs, curs.description, header, jsonify)
 
 	def fetchone(self, sqltxt, args = None, header = False, jsonify = False):
 		"""
@@ -303,12 +314,26 @@ class SphinxQL:
 		curs.execute(sqltxt, args)
 		rs = curs.fetchone()
 		curs.close()
-		if header or jsonify:
-			headr = [col_desc[0] for col_desc in curs.description]
-			rs = (tuple(headr),) + rs
-			if jsonify:
-				rs = self._jsonify(rs)
-		return rs
+		if rs is None or not (header or jsonify):
+			return rs
+		rs = resultset.shape((rs,), curs.description, header, jsonify)
+		return rs[0] if jsonify else rs
+
+	def fetchbatch(self, statements):
+		"""
+		Run (sqltxt, args) statements in one multi-statement round trip and
+		return their result sets in order, at most MAX_BATCH_QUERIES of them.
+		"""
+		sqltxt = ';\n'.join(x[0] for x in statements)
+		args = tuple(arg for x in statements for arg in (x[1] or ()))
+		self.__printsql__(sqltxt, args)
+		curs = self.conn.cursor()
+		curs.execute(sqltxt, args or None)
+		rsl = [curs.fetchall()]
+		while curs.nextset():
+			rsl += [curs.fetchall()]
+		curs.close()
+		return rsl
 
 	_singletons = {}
 	@staticmethod
@@ -351,6 +376,39 @@ class SphinxQL:
 		return sqltxt+';\n'
 
 
+	@staticmethod
+	def literal_size(value):
+		""" Upper bound on the bytes of a value as an escaped SphinxQL literal. """
+		if isinstance(value, str):
+			return len(value.encode('utf-8')) + sum(value.count(c) for c in ESCAPED) + 2
+		return len(str(value))
+
+	@staticmethod
+	def generate_insert_batches(table_name, rows, verb = 'INSERT', max_packet = MAX_PACKET_SIZE):
+		"""
+		Generate multi-row INSERT (or REPLACE) statements with their args,
+		each as many rows as fit in a searchd packet of max_packet bytes.
+		"""
+		head = verb + ' INTO ' + table_name + ' VALUES '
+		budget = max_packet - len(head) - 1024 # Headroom for the packet header.
+		batch, size = [], 0
+		for row in rows:
+			row_size = sum(SphinxQL.literal_size(x) for x in row) + len(row) + 2
+			if batch and size + row_size > budget:
+				yield SphinxQL.batch_statement(head, batch)
+				batch, size = [], 0
+			batch.append(row)
+			size += row_size
+		if batch:
+			yield SphinxQL.batch_statement(head, batch)
+
+	@staticmethod
+	def batch_statement(head, rows):
+		""" One multi-row statement and its flattened args. """
+		values = ','.join('(' + ','.join(['%s'] * len(row)) + ')' for row in rows)
+		return head + values, tuple(x for row in rows for x in row)
+
+
 	@staticmethod
 	def generate_select(table_name, columns):
 		""" Generate sql select statement. """
@@ -358,3 +416,43 @@ class SphinxQL:
 		sqltxt += '\nFROM %s;\n' % table_name
 		return sqltxt
 
+
+
+
+class AsyncSphinxQLPool(AsyncSQLPool):
+	"""
+	Bounded, health-checked asyncio pool of searchd connections.
+	The session setup statements run once per connection, not per query,
+	and connections allow multi-statement batches for fetchbatch.
+	Keep workers * maxsize under searchd's max_children.
+	"""
+	SETUP = (
+		"SET NAMES utf8",
+		"SET CHARACTER SET utf8",
+		"SET character_set_connection = utf8",
+		"SET collation_connection = 'utf8_bin'")
+
+	def __init__(
+			self, host = None, port = None, minsize = None, maxsize = None,
+			timeout = None, ping_interval = 30, printsql = False):
+		super().__init__(
+			db = None, minsize = minsize if minsize is not None else int(os.getenv('SPHINX_POOL_MIN', 1)),
+			maxsize = maxsize or int(os.getenv('SPHINX_POOL_MAX', 4)),
+			timeout = timeout or float(os.getenv('SPHINX_POOL_TIMEOUT', 10)),
+			ping_interval = ping_interval, init_command = None, client_flag = MULTI_STATEMENTS,
+			printsql = printsql)
+		self.connect_kwargs.update({
+			'host': host or os.getenv('SQL_HOST', 'sphinx'),
+			'port': port or int(os.getenv('SQL_PORT', 9306)),
+			'user': '', 'password': ''})
+
+	async def _connect(self):
+		pc = await super()._connect()
+		try:
+			async with pc.conn.cursor() as curs:
+				for sqltxt in self.SETUP:
+					await curs.execute(sqltxt)
+		except BaseException:
+			pc.conn.close()
+			raise
+		return pc
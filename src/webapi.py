@@ -1,19 +1,221 @@
 #!/usr/bin/env python3
 
+import gc
 import os
+import signal
+import asyncio
+import inspect
+import threading
+import multiprocessing
+from json import dumps
 
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, raw, stream
 
 import logger
-from mariadb import SQL
-from citysearch import CityAPI
+import procstats
+import snapshot
+from citysearch import CityAPI, DataLoader, BATCH_MAX, DATASET
 
 
-cityapi = CityAPI()
+WORKERS = 4 * os.cpu_count()
+PRELOAD = os.getenv('CITYSEARCH_PRELOAD', '1') != '0'
+SNAPSHOT_POLL = float(os.getenv('CITYSEARCH_SNAPSHOT_POLL', 60)) # Seconds between delta update checks.
+READY_POLL = 1 # Seconds between snapshot checks until the dataset is loaded.
+WITHOUT_DATASET = ('hello', 'count', 'live', 'ready', 'memory', 'cache') # Endpoints served before it is.
+BOOTSTRAP_FAILED = multiprocessing.Event() # Set when the bootstrap process died without a snapshot, see /live.
+BOOTSTRAP_PIDS = [] # The bootstrap process, a sibling of the workers left out of /memory.
+
+def build():
+	""" Cold start bootstrap process: load the databases and write the city snapshot. """
+	try:
+		timer = CityAPI.build_snapshot()
+		logger.info('Bootstrap timing report:\n' + timer.report())
+	except Exception as ex:
+		logger.exception(ex, 'Bootstrap failed:')
+		raise
+
+
+def watch_bootstrap(process):
+	"""
+	Wait for the bootstrap process. If it dies without writing a snapshot
+	the workers would wait for one forever: /live fails from then on and
+	the master stops, for the container's restart policy to start over.
+	"""
+	process.join()
+	if process.exitcode != 0 or not DataLoader().has_snapshot():
+		logger.info('Bootstrap process exited with code %s and no snapshot, stopping.' % process.exitcode)
+		BOOTSTRAP_FAILED.set()
+		os.kill(os.getpid(), signal.SIGTERM)
+
+
+def databases_current(dl):
+	""" Whether the databases hold the data of the snapshot, assumed if they do not answer at once. """
+	try:
+		deltas = snapshot.read_manifest(dl.dlpath())['meta'].get('deltas', [])
+		return dl.databases_hold(dl.load_state(deltas))
+	except Exception as ex:
+		logger.info('Database check failed, keeping the snapshot: %s' % ex)
+		return True
+
+
+def preload():
+	"""
+	Build the city cache once before the workers fork.
+	The store is pointer-free numpy and mmap pages, and freezing the gc
+	keeps collections from touching (and so copying) inherited objects.
+	On a cold start a bootstrap process builds the snapshot instead, while
+	the workers serve WITHOUT_DATASET endpoints and map it once written.
+	A snapshot whose data the databases do not hold (e.g. recreated without
+	their volumes) is discarded for a cold start too.
+	"""
+	dl = DataLoader()
+	if dl.has_snapshot() and not databases_current(dl):
+		logger.info('The databases do not hold the snapshot data, reloading them.')
+		snapshot.remove(dl.dlpath())
+	if not dl.has_snapshot():
+		process = multiprocessing.Process(target = build, name = 'bootstrap', daemon = True)
+		process.start()
+		BOOTSTRAP_PIDS.append(process.pid)
+		threading.Thread(target = watch_bootstrap, args = (process,), name = 'bootstrap_watch', daemon = True).start()
+		return None
+	if not PRELOAD:
+		return None
+	api = CityAPI()
+	gc.collect()
+	if hasattr(gc, 'freeze'):
+		gc.freeze()
+	return api
+
+
+def respond(rs):
+	""" Send pre-encoded JSON bytes as they are, anything else through json. """
+	if isinstance(rs, bytes):
+		return raw(rs, content_type = 'application/json')
+	return json(rs)
+
+
+async def write(response, data):
+	""" Streaming write, a coroutine in newer sanic releases. """
+	rv = response.write(data)
+	if inspect.isawaitable(rv):
+		await rv
+
+
+def ndjson(rs):
+	""" One NDJSON line, from pre-encoded JSON bytes or a plain object. """
+	if isinstance(rs, bytes):
+		return rs + b'\n'
+	return dumps(rs).encode('utf-8') + b'\n'
+
+
+def fields_arg(req):
+	""" Optional comma separated field projection, e.g. fields=name,latitude,longitude. """
+	if 'fields' in req.args:
+		return [x for x in req.args['fields'][0].split(',') if x]
+	return None
+
+
+def stream_arg(req):
+	""" Streaming mode from query parameter stream: ndjson, json (one chunked array) or None. """
+	if 'stream' in req.args and req.args['stream'][0] in ('ndjson', 'json'):
+		return req.args['stream'][0]
+	return None
+
+
+def stream_rows(chunks, mode):
+	"""
+	Stream an async iterator of encoded row chunks as NDJSON lines or as
+	one JSON array, writing each chunk as soon as it is produced.
+	"""
+	async def streaming(response):
+		first = True
+		async for rows in chunks:
+			if not rows:
+				continue
+			if mode == 'ndjson':
+				await write(response, b'\n'.join(rows) + b'\n')
+			else:
+				await write(response, (b'[' if first else b',') + b','.join(rows))
+			first = False
+		if mode != 'ndjson':
+			await write(response, b'[]' if first else b']')
+
+	content_type = 'application/x-ndjson' if mode == 'ndjson' else 'application/json'
+	return stream(streaming, content_type = content_type)
+
+
+cityapi = preload()
 webapi = Sanic()
 
 
+@webapi.listener('before_server_start')
+async def load_cityapi(app, loop):
+	""" Without preload each worker maps the snapshot after the fork, if it is there yet. """
+	global cityapi
+	if cityapi is None:
+		cityapi = CityAPI(build = False)
+	await cityapi.open_pools()
+
+
+@webapi.listener('after_server_stop')
+async def close_cityapi(app, loop):
+	await cityapi.close_pools()
+
+
+@webapi.listener('after_server_start')
+async def watch_snapshot(app, loop):
+	"""
+	Load this worker's dataset once the bootstrap process writes the snapshot,
+	and reload it whenever apply_deltas writes a new snapshot generation.
+	"""
+	async def watch():
+		while True:
+			await asyncio.sleep(SNAPSHOT_POLL if cityapi.ready else READY_POLL)
+			try:
+				if not cityapi.ready or cityapi.snapshot_changed():
+					cityapi.reload(build = False)
+			except Exception as ex:
+				logger.exception(ex, 'Snapshot reload failed:')
+	loop.create_task(watch())
+
+
+@webapi.listener('after_server_start')
+async def log_memory(app, loop):
+	mem = procstats.memory()
+	logger.info('Worker %s memory: rss %s kB, pss %s kB.' % (mem['pid'], mem['Rss'], mem['Pss']))
+
+
+@webapi.middleware('request')
+async def require_dataset(req):
+	""" Until the dataset is loaded, only WITHOUT_DATASET endpoints are served. """
+	if not cityapi.ready and req.path.rstrip('/').rsplit('/', 1)[-1] not in WITHOUT_DATASET:
+		return json({'error': 'dataset loading, see /v0/city/ready'}, status = 503)
+
+
+@webapi.route('/v0/city/live')
+async def live(req):
+	'''
+	Liveness, this worker is serving requests, 503 once the bootstrap process has died without a snapshot:
+	example:
+	http://citysearch:8080/v0/city/live
+	'''
+	if BOOTSTRAP_FAILED.is_set():
+		return json({'live': False, 'error': 'bootstrap failed, see the log'}, status = 503)
+	return json({'live': True})
+
+
+@webapi.route('/v0/city/ready')
+async def ready(req):
+	'''
+	Readiness, 200 once this worker has loaded the dataset, 503 before:
+	example:
+	http://citysearch:8080/v0/city/ready
+	'''
+	rs = {'ready': cityapi.ready, 'dataset': DATASET, 'version': cityapi.version, 'generation': cityapi.generation}
+	return json(rs, status = 200 if cityapi.ready else 503)
+
+
 @webapi.route('/v0/city/hello')
 async def hello(req):
 	'''
@@ -31,10 +233,31 @@ async def count(req):
 	example:
 	http://citysearch:8080/v0/city/count
 	'''
-	cnt = SQL.singleton().fetchone('select count(1) from City;')[0]
+	cnt = (await cityapi.sqlpool.fetchone('select count(1) from City;'))[0]
 	return json({'count':cnt})
 
 
+@webapi.route('/v0/city/memory')
+async def memory(req):
+	'''
+	Per-worker RSS/PSS report in kB, summed across the workers (not the bootstrap process):
+	example:
+	http://citysearch:8080/v0/city/memory
+	'''
+	pids = None if WORKERS > 1 else [os.getpid()]
+	return json(procstats.workers_report(pids, BOOTSTRAP_PIDS))
+
+
+@webapi.route('/v0/city/cache')
+async def cache(req):
+	'''
+	This worker's result cache counters and dataset version:
+	example:
+	http://citysearch:8080/v0/city/cache
+	'''
+	return json(cityapi.cache.stats())
+
+
 @webapi.route('/v0/city/proximity_search')
 async def proximity_search(req):
 	'''
@@ -42,10 +265,14 @@ async def proximity_search(req):
 	The city identifier/value pair should be provided as the first 
 	positional query parameter. Limit the city count with query 
 	parameter k (defaults to 10). Limit the country in the origin 
-	and result set queries with query parameter ccode.
+	and result set queries with query parameter ccode. Project the 
+	result fields with query parameter fields. Stream large results 
+	as they are read with stream=ndjson or stream=json.
 	example:
 	http://citysearch:8080/v0/city/proximity_search?name=Daly%20City&k=10
 	http://citysearch:8080/v0/city/proximity_search?geonameid=3039154&k=100&ccode=US
+	http://citysearch:8080/v0/city/proximity_search?name=Daly%20City&fields=geonameid,name,latitude,longitude
+	http://citysearch:8080/v0/city/proximity_search?name=Daly%20City&k=5000&stream=ndjson
 	'''
 	akey = list(req.args.keys())[0]
 	avalue = list(req.args.values())[0][0]
@@ -57,7 +284,10 @@ async def proximity_search(req):
 		ccode = req.args['ccode'][0]
 	else:
 		ccode = None
-	rs = cityapi.proximity_search(akey, avalue, k, ccode)
+	mode = stream_arg(req)
+	if mode:
+		return stream_rows(cityapi.proximity_search_stream(akey, avalue, k, ccode, fields_arg(req)), mode)
+	rs = await cityapi.proximity_search_async(akey, avalue, k, ccode, fields_arg(req))
 	return json(rs)
 
 
@@ -68,10 +298,14 @@ async def proximity_search2(req):
 	The city identifier/value pair should be provided as the first 
 	positional query parameter. Limit the city count with query 
 	parameter k (defaults to 10). Limit the country in the origin 
-	and result set queries with query parameter ccode.
+	and result set queries with query parameter ccode. Project the 
+	result fields with query parameter fields. Stream large results 
+	as they are encoded with stream=ndjson or stream=json.
 	example:
 	http://citysearch:8080/v0/city/proximity_search2?name=Daly%20City&k=10
 	http://citysearch:8080/v0/city/proximity_search2?geonameid=3039154&k=100&ccode=US
+	http://citysearch:8080/v0/city/proximity_search2?name=Daly%20City&fields=name,distance_km
+	http://citysearch:8080/v0/city/proximity_search2?name=Daly%20City&k=50000&stream=json
 	'''
 	akey = list(req.args.keys())[0]
 	avalue = list(req.args.values())[0][0]
@@ -83,30 +317,145 @@ async def proximity_search2(req):
 		ccode = req.args['ccode'][0]
 	else:
 		ccode = None
-	rs = cityapi.proximity_search2(akey, avalue, k, ccode)
+	mode = stream_arg(req)
+	if mode:
+		return stream_rows(cityapi.proximity_search2_stream(akey, avalue, k, ccode, fields_arg(req)), mode)
+	rs = cityapi.proximity_search2(akey, avalue, k, ccode, fields_arg(req))
+	return respond(rs)
+
+
+@webapi.route('/v0/city/proximity_search3')
+async def proximity_search3(req):
+	'''
+	Proximity search #3 for cities, over MariaDB's SPATIAL index:
+	The city identifier/value pair should be provided as the first 
+	positional query parameter. Limit the city count with query 
+	parameter k (defaults to 10). Limit the country in the origin 
+	and result set queries with query parameter ccode. Project the 
+	result fields with query parameter fields. Stream large results 
+	as they are read with stream=ndjson or stream=json.
+	example:
+	http://citysearch:8080/v0/city/proximity_search3?name=Daly%20City&k=10
+	http://citysearch:8080/v0/city/proximity_search3?geonameid=3039154&k=100&ccode=US
+	http://citysearch:8080/v0/city/proximity_search3?name=Daly%20City&k=5000&stream=ndjson
+	'''
+	akey = list(req.args.keys())[0]
+	avalue = list(req.args.values())[0][0]
+	if 'k' in req.args:
+		k = int(req.args['k'][0])
+	else:
+		k = 10
+	if 'ccode' in req.args:
+		ccode = req.args['ccode'][0]
+	else:
+		ccode = None
+	mode = stream_arg(req)
+	if mode:
+		return stream_rows(cityapi.proximity_search_stream(akey, avalue, k, ccode, fields_arg(req), 'proximity_search3'), mode)
+	rs = await cityapi.proximity_search3_async(akey, avalue, k, ccode, fields_arg(req))
 	return json(rs)
 
 
+@webapi.route('/v0/city/proximity_batch', methods = ['POST'])
+async def proximity_batch(req):
+	'''
+	Batch proximity search #2 for many origins in one request:
+	POST a JSON list of items, each either a city identifier/value pair 
+	or a lat and lon, with optional per item k (defaults to 10) and ccode. 
+	Results stream back as newline delimited JSON, one line per item in 
+	input order ({} for items that are invalid or not found). Project the 
+	result fields with query parameter fields.
+	example:
+	curl -d '[{"name": "Daly City", "k": 3}, {"lat": 48.85, "lon": 2.35, "ccode": "FR"}]' http://citysearch:8080/v0/city/proximity_batch
+	'''
+	items = req.json
+	if isinstance(items, dict):
+		items = items.get('items')
+	if not isinstance(items, list):
+		return json({'error': 'expected a JSON list of items'}, status = 400)
+	if len(items) > BATCH_MAX:
+		return json({'error': 'at most %d items per batch' % BATCH_MAX}, status = 413)
+	fields = fields_arg(req)
+
+	async def stream_items(response):
+		async for body in cityapi.proximity_search_batch(items, fields):
+			await write(response, ndjson(body))
+
+	return stream(stream_items, content_type = 'application/x-ndjson')
+
+
+@webapi.route('/v0/city/lookup_batch', methods = ['POST'])
+async def lookup_batch(req):
+	'''
+	Bulk city lookup: POST a JSON list of items, each a city identifier/value 
+	pair with an optional ccode. Responds with the matching cities in input 
+	order (null for items that are invalid or not found), resolved from the 
+	in-memory indexes. Project the result fields with query parameter fields.
+	example:
+	curl -d '[{"name": "Daly City", "ccode": "US"}, {"geonameid": 3039154}]' http://citysearch:8080/v0/city/lookup_batch
+	'''
+	items = req.json
+	if isinstance(items, dict):
+		items = items.get('items')
+	if not isinstance(items, list):
+		return json({'error': 'expected a JSON list of items'}, status = 400)
+	if len(items) > BATCH_MAX:
+		return json({'error': 'at most %d items per batch' % BATCH_MAX}, status = 413)
+	return respond(cityapi.lookup_batch(items, fields_arg(req)))
+
+
 @webapi.route('/v0/city/text_search')
 async def text_search(req):
 	'''
-	Full text search for cities:
+	Full text search for cities, project the result fields with query parameter fields.
+	With stream=ndjson or stream=json up to limit matches (beyond the 
+	default 20) stream back as they are read:
 	example:
 	http://citysearch:8080/v0/city/text_search?q=San%20Francisco
+	http://citysearch:8080/v0/city/text_search?q=San%20Francisco&fields=geonameid,name
+	http://citysearch:8080/v0/city/text_search?q=San&limit=20000&stream=ndjson
 	'''
 	if 'q' in req.args:
 		q = req.args['q'][0]
 	else:
 		return json({})
-	rs = cityapi.text_search(q)
-	return json(rs)
+	mode = stream_arg(req)
+	if mode:
+		limit = int(req.args['limit'][0]) if 'limit' in req.args else 20
+		return stream_rows(cityapi.text_search_stream(q, limit, fields_arg(req)), mode)
+	rs = await cityapi.text_search_async(q, fields_arg(req))
+	return respond(rs)
+
+
+@webapi.route('/v0/city/text_batch', methods = ['POST'])
+async def text_batch(req):
+	'''
+	Batch full text search for cities:
+	POST a JSON list of query strings, they are sent to Sphinx as 
+	multi-query batches. Results stream back as newline delimited JSON, 
+	one line per query in input order. Project the result fields with 
+	query parameter fields.
+	example:
+	curl -d '["San Francisco", "Daly City"]' http://citysearch:8080/v0/city/text_batch
+	'''
+	texts = req.json
+	if not isinstance(texts, list):
+		return json({'error': 'expected a JSON list of query strings'}, status = 400)
+	if len(texts) > BATCH_MAX:
+		return json({'error': 'at most %d queries per batch' % BATCH_MAX}, status = 413)
+	rs = await cityapi.text_search_batch_async(texts, fields_arg(req))
+
+	async def stream_results(response):
+		for body in rs:
+			await write(response, ndjson(body))
+
+	return stream(stream_results, content_type = 'application/x-ndjson')
 
 
 
 def main():
 	logger.info('CitySearch webapi started.')
-	workers = 4 * os.cpu_count()
-	webapi.run(host = '0.0.0.0', port = 8080, workers = workers, debug = False)
+	webapi.run(host = '0.0.0.0', port = 8080, workers = WORKERS, debug = False)
 	logger.info('CitySearch webapi stopped.')
 
 
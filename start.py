@@ -8,6 +8,15 @@ import subprocess as sp
 
 
 DEFAULT_PASSWORD = 'citysearch123456'
+DEFAULT_DATASET = 'cities1000'
+
+
+def dataset_env():
+	""" Docker -e options of the GeoNames dataset (and an rt_mem_limit override), see CITYSEARCH_DATASET. """
+	opts = '-e "%s=%s" ' % ('CITYSEARCH_DATASET', os.getenv('CITYSEARCH_DATASET', DEFAULT_DATASET))
+	if os.getenv('SPHINX_RT_MEM_LIMIT'):
+		opts += '-e "%s=%s" ' % ('SPHINX_RT_MEM_LIMIT', os.getenv('SPHINX_RT_MEM_LIMIT'))
+	return opts
 
 
 def pre_start(cname, args):
@@ -67,6 +76,8 @@ def start_sphinx(args):
 	startCmd += '--restart=always '
 	startCmd += '-p 9306:9306 '
 	startCmd += '-p 9312:9312 '
+	startCmd += '-v /tmp/citysearch/sphinx:/tmp/citysearch/sphinx '
+	startCmd += dataset_env()
 	startCmd += '-d %s' % container_name
 	if args.new:
 		if args.echo:
@@ -92,6 +103,7 @@ def start_citysearch(args):
 	startCmd += '-v /var/log/citysearch:/var/log/citysearch '
 	startCmd += '--link sphinx:sphinx '
 	startCmd += '--link mariadb:mariadb '
+	startCmd += dataset_env()
 	startCmd += '-d %s' % container_name
 	if args.new:
 		if args.echo:
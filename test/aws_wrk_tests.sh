@@ -10,6 +10,15 @@ wrk -c 100 -d 10 -t 33 "http://citysearch:8080/v0/city/proximity_search?name=Dal
 echo ''
 wrk -c 100 -d 10 -t 33 "http://citysearch:8080/v0/city/proximity_search2?name=Daly%20City&k=10"
 echo ''
+wrk -c 100 -d 10 -t 33 "http://citysearch:8080/v0/city/proximity_search3?name=Daly%20City&k=10"
+echo ''
+# The proximity engines side by side, from random origins and k that mostly miss the result cache:
+wrk -c 100 -d 10 -t 33 -s "$(dirname "$0")/wrk_proximity.lua" "http://citysearch:8080/v0/city/proximity_search"
+echo ''
+wrk -c 100 -d 10 -t 33 -s "$(dirname "$0")/wrk_proximity.lua" "http://citysearch:8080/v0/city/proximity_search2"
+echo ''
+wrk -c 100 -d 10 -t 33 -s "$(dirname "$0")/wrk_proximity.lua" "http://citysearch:8080/v0/city/proximity_search3"
+echo ''
 wrk -c 100 -d 10 -t 33 "http://citysearch:8080/v0/city/text_search?q=San%20Francisco"
 echo ''
 echo 'Finished wrk tests.'
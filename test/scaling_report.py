@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Scaling report: cold start every GeoNames dataset in turn and measure its
+load time (until /ready), worker memory (/memory) and request latency
+percentiles, printed as one table row per dataset.
+Run from the repository root on the docker host, after ./build.py. The
+city snapshots under /tmp/citysearch are removed so every start reloads
+the databases, downloaded dumps are kept (a second run times no download).
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import random
+import argparse
+import subprocess as sp
+import concurrent.futures
+
+import requests
+
+
+BASEURL = 'http://127.0.0.1:8080/v0/city/'
+DATASETS = ['cities15000', 'cities5000', 'cities1000', 'cities500', 'allCountries']
+SNAPSHOTS = '/tmp/citysearch/snapshot_v*'
+ENDPOINTS = ['proximity_search', 'proximity_search2', 'proximity_search3', 'text_search']
+HUBS = ['London', 'Paris', 'Tokyo', 'San Francisco', 'Sydney', 'Lagos', 'Lima', 'Mumbai'] # Origins in every dataset.
+
+
+def url(txt):
+	return BASEURL + txt
+
+
+def percentile(values, pct):
+	""" Nearest rank percentile of a list of numbers. """
+	values = sorted(values)
+	return values[max(0, int(round(pct / 100.0 * len(values))) - 1)]
+
+
+def cold_start(dataset, timeout):
+	""" Clean start every container on dataset, returning the seconds until the web api is ready for it. """
+	env = dict(os.environ, CITYSEARCH_DATASET = dataset)
+	for path in glob.glob(SNAPSHOTS):
+		shutil.rmtree(path)
+	started = time.time()
+	sp.check_call(['./start.py', '-c', '--all'], env = env, stdout = sp.DEVNULL)
+	while time.time() - started < timeout:
+		try:
+			rs = requests.get(url('ready'), timeout = 5)
+			if rs.status_code == 200 and rs.json().get('dataset') == dataset:
+				return time.time() - started
+		except (requests.RequestException, ValueError):
+			pass # Not up yet.
+		time.sleep(1)
+	raise RuntimeError('%s not ready after %d seconds.' % (dataset, timeout))
+
+
+def sample_cities(k):
+	""" (geonameid, name) of about k cities around the hubs, so queries miss the result caches. """
+	cities = set()
+	for hub in HUBS:
+		rs = requests.get(url('proximity_search2'), params = {'name': hub, 'k': k // len(HUBS) + 1, 'fields': 'geonameid,name'})
+		if rs.status_code == 200:
+			cities.update((x['geonameid'], x['name']) for x in rs.json())
+	cities = sorted(cities)
+	random.shuffle(cities)
+	return cities[:k]
+
+
+def latencies(queries, concurrency):
+	""" Milliseconds of every query, a (path, params) pair, over concurrency clients. """
+	session = requests.Session()
+	def timed(query):
+		started = time.time()
+		session.get(url(query[0]), params = query[1]).raise_for_status()
+		return 1000 * (time.time() - started)
+	with concurrent.futures.ThreadPoolExecutor(max_workers = concurrency) as ex:
+		return list(ex.map(timed, queries))
+
+
+def measure(dataset, args):
+	""" One report row for dataset. """
+	row = {'dataset': dataset, 'load_s': cold_start(dataset, args.timeout)}
+	row['rows'] = requests.get(url('count')).json()['count']
+	mem = requests.get(url('memory')).json()
+	row['rss_mb'] = mem['total_rss_kb'] / 1024.0
+	row['pss_mb'] = mem['total_pss_kb'] / 1024.0
+	cities = sample_cities(args.requests)
+	endpoints = {
+		'proximity_search': [('proximity_search', {'geonameid': gid, 'k': 10}) for gid, name in cities],
+		'proximity_search2': [('proximity_search2', {'geonameid': gid, 'k': 10}) for gid, name in cities],
+		'proximity_search3': [('proximity_search3', {'geonameid': gid, 'k': 10}) for gid, name in cities],
+		'text_search': [('text_search', {'q': name}) for gid, name in cities]}
+	for name, queries in endpoints.items():
+		ms = latencies(queries, args.concurrency)
+		row[name] = (percentile(ms, 50), percentile(ms, 99))
+	return row
+
+
+def report(rows):
+	head = '%-13s %10s %9s %9s %9s' % ('dataset', 'rows', 'load s', 'rss MB', 'pss MB')
+	head += ''.join(' %26s' % ('%s p50/p99 ms' % name) for name in ENDPOINTS)
+	lines = [head]
+	for row in rows:
+		line = '%-13s %10d %9.1f %9.1f %9.1f' % (row['dataset'], row['rows'], row['load_s'], row['rss_mb'], row['pss_mb'])
+		for name in ENDPOINTS:
+			line += ' %26s' % ('%.1f / %.1f' % row[name])
+		lines.append(line)
+	return '\n'.join(lines)
+
+
+def main():
+	""" Main entry point to the scaling report. """
+	desc = """Scaling report: load time, RSS and p99 latency per GeoNames dataset."""
+	ap = argparse.ArgumentParser(add_help = True, description = desc)
+	ap.add_argument('datasets', nargs = '*', default = DATASETS, help = 'Datasets, smallest first.')
+	ap.add_argument('-r', '--requests', type = int, default = 2000, help = 'Requests per endpoint.')
+	ap.add_argument('-c', '--concurrency', type = int, default = 10, help = 'Concurrent clients.')
+	ap.add_argument('-t', '--timeout', type = int, default = 7200, help = 'Seconds to wait for a cold start.')
+	args = ap.parse_args()
+	rows = []
+	for dataset in args.datasets:
+		rows.append(measure(dataset, args))
+		print(report(rows[-1:]).splitlines()[-1], file = sys.stderr)
+	print(report(rows))
+
+
+if __name__ == '__main__':
+	main()
@@ -31,6 +31,14 @@ class APITest(ut.TestCase):
 		elapsed = timeit.default_timer() - self.started
 		print('time: %s sec.' % elapsed)
 
+	def test_live1(self):
+		self.assertTrue(fetch('live')['live'])
+
+	def test_ready1(self):
+		rs = fetch('ready')
+		self.assertTrue(rs['ready'])
+		self.assertTrue(rs['version'] >= 1)
+
 	def test_count1(self):
 		cnt = fetch('count')['count']
 		print('city count: %s' % cnt)
@@ -55,6 +63,37 @@ class APITest(ut.TestCase):
 		print('proximity rate: %s/sec' % str(n/t))
 		self.assertTrue(n/t > 10)
 
+	def test_proximity3(self):
+		cities = fetch('proximity_search2?name=Daly%20City&k=6')
+		GEONAMEIDS = [5341430, 5330854, 5338703, 5330810, 5397765, 5391959]
+		geonameids = [c['geonameid'] for c in cities]
+		print('proximity search 2 matches: %s/%s' % (len(geonameids), len(GEONAMEIDS)))
+		self.assertTrue(set(GEONAMEIDS) == set(geonameids))
+		self.assertTrue(cities[0]['distance_km'] == 0.0)
+
+	def test_proximity4(self):
+		cities = fetch('proximity_search2?name=Daly%20City&k=6&fields=geonameid,distance_km')
+		self.assertTrue(all(set(c.keys()) == {'geonameid', 'distance_km'} for c in cities))
+		self.assertTrue(len(cities) == 6)
+
+	def test_proximity5(self):
+		cities = fetch('proximity_search?name=Daly%20City&k=6&fields=geonameid,name')
+		self.assertTrue(all(set(c.keys()) == {'geonameid', 'name'} for c in cities))
+		self.assertTrue(len(cities) == 6)
+
+	def test_proximity6(self):
+		cities = fetch('proximity_search3?name=Daly%20City&k=6')
+		GEONAMEIDS = [5341430, 5330854, 5338703, 5330810, 5397765, 5391959]
+		geonameids = [c['geonameid'] for c in cities]
+		print('proximity search 3 matches: %s/%s' % (len(geonameids), len(GEONAMEIDS)))
+		self.assertTrue(set(GEONAMEIDS) == set(geonameids))
+
+	def test_proximity7(self):
+		for query in ['name=Suva&k=50', 'name=Longyearbyen&k=20', 'name=Paris&k=200&ccode=FR']:
+			cities2 = fetch('proximity_search2?%s&fields=geonameid' % query)
+			cities3 = fetch('proximity_search3?%s&fields=geonameid' % query)
+			self.assertTrue({c['geonameid'] for c in cities2} == {c['geonameid'] for c in cities3})
+
 	def test_text1(self):
 		cities = fetch('text_search?q=San%20Francisco')
 		GEONAMEIDS = [3429054, 3837624, 3837625, 3449112, 3493146, 2511381, 3590197, 3590213, 3590219, 3600338]
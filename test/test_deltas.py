@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Module to test GeoNames delta files applied to a small city store.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest as ut
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from citysearch import CityAPI, DataLoader, colnames, col_types
+from citystore import CityStore
+from download import write_state
+
+
+def city(geonameid, name, lat, lon, ccode, population):
+	""" A GeoNames dump line of a populated place. """
+	row = dict.fromkeys(colnames(), '')
+	row.update({
+		'geonameid': geonameid, 'name': name, 'asciiname': name, 'latitude': lat, 'longitude': lon,
+		'feat_class': 'P', 'feat_code': 'PPL', 'country_code': ccode, 'population': population,
+		'dem': 10, 'timezone': 'Europe/Paris', 'modified': '2018-01-01'})
+	return '\t'.join(str(row[col]) for col in colnames()) + '\n'
+
+
+DUMP = [
+	city(1, 'Alpha', 48.85, 2.35, 'FR', 2000000),
+	city(2, 'Bravo', 45.76, 4.83, 'FR', 500000),
+	city(3, 'Charlie', 43.30, 5.37, 'FR', 800000),
+	city(4, 'Delta', 52.52, 13.40, 'DE', 3500000),
+	city(5, 'Echo', 48.14, 11.58, 'DE', 1400000)]
+
+
+class DeltaTest(ut.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.dl = DataLoader('cities1000')
+		path = os.path.join(self.dir, 'dump.txt')
+		with open(path, 'w', encoding = 'utf-8') as fout:
+			fout.writelines(DUMP)
+		df = self.dl.read_geonames(path)
+		df.insert(0, 'id', range(1, len(df) + 1))
+		self.store = CityStore.from_dataframe(df, col_types)
+		os.remove(path)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def write(self, name, lines):
+		with open(os.path.join(self.dir, name), 'w', encoding = 'utf-8') as fout:
+			fout.writelines(lines)
+
+	def apply(self, after = None):
+		""" The store and indexes after the delta files in the test directory (dated after after). """
+		geo_cc = CityAPI.geo_indexes(self.store)['geo_cc']
+		rows, deletes = self.dl.read_deltas(self.dl.delta_files((), self.dir, after), self.dir)
+		df, positions, dead = CityAPI.delta_changes(self.store, rows, deletes)
+		self.assertEqual(df.id.tolist(), [pos + 1 for pos in positions])
+		return CityAPI.patch_store(self.store, geo_cc, df, positions, dead)
+
+	def test_deltas1(self):
+		self.write('modifications-2018-01-02.txt', [
+			city(2, 'Bravissimo', 45.76, 4.83, 'FR', 510000), # Renamed.
+			city(6, 'Foxtrot', 48.80, 2.30, 'FR', 90000), # New, next to Alpha.
+			city(5, 'Echo', 48.14, 11.58, 'DE', 10)]) # Below the cities1000 floor now.
+		self.write('deletes-2018-01-02.txt', ['3\tCharlie\tduplicate\n'])
+		store, indexes = self.apply()
+		gids = store.index['geonameid']
+		self.assertEqual(len(store), 6)
+		self.assertEqual([gids.first(gid) for gid in [1, 2, 3, 4, 5, 6]], [0, 1, None, 3, None, 5])
+		self.assertEqual(store.dead.tolist(), [False, False, True, False, True, False])
+		self.assertEqual(store.index['name'].first('Bravissimo'), 1)
+		self.assertIsNone(store.index['name'].first('Bravo'))
+		self.assertEqual(store.composite['name'].first(('FR', 'Foxtrot')), 5)
+		self.assertEqual(int(store['population'][1]), 510000)
+
+	def test_deltas2(self):
+		self.write('modifications-2018-01-02.txt', [city(6, 'Foxtrot', 48.80, 2.30, 'FR', 90000)])
+		self.write('deletes-2018-01-02.txt', ['3\tCharlie\tduplicate\n', '4\tDelta\tduplicate\n'])
+		store, indexes = self.apply()
+		ids, dist = indexes['geo']['all'].nearest(48.85, 2.35, 10)
+		self.assertEqual(ids.tolist()[:2], [0, 5]) # Alpha, then Foxtrot.
+		self.assertEqual(sorted(ids.tolist()), [0, 1, 4, 5]) # No deleted city.
+		ids, dist = indexes['geo_cc']['FR'].nearest(45.76, 4.83, 10)
+		self.assertEqual(ids.tolist(), [1, 5, 0])
+		ids, dist = indexes['geo_cc']['DE'].nearest(52.52, 13.40, 10)
+		self.assertEqual(ids.tolist(), [4])
+
+	def test_refreshed_dump(self):
+		self.write('modifications-2018-01-02.txt', [city(2, 'Bravo', 45.76, 4.83, 'FR', 1)]) # Older than the dump.
+		self.write('deletes-2018-01-03.txt', ['1\tAlpha\tduplicate\n']) # On its day, so in it.
+		self.write('modifications-2018-01-04.txt', [city(6, 'Foxtrot', 48.80, 2.30, 'FR', 90000)])
+		self.dl.archive = lambda: os.path.join(self.dir, 'cities1000.zip')
+		write_state(self.dl.archive() + '.json', {'etag': '"v2"', 'last_modified': 'Wed, 03 Jan 2018 02:15:00 GMT'})
+		self.assertEqual(self.dl.dump_date(), '2018-01-03')
+		self.assertEqual(self.dl.delta_files((), self.dir, self.dl.dump_date()), [('modifications-2018-01-04.txt', 'modifications')])
+		store, indexes = self.apply(self.dl.dump_date())
+		self.assertEqual(len(store), 6)
+		self.assertEqual(store.dead.tolist(), [False] * 6)
+		self.assertEqual(int(store['population'][1]), 500000)
+		self.assertEqual(store.index['name'].first('Foxtrot'), 5)
+
+
+
+if __name__ == '__main__':
+	ut.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Module to test resumable, conditional downloads against a local HTTP stand-in.
+"""
+
+import os
+import sys
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest as ut
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import download
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+	""" Serves one file, body and etag set by the test, with conditional and Range requests. """
+	body = b''
+	etag = '"v1"'
+	last_modified = 'Mon, 01 Jan 2018 00:00:00 GMT'
+	requests = [] # (status, request headers) of every request.
+	digest = None # Published with every response when set, as a Digest header.
+
+	def do_GET(self):
+		cls = type(self)
+		body, first = cls.body, 0
+		if self.headers.get('If-None-Match') == cls.etag:
+			return self.reply(304, {})
+		status, headers = 200, {'ETag': cls.etag, 'Last-Modified': cls.last_modified}
+		ranged = self.headers.get('Range')
+		if ranged and self.headers.get('If-Range') in (None, cls.etag):
+			first = int(ranged[len('bytes='):].rstrip('-'))
+			if first >= len(body):
+				return self.reply(416, {'Content-Range': 'bytes */%d' % len(body)})
+			status = 206
+			headers['Content-Range'] = 'bytes %d-%d/%d' % (first, len(body) - 1, len(body))
+		if cls.digest:
+			headers['Digest'] = 'SHA-256=' + cls.digest
+		self.reply(status, headers, body[first:])
+
+	def reply(self, status, headers, body = b''):
+		type(self).requests.append((status, dict(self.headers)))
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class DownloadTest(ut.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.server = http.server.HTTPServer(('127.0.0.1', 0), StandIn)
+		cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+		cls.thread.start()
+		cls.url = 'http://127.0.0.1:%d/cities.zip' % cls.server.server_port
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'cities.zip')
+		StandIn.body = os.urandom(3 * download.BLOCK + 12345)
+		StandIn.etag = '"v1"'
+		StandIn.requests = []
+		StandIn.digest = None
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def partial(self, data, etag):
+		""" Leave a .part of data, as an interrupted run of the etag version would. """
+		with open(self.path + '.part', 'wb') as fout:
+			fout.write(data)
+		download.write_state(self.path + '.part.json', {'etag': etag, 'last_modified': None})
+
+	def assertDownloaded(self, state):
+		with open(self.path, 'rb') as fin:
+			self.assertEqual(fin.read(), StandIn.body)
+		self.assertEqual(state['size'], len(StandIn.body))
+		self.assertEqual(state['etag'], StandIn.etag)
+		self.assertFalse(os.path.exists(self.path + '.part'))
+		self.assertFalse(os.path.exists(self.path + '.part.json'))
+
+	def test_download200(self):
+		state = download.fetch(self.url, self.path)
+		self.assertDownloaded(state)
+		self.assertEqual([status for status, headers in StandIn.requests], [200])
+
+	def test_unchanged304(self):
+		state = download.fetch(self.url, self.path)
+		self.assertIsNone(download.fetch(self.url, self.path, state))
+		self.assertEqual(StandIn.requests[-1][0], 304)
+		self.assertEqual(StandIn.requests[-1][1].get('If-None-Match'), '"v1"')
+
+	def test_resume206(self):
+		self.partial(StandIn.body[:download.BLOCK + 7], '"v1"')
+		state = download.fetch(self.url, self.path)
+		self.assertDownloaded(state)
+		status, headers = StandIn.requests[-1]
+		self.assertEqual(status, 206)
+		self.assertEqual(headers.get('Range'), 'bytes=%d-' % (download.BLOCK + 7))
+
+	def test_changed_etag(self):
+		self.partial(StandIn.body[:download.BLOCK], '"v0"')
+		state = download.fetch(self.url, self.path, {'etag': '"v0"'})
+		self.assertDownloaded(state)
+		self.assertEqual([status for status, headers in StandIn.requests], [200])
+
+	def test_changed_since_download(self):
+		state = download.fetch(self.url, self.path)
+		StandIn.body, StandIn.etag = os.urandom(1000), '"v2"'
+		self.assertDownloaded(download.fetch(self.url, self.path, state))
+
+	def test_whole_part416(self):
+		self.partial(StandIn.body, '"v1"')
+		state = download.fetch(self.url, self.path)
+		self.assertDownloaded(state)
+		self.assertEqual([status for status, headers in StandIn.requests], [416])
+
+	def test_oversized_part416(self):
+		self.partial(StandIn.body + b'junk', '"v1"')
+		state = download.fetch(self.url, self.path)
+		self.assertDownloaded(state)
+		self.assertEqual([status for status, headers in StandIn.requests], [416, 200])
+
+	def test_digest(self):
+		StandIn.digest = base64.b64encode(hashlib.sha256(StandIn.body).digest()).decode('ascii')
+		self.partial(StandIn.body[:download.BLOCK], '"v1"')
+		state = download.fetch(self.url, self.path)
+		self.assertDownloaded(state)
+		self.assertEqual(state['digest'], ['sha256', StandIn.digest])
+
+	def test_digest_mismatch(self):
+		StandIn.digest = base64.b64encode(hashlib.sha256(b'another file').digest()).decode('ascii')
+		with self.assertRaises(download.DownloadError):
+			download.fetch(self.url, self.path)
+		self.assertFalse(os.path.exists(self.path))
+		self.assertFalse(os.path.exists(self.path + '.part'))
+
+
+
+if __name__ == '__main__':
+	ut.main()
@@ -0,0 +1,24 @@
+-- Proximity search requests from random origins and k, so runs time the search engines
+-- rather than the result cache, e.g.:
+-- wrk -c 100 -d 10 -t 33 -s wrk_proximity.lua "http://127.0.0.1:8080/v0/city/proximity_search3"
+
+local names = {
+	"Daly%20City", "San%20Francisco", "Oakland", "Los%20Angeles", "New%20York%20City", "Chicago",
+	"Toronto", "Mexico%20City", "Lima", "Buenos%20Aires", "London", "Paris", "Berlin", "Madrid",
+	"Rome", "Cairo", "Lagos", "Nairobi", "Moscow", "Mumbai", "Beijing", "Tokyo", "Sydney", "Suva"}
+
+local threads = 0
+
+function setup(thread)
+	threads = threads + 1
+	thread:set("seed", threads)
+end
+
+function init(args)
+	math.randomseed(os.time() * 1000 + seed)
+end
+
+function request()
+	local path = wrk.path .. "?name=" .. names[math.random(#names)] .. "&k=" .. math.random(5, 50)
+	return wrk.format(nil, path)
+end